@@ -0,0 +1,145 @@
+"""
+achievements.py
+Декларативные правила достижений и их проверка по счётчикам пользователя.
+"""
+
+import sqlite3
+from typing import Dict, Iterable, List, Optional
+
+
+class AchievementRule:
+    """
+    Достижение выдаётся, когда счётчик counter пользователя достигает threshold.
+    """
+
+    def __init__(self, name: str, emoji: str, description: str, counter: str, threshold: int) -> None:
+        self.name: str = name
+        self.emoji: str = emoji
+        self.description: str = description
+        self.counter: str = counter
+        self.threshold: int = threshold
+
+    @property
+    def title(self) -> str:
+        return f"{self.emoji} {self.name}"
+
+
+# Все достижения бота. Имена хранятся в user_achievements — не переименовывать
+ACHIEVEMENT_RULES: List[AchievementRule] = [
+    AchievementRule("Новичок", "🌱", "Сделал первый шаг в мир Таро", "registered", 1),
+
+    AchievementRule("Искатель", "🔮", "Первый расклад", "readings", 1),
+    AchievementRule("Любознательный", "🌟", "5 раскладов", "readings", 5),
+    AchievementRule("Мудрец", "💫", "10 раскладов", "readings", 10),
+    AchievementRule("Мастер", "✨", "20 раскладов", "readings", 20),
+    AchievementRule("Великий Маг", "👑", "50 раскладов", "readings", 50),
+
+    AchievementRule("Коллекционер", "💎", "Первый премиум-расклад", "premium", 1),
+    AchievementRule("Элитный", "💎💎", "5 премиум-раскладов", "premium", 5),
+    AchievementRule("Королевский", "👑💎", "10 премиум-раскладов", "premium", 10),
+
+    AchievementRule("Наставник", "🤝", "Пригласил первого друга", "referrals", 1),
+    AchievementRule("Проводник", "🌙", "Пригласил 3 друзей", "referrals", 3),
+    AchievementRule("Мастер Наставничества", "🤝🌟", "Пригласил 5 друзей", "referrals", 5),
+
+    AchievementRule("Энциклопедист", "📚", "3 типа раскладов", "reading_types", 3),
+    AchievementRule("Знаток раскладов", "📚✨", "5 типов раскладов", "reading_types", 5),
+
+    AchievementRule("Постоянный", "🔥", "3 дня подряд", "streak", 3),
+    AchievementRule("Ежедневный практик", "🔥🔥", "7 дней подряд", "streak", 7),
+    AchievementRule("Непрерывный путь", "🔥🔥🔥", "30 дней подряд", "streak", 30),
+
+    AchievementRule("Частый гость", "📅", "7 активных дней за месяц", "active_days", 7),
+    AchievementRule("Лунный месяц", "🌕", "30 активных дней за месяц", "active_days", 30),
+
+    AchievementRule("Критик", "📝", "Оставил первый отзыв", "feedback", 1),
+]
+
+# Значение каждого счётчика — одна выборка по ключу пользователя
+COUNTER_QUERIES: Dict[str, str] = {
+    "registered": "SELECT COUNT(*) FROM users WHERE user_id = ?",
+    "readings": "SELECT total_readings FROM user_stats WHERE user_id = ?",
+    "premium": "SELECT premium_readings FROM user_levels WHERE user_id = ?",
+    "referrals": "SELECT referrals_count FROM users WHERE user_id = ?",
+    "reading_types": "SELECT COUNT(*) FROM user_reading_types WHERE user_id = ?",
+    "streak": "SELECT streak_days FROM user_stats WHERE user_id = ?",
+    "active_days": "SELECT reading_days_active FROM user_stats WHERE user_id = ?",
+    "feedback": "SELECT COUNT(*) FROM feedback WHERE user_id = ?",
+}
+
+# Категории экрана прогресса (в порядке показа)
+PROGRESS_COUNTERS: List[str] = ["readings", "premium", "referrals", "reading_types", "streak", "active_days"]
+
+
+def load_counters(conn: sqlite3.Connection, user_id: int, counters: Iterable[str]) -> Dict[str, int]:
+    """
+    Читает текущие значения счётчиков пользователя.
+    """
+    values = {}
+    for counter in counters:
+        row = conn.execute(COUNTER_QUERIES[counter], (user_id,)).fetchone()
+        values[counter] = (row[0] or 0) if row else 0
+    return values
+
+
+def unlock_achievements(
+    conn: sqlite3.Connection,
+    user_id: int,
+    counters: Iterable[str],
+    values: Optional[Dict[str, int]] = None
+) -> List[AchievementRule]:
+    """
+    Проверяет правила, зависящие от изменившихся счётчиков, и записывает
+    новые достижения одной пачкой. Вызывается внутри транзакции события.
+
+    Args:
+        counters: счётчики, изменённые событием
+        values: уже известные значения счётчиков (остальные читаются из базы)
+
+    Returns:
+        Достижения, полученные этим вызовом
+    """
+    counters = set(counters)
+    values = dict(values or {})
+    values.update(load_counters(conn, user_id, counters - values.keys()))
+
+    reached = [
+        rule for rule in ACHIEVEMENT_RULES
+        if rule.counter in counters and values.get(rule.counter, 0) >= rule.threshold
+    ]
+    if not reached:
+        return []
+
+    unlocked = {
+        row[0] for row in conn.execute(
+            "SELECT achievement_name FROM user_achievements WHERE user_id = ?",
+            (user_id,)
+        )
+    }
+    new_rules = [rule for rule in reached if rule.name not in unlocked]
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO user_achievements (user_id, achievement_name, achievement_emoji, description)
+        VALUES (?, ?, ?, ?)
+        """,
+        [(user_id, rule.name, rule.emoji, rule.description) for rule in new_rules]
+    )
+    return new_rules
+
+
+def achievement_progress(values: Dict[str, int]) -> Dict[str, Dict[str, float]]:
+    """
+    Прогресс по категориям: текущее значение, ближайший порог и процент
+    от максимального порога категории.
+    """
+    progress = {}
+    for counter in PROGRESS_COUNTERS:
+        thresholds = sorted(rule.threshold for rule in ACHIEVEMENT_RULES if rule.counter == counter)
+        current = values.get(counter, 0)
+        next_threshold = next((t for t in thresholds if t > current), thresholds[-1])
+        progress[counter] = {
+            "current": current,
+            "next": next_threshold,
+            "progress": min(current / thresholds[-1] * 100, 100) if current > 0 else 0
+        }
+    return progress
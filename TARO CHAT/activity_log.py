@@ -0,0 +1,130 @@
+"""
+activity_log.py
+Отложенная пакетная запись журнала активности пользователей (user_activity).
+"""
+
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from storage import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+# (user_id, activity_type, details, timestamp)
+ActivityRecord = Tuple[int, str, str, str]
+
+
+class ActivityLogger:
+    """
+    Журнал активности с отложенной записью.
+
+    log() не обращается к базе: запись кладётся в ограниченную очередь,
+    фоновая задача сбрасывает её в user_activity одной транзакцией
+    executemany каждые flush_interval_ms миллисекунд или по накоплении
+    batch_size записей. При переполнении очереди новые записи отбрасываются
+    (журнал вспомогательный и не должен тормозить основной путь).
+
+    Время события фиксируется в момент вызова log() в формате CURRENT_TIMESTAMP (UTC).
+    """
+
+    def __init__(
+        self,
+        pool: SQLitePool,
+        max_queue: int = 10000,
+        batch_size: int = 500,
+        flush_interval_ms: int = 1000
+    ) -> None:
+        self.pool: SQLitePool = pool
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval_ms / 1000
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._wakeup: asyncio.Event = asyncio.Event()
+        self._stopping: bool = False
+        self._task: Optional[asyncio.Task] = None
+        self.written: int = 0
+        self.dropped: int = 0
+
+    def log(self, user_id: int, activity_type: str, details: str) -> None:
+        """
+        Ставит запись в очередь. Вызывается только из event loop.
+        """
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            self._queue.put_nowait((user_id, activity_type, details, timestamp))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"⚠️ Activity log queue is full, dropped {self.dropped} records")
+            return
+
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """
+        Запускает фоновую задачу сброса (нужен запущенный event loop).
+        """
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="activity-log-flusher")
+            logger.info("📝 Activity log writer started")
+
+    async def stop(self) -> None:
+        """
+        Останавливает фоновую задачу и записывает всё, что осталось в очереди.
+        """
+        # Задача не отменяется, а завершается сама: отмена могла бы прервать
+        # уже извлечённую из очереди пачку
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        logger.info(f"📝 Activity log writer stopped ({self.written} written, {self.dropped} dropped)")
+
+    async def flush(self) -> int:
+        """
+        Немедленно записывает все записи из очереди.
+
+        Returns:
+            Количество записанных записей
+        """
+        total = 0
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._write(batch)
+            total += len(batch)
+        return total
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            # Ждём интервал сброса или накопления batch_size записей
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _write(self, batch: List[ActivityRecord]) -> None:
+        def transaction(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                INSERT INTO user_activity (user_id, activity_type, details, timestamp)
+                VALUES (?, ?, ?, ?)
+                """,
+                batch
+            )
+
+        try:
+            await self.pool.write(transaction)
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            self.dropped += len(batch)
+            logger.error(f"⚠️ Error writing {len(batch)} activity records: {e}")
@@ -3,10 +3,8 @@ admin_handlers.py
 Финальный исправленный файл с правильными вызовами методов базы данных.
 """
 
+import asyncio
 import logging
-import shutil
-import os
-import sqlite3
 from datetime import datetime
 from aiogram import Router, Bot, F
 from aiogram.types import Message, CallbackQuery
@@ -17,16 +15,27 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from typing import Dict, Any, List
 
-from config import ADMIN_ID, PAYMENT_OPTIONS, DB_PATH
-from database import Database
+from config import ADMIN_ID, PAYMENT_OPTIONS, BACKUP_DIR
+from database import db
+from backup import backup_manager, format_size
+from broadcast import new_broadcast
+from ohmygpt_api import ohmygpt_api
+from llm_queue import llm_queue
+from model_router import model_router, hedge_budget, CLOSED, HALF_OPEN
+from audience import BROADCAST_SEGMENTS
 from utils import format_datetime
 from keyboards import admin_panel_keyboard, broadcast_keyboard
 from yoomoney import yoomoney_payment
 
 admin_router = Router()
-db = Database()
 logger = logging.getLogger(__name__)
 
+# Как часто обновлять сообщение с прогрессом бэкапа (секунды)
+BACKUP_PROGRESS_INTERVAL: float = 2.0
+
+# Как часто обновлять сообщение с прогрессом рассылки (секунды)
+BROADCAST_PROGRESS_INTERVAL: float = 5.0
+
 # ==================== ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ДЛЯ БЕЗОПАСНОГО CALLBACK.ANSWER() ====================
 
 async def safe_answer(callback: CallbackQuery, text: str = None, show_alert: bool = False) -> bool:
@@ -89,10 +98,6 @@ def pending_payment_keyboard(payment_id: int) -> InlineKeyboardBuilder:
     keyboard.adjust(2)
     return keyboard.as_markup()
 
-def get_sqlite_connection():
-    """Создаёт соединение с SQLite базой данных."""
-    return sqlite3.connect("database.db")
-
 @admin_router.message(Command("admin"))
 async def admin_panel_handler(message: Message) -> None:
     """
@@ -318,32 +323,20 @@ async def debug_payment_handler(message: Message) -> None:
         # 1. Проверяем в базе данных
         debug_info += "📊 <b>1. Проверка в базе данных:</b>\n"
         try:
-            with sqlite3.connect(str(DB_PATH)) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT p.*, u.username, u.user_id as user_id_from_db
-                    FROM payments p
-                    LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.yoomoney_label = ?
-                """, (label,))
-                
-                payment = cursor.fetchone()
-                
-                if payment:
-                    payment_dict = dict(payment)
-                    debug_info += f"✅ <b>Найдено в БД:</b>\n"
-                    debug_info += f"• ID: {payment_dict.get('id')}\n"
-                    debug_info += f"• User ID: {payment_dict.get('user_id')}\n"
-                    debug_info += f"• Username: {payment_dict.get('username', 'N/A')}\n"
-                    debug_info += f"• Amount: {payment_dict.get('amount')} руб.\n"
-                    debug_info += f"• Requests: {payment_dict.get('requests')}\n"
-                    debug_info += f"• Status: <b>{payment_dict.get('status')}</b>\n"
-                    debug_info += f"• Timestamp: {payment_dict.get('timestamp')}\n"
-                    debug_info += f"• Admin ID: {payment_dict.get('admin_id', 'N/A')}\n\n"
-                else:
-                    debug_info += "❌ <b>Не найдено в БД</b>\n\n"
+            payment_dict = await db.get_payment_by_label(label)
+            
+            if payment_dict:
+                debug_info += f"✅ <b>Найдено в БД:</b>\n"
+                debug_info += f"• ID: {payment_dict.get('id')}\n"
+                debug_info += f"• User ID: {payment_dict.get('user_id')}\n"
+                debug_info += f"• Username: {payment_dict.get('username', 'N/A')}\n"
+                debug_info += f"• Amount: {payment_dict.get('amount')} руб.\n"
+                debug_info += f"• Requests: {payment_dict.get('requests')}\n"
+                debug_info += f"• Status: <b>{payment_dict.get('status')}</b>\n"
+                debug_info += f"• Timestamp: {payment_dict.get('timestamp')}\n"
+                debug_info += f"• Admin ID: {payment_dict.get('admin_id', 'N/A')}\n\n"
+            else:
+                debug_info += "❌ <b>Не найдено в БД</b>\n\n"
         except Exception as e:
             debug_info += f"❌ <b>Ошибка БД:</b> {e}\n\n"
         
@@ -467,51 +460,58 @@ async def admin_stats_handler(callback: CallbackQuery) -> None:
         return
     
     try:
-        # Получаем всех пользователей
-        all_users = await db.get_all_users()
-        total_users = len(all_users)
-        
-        # Считаем статистику
-        active_users = 0
-        total_requests = 0
-        premium_requests = 0
-        total_readings = 0
-        
-        # Используем прямое SQL для подсчёта истории
-        with get_sqlite_connection() as conn:
-            cursor = conn.cursor()
-            
-            for user in all_users:
-                user_data = await db.get_user(user["user_id"])
-                if user_data:
-                    total_requests += user_data.get("requests_left", 0) + user_data.get("premium_requests", 0)
-                    premium_requests += user_data.get("premium_requests", 0)
-                    
-                    # Подсчитываем историю пользователя
-                    cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user["user_id"],))
-                    user_history_count = cursor.fetchone()[0]
-                    total_readings += user_history_count
-                    
-                    # Считаем активным, если есть запросы или история
-                    if (user_data.get("requests_left", 0) > 0 or 
-                        user_data.get("premium_requests", 0) > 0 or 
-                        user_history_count > 0):
-                        active_users += 1
-        
-        # Считаем рефералов
-        with get_sqlite_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users WHERE referral_id IS NOT NULL")
-            total_referrals = cursor.fetchone()[0]
+        stats = await db.get_bot_statistics()
+        if not stats:
+            raise RuntimeError("статистика недоступна")
         
         stats_text = (
             f"📊 <b>Статистика бота</b> 🌙\n\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"🎯 Активных пользователей: {active_users}\n"
-            f"🔮 Всего раскладов: {total_readings}\n"
-            f"💎 Премиум-запросов осталось: {premium_requests}\n"
-            f"🆓 Бесплатных запросов осталось: {total_requests - premium_requests}\n"
-            f"🤝 Всего рефералов: {total_referrals}"
+            f"👥 Всего пользователей: {stats['total_users']}\n"
+            f"🎯 Активных пользователей: {stats['active_users']}\n"
+            f"🔮 Всего раскладов: {stats['total_readings']}\n"
+            f"💎 Премиум-запросов осталось: {stats['premium_requests']}\n"
+            f"🆓 Бесплатных запросов осталось: {stats['free_requests']}\n"
+            f"🤝 Всего рефералов: {stats['total_referrals']}"
+        )
+        
+        api_stats = ohmygpt_api.pool_stats()
+        versions = ", ".join(f"{version}: {count}" for version, count in api_stats["http_versions"].items()) or "—"
+        stats_text += (
+            f"\n\n🌐 <b>OhMyGPT</b>\n"
+            f"⚡ Запросов в работе: {api_stats['in_flight']} "
+            f"({api_stats['utilization']:.0%} пула, пик {api_stats['peak_in_flight']})\n"
+            f"📨 Всего запросов: {api_stats['requests_total']}, ошибок соединения: {api_stats['transport_errors']}\n"
+            f"🔗 Протоколы: {versions}"
+        )
+        
+        queue_stats = llm_queue.stats()
+        stats_text += (
+            f"\n\n⏳ <b>Очередь раскладов</b>\n"
+            f"⚙️ В работе: {queue_stats['active']} / {llm_queue.concurrency}, "
+            f"ждут: {queue_stats['waiting']} (пик {queue_stats['peak_waiting']})\n"
+            f"✅ Выполнено: {queue_stats['served']}, отклонено: {queue_stats['rejected']}, "
+            f"макс. ожидание: {queue_stats['max_wait']:.0f} с"
+        )
+        
+        stats_text += "\n\n🧭 <b>Модели</b>"
+        for model_stats in model_router.snapshot():
+            if model_stats["state"] == CLOSED:
+                state = "🟢"
+            elif model_stats["state"] == HALF_OPEN:
+                state = "🟡 проба"
+            else:
+                state = f"🔴 выкл. ещё {model_stats['reopens_in']:.0f} с"
+            latency = f"{model_stats['latency']:.1f} с" if model_stats["latency"] is not None else "—"
+            stats_text += (
+                f"\n{state} <code>{model_stats['model']}</code>: {latency}, "
+                f"ошибки {model_stats['error_rate']:.0%}, таймауты {model_stats['timeout_rate']:.0%} "
+                f"({model_stats['samples']} из {model_stats['requests']})"
+            )
+        hedge_stats = hedge_budget.snapshot()
+        stats_text += (
+            f"\n🪁 Хеджи: {hedge_stats['share']:.1%} запросов за окно, "
+            f"всего {hedge_stats['hedges_total']}, выиграли {hedge_stats['hedge_wins']}, "
+            f"отказано бюджетом {hedge_stats['denied']}"
         )
         
         keyboard = InlineKeyboardBuilder()
@@ -552,64 +552,61 @@ async def admin_backup_handler(callback: CallbackQuery) -> None:
         logger.warning(f"⚠️ Unauthorized access to admin_backup by user {user_id} (@{username}).")
         return
     
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="🔙 Назад", callback_data="admin_panel")
+    keyboard.adjust(1)
+    
+    if backup_manager.in_progress:
+        await safe_answer(callback, "⏳ Бэкап уже создаётся, дождитесь завершения")
+        return
+    
+    await safe_answer(callback)
+    
+    # Бэкап выполняется в отдельном потоке; здесь только обновляем прогресс
+    backup_task = asyncio.create_task(backup_manager.create_backup())
+    last_text = None
+    while not backup_task.done():
+        progress = backup_manager.progress
+        if progress and progress["total"]:
+            percent = progress["copied"] * 100 // progress["total"]
+            stage = "Копирование базы" if progress["stage"] == "copy" else "Сжатие"
+            text = f"💾 <b>Создание бэкапа...</b> 🌙\n\n{stage}: {percent}%"
+        else:
+            text = "💾 <b>Создание бэкапа...</b> 🌙"
+        if text != last_text:
+            try:
+                await callback.message.edit_text(text, parse_mode='HTML')
+                last_text = text
+            except TelegramBadRequest:
+                pass
+        await asyncio.wait({backup_task}, timeout=BACKUP_PROGRESS_INTERVAL)
+    
     try:
-        # Проверяем существование файла базы данных
-        db_path = "database/database.db"
-        if not os.path.exists(db_path):
-            # Пробуем альтернативный путь
-            db_path = "database.db"
-            if not os.path.exists(db_path):
-                raise FileNotFoundError(f"Файл базы данных не найден: {db_path}")
-        
-        # Создаём папку backups если её нет
-        backup_dir = "backups"
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # Создаём имя файла с датой и временем
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"tarot_bot_backup_{timestamp}.db"
-        backup_path = os.path.join(backup_dir, backup_filename)
-        
-        # Копируем базу данных
-        shutil.copy2(db_path, backup_path)
-        
-        # Получаем размер файла
-        file_size = os.path.getsize(backup_path)
-        size_kb = file_size // 1024
-        size_mb = size_kb // 1024
-        
-        keyboard = InlineKeyboardBuilder()
-        keyboard.button(text="🔙 Назад", callback_data="admin_panel")
-        keyboard.adjust(1)
-        
-        size_display = f"{size_mb} МБ" if size_mb > 0 else f"{size_kb} КБ"
+        result = backup_task.result()
         
         await callback.message.edit_text(
             f"💾 <b>Бэкап успешно создан!</b> 🌙\n\n"
-            f"📁 Файл: <code>{backup_filename}</code>\n"
-            f"📏 Размер: {size_display}\n"
+            f"📁 Файл: <code>{result['path'].name}</code>\n"
+            f"📏 Размер: {format_size(result['raw_size'])} → {format_size(result['compressed_size'])} (gzip)\n"
+            f"⏱ Время: {result['duration']:.1f} с ({result['throughput_mb_s']:.1f} МБ/с)\n"
+            f"🗑 Удалено старых копий: {len(result['removed'])}\n"
             f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-            f"Бэкап сохранён в папке <code>backups/</code>",
+            f"Бэкап сохранён в папке <code>{BACKUP_DIR.name}/</code>",
             reply_markup=keyboard.as_markup(),
             parse_mode='HTML'
         )
-        logger.info(f"🔮 Admin {user_id} (@{username}) created backup at {backup_path}.")
+        logger.info(f"🔮 Admin {user_id} (@{username}) created backup at {result['path']}.")
         
     except Exception as e:
         logger.error(f"⚠️ Error creating backup: {e}")
-        keyboard = InlineKeyboardBuilder()
-        keyboard.button(text="🔙 Назад", callback_data="admin_panel")
-        keyboard.adjust(1)
         
         await callback.message.edit_text(
             f"⚠️ <b>Не удалось создать бэкап!</b> 🌙\n\n"
             f"Ошибка: {str(e)[:100]}\n\n"
-            f"Проверьте наличие файла базы данных.",
+            f"Проверьте наличие файла базы данных и свободное место на диске.",
             reply_markup=keyboard.as_markup(),
             parse_mode='HTML'
         )
-    
-    await safe_answer(callback)
 
 @admin_router.callback_query(F.data == "admin_pending_payments")
 async def admin_pending_payments_handler(callback: CallbackQuery) -> None:
@@ -708,18 +705,9 @@ async def admin_confirm_payment_handler(callback: CallbackQuery, bot: Bot) -> No
     try:
         payment_id = int(callback.data.split("_")[2])
         
-        # Используем прямой SQL для получения информации о платеже
-        with get_sqlite_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p.id, p.user_id, p.amount, p.requests, u.username, u.premium_requests
-                FROM payments p
-                LEFT JOIN users u ON p.user_id = u.user_id
-                WHERE p.id = ? AND p.status = 'pending'
-            """, (payment_id,))
-            payment_data = cursor.fetchone()
-        
-        if not payment_data:
+        payment_data = await db.get_payment(payment_id)
+        
+        if not payment_data or payment_data["status"] != "pending":
             await callback.message.edit_text(
                 "⚠️ <b>Платёж не найден или уже обработан!</b> 🌙",
                 reply_markup=InlineKeyboardBuilder()
@@ -731,7 +719,12 @@ async def admin_confirm_payment_handler(callback: CallbackQuery, bot: Bot) -> No
             await safe_answer(callback)
             return
         
-        payment_id, user_id_payment, amount, requests, username_payment, current_premium = payment_data
+        user_id_payment = payment_data["user_id"]
+        amount = payment_data["amount"]
+        requests = payment_data["requests"]
+        username_payment = payment_data["username"]
+        payer = await db.get_user(user_id_payment)
+        current_premium = payer["premium_requests"] if payer else 0
         
         # Подтверждаем платёж через метод Database
         success = await db.confirm_payment(payment_id, "confirmed", requests)
@@ -795,18 +788,9 @@ async def admin_reject_payment_handler(callback: CallbackQuery, bot: Bot) -> Non
     try:
         payment_id = int(callback.data.split("_")[2])
         
-        # Используем прямой SQL для получения информации о платеже
-        with get_sqlite_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p.user_id, p.amount, u.username
-                FROM payments p
-                LEFT JOIN users u ON p.user_id = u.user_id
-                WHERE p.id = ? AND p.status = 'pending'
-            """, (payment_id,))
-            payment_data = cursor.fetchone()
-        
-        if not payment_data:
+        payment_data = await db.get_payment(payment_id)
+        
+        if not payment_data or payment_data["status"] != "pending":
             await callback.message.edit_text(
                 "⚠️ <b>Платёж не найден или уже обработан!</b> 🌙",
                 reply_markup=InlineKeyboardBuilder()
@@ -818,7 +802,9 @@ async def admin_reject_payment_handler(callback: CallbackQuery, bot: Bot) -> Non
             await safe_answer(callback)
             return
         
-        user_id_payment, amount, username_payment = payment_data
+        user_id_payment = payment_data["user_id"]
+        amount = payment_data["amount"]
+        username_payment = payment_data["username"]
         
         # Отклоняем платёж через метод Database
         success = await db.confirm_payment(payment_id, "rejected")
@@ -877,18 +863,7 @@ async def admin_users_handler(callback: CallbackQuery) -> None:
         return
     
     try:
-        # Получаем всех пользователей через прямой SQL для лучшего контроля
-        with get_sqlite_connection() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, username, first_name, last_name, 
-                       requests_left, premium_requests, is_banned, created_at
-                FROM users 
-                ORDER BY created_at DESC 
-                LIMIT 10
-            """)
-            users = cursor.fetchall()
+        users = await db.get_recent_users(limit=10)
         
         if not users:
             users_text = "👥 <b>Нет пользователей</b> 🌙\n\nБаза данных пуста."
@@ -948,18 +923,7 @@ async def admin_feedbacks_handler(callback: CallbackQuery) -> None:
         return
     
     try:
-        # Используем прямой SQL для получения отзывов
-        with get_sqlite_connection() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT f.user_id, f.feedback, f.timestamp, u.username
-                FROM feedback f
-                LEFT JOIN users u ON f.user_id = u.user_id
-                ORDER BY f.timestamp DESC 
-                LIMIT 5
-            """)
-            feedbacks = cursor.fetchall()
+        feedbacks = await db.get_recent_feedback(limit=5)
         
         if not feedbacks:
             feedbacks_text = "🌟 <b>Нет отзывов</b> 🌙\n\nПользователи ещё не оставляли отзывы."
@@ -1074,18 +1038,58 @@ async def process_broadcast_message(message: Message, state: FSMContext, bot: Bo
         logger.warning(f"⚠️ Admin {user_id} (@{username}) provided empty broadcast message.")
         return
     
-    await state.update_data(broadcast_text=broadcast_text)
+    await state.update_data(broadcast_text=broadcast_text, broadcast_segment="all")
     
     await message.answer(
+        await broadcast_preview_text(broadcast_text, "all"),
+        reply_markup=broadcast_keyboard("all"),
+        parse_mode='HTML'
+    )
+    logger.info(f"🔮 Admin {user_id} (@{username}) previewed broadcast message: {broadcast_text[:50]}...")
+
+async def broadcast_preview_text(broadcast_text: str, segment_key: str) -> str:
+    """
+    Текст предпросмотра рассылки с выбранной аудиторией и её размером.
+    """
+    label, segment = BROADCAST_SEGMENTS[segment_key]
+    audience = await db.count_audience(segment())
+    return (
         f"📬 <b>Предпросмотр рассылки</b> 🌙\n\n"
         f"{broadcast_text}\n\n"
+        f"<b>Аудитория:</b> {label} — {audience} пользователей\n\n"
         f"<b>Подтвердите отправку:</b>\n"
-        f"• Сообщение будет отправлено всем пользователям\n"
-        f"• Отменить рассылку будет невозможно",
-        reply_markup=broadcast_keyboard(),
-        parse_mode='HTML'
+        f"• Выберите аудиторию кнопками ниже\n"
+        f"• Отменить рассылку будет невозможно"
     )
-    logger.info(f"🔮 Admin {user_id} (@{username}) previewed broadcast message: {broadcast_text[:50]}...")
+
+@admin_router.callback_query(F.data.startswith("broadcast_segment_"))
+async def broadcast_segment_handler(callback: CallbackQuery, state: FSMContext) -> None:
+    """
+    Обработчик выбора аудитории рассылки.
+    """
+    user_id: int = callback.from_user.id
+    
+    if user_id != ADMIN_ID:
+        await safe_answer(callback, "🚫 Доступ запрещён!", show_alert=True)
+        return
+    
+    segment_key = callback.data[len("broadcast_segment_"):]
+    data = await state.get_data()
+    broadcast_text = data.get("broadcast_text")
+    if segment_key not in BROADCAST_SEGMENTS or not broadcast_text:
+        await safe_answer(callback)
+        return
+    
+    await state.update_data(broadcast_segment=segment_key)
+    try:
+        await callback.message.edit_text(
+            await broadcast_preview_text(broadcast_text, segment_key),
+            reply_markup=broadcast_keyboard(segment_key),
+            parse_mode='HTML'
+        )
+    except TelegramBadRequest:
+        pass
+    await safe_answer(callback)
 
 @admin_router.callback_query(F.data == "confirm_broadcast")
 async def confirm_broadcast_handler(callback: CallbackQuery, state: FSMContext, bot: Bot) -> None:
@@ -1125,27 +1129,37 @@ async def confirm_broadcast_handler(callback: CallbackQuery, state: FSMContext,
     )
     
     try:
-        users = await db.get_all_users()
-        success_count = 0
-        fail_count = 0
-        
-        for user in users:
-            try:
-                await bot.send_message(
-                    user["user_id"],
-                    f"📬 <b>Сообщение от Таро-бота</b> 🌙\n\n{broadcast_text}",
-                    parse_mode='HTML'
-                )
-                success_count += 1
-                
-                # Небольшая задержка, чтобы не превышать лимиты Telegram
-                if success_count % 10 == 0:
-                    import asyncio
-                    await asyncio.sleep(0.1)
-                    
-            except Exception as e:
-                logger.error(f"⚠️ Failed to send broadcast to user {user['user_id']}: {e}")
-                fail_count += 1
+        segment_key = data.get("broadcast_segment", "all")
+        segment = BROADCAST_SEGMENTS.get(segment_key, BROADCAST_SEGMENTS["all"])[1]()
+        total = await db.count_audience(segment)
+        text = f"📬 <b>Сообщение от Таро-бота</b> 🌙\n\n{broadcast_text}"
+        broadcast = new_broadcast()
+        
+        # Рассылка идёт в фоне, аудитория читается из базы пачками; здесь только обновляем прогресс
+        broadcast_task = asyncio.create_task(broadcast.run(
+            db.iter_audience(segment),
+            lambda recipient: bot.send_message(recipient, text, parse_mode='HTML'),
+            total=total
+        ))
+        last_text = None
+        while not broadcast_task.done():
+            await asyncio.wait({broadcast_task}, timeout=BROADCAST_PROGRESS_INTERVAL)
+            if broadcast_task.done():
+                break
+            percent = broadcast.processed * 100 // max(total, 1)
+            progress_text = (
+                f"📬 <b>Рассылка идёт...</b> 🌙\n\n"
+                f"📊 {broadcast.processed} / {total} ({percent}%)\n"
+                f"✅ Доставлено: {broadcast.sent}\n"
+                f"⏱ {broadcast.elapsed:.0f} с"
+            )
+            if progress_text != last_text:
+                try:
+                    await callback.message.edit_text(progress_text, parse_mode='HTML')
+                    last_text = progress_text
+                except TelegramBadRequest:
+                    pass
+        report = broadcast_task.result()
         
         keyboard = InlineKeyboardBuilder()
         keyboard.button(text="🔙 Назад", callback_data="admin_panel")
@@ -1153,13 +1167,21 @@ async def confirm_broadcast_handler(callback: CallbackQuery, state: FSMContext,
         
         await callback.message.edit_text(
             f"📬 <b>Рассылка завершена!</b> 🌙\n\n"
-            f"✅ Отправлено успешно: {success_count} пользователям\n"
-            f"❌ Не удалось отправить: {fail_count} пользователям\n\n"
-            f"<i>Общее количество пользователей: {len(users)}</i>",
+            f"✅ Отправлено успешно: {report['sent']} пользователям\n"
+            f"🚫 Заблокировали бота: {report['blocked']}\n"
+            f"👻 Удалили аккаунт: {report['not_found']}\n"
+            f"❌ Не удалось отправить: {report['failed']} пользователям\n"
+            f"🔁 Повторов после лимита Telegram: {report['retries']}\n"
+            f"⏱ Время: {report['duration']:.0f} с ({report['rate']:.1f} сообщ./с)\n\n"
+            f"<i>Общее количество пользователей: {report['total']}</i>",
             reply_markup=keyboard.as_markup(),
             parse_mode='HTML'
         )
-        logger.info(f"🔮 Admin {user_id} (@{username}) completed broadcast: {success_count} sent, {fail_count} failed.")
+        logger.info(
+            f"🔮 Admin {user_id} (@{username}) completed broadcast to '{segment.name}': "
+            f"{report['sent']} sent, {report['failed']} failed, {report['blocked']} blocked, "
+            f"{report['not_found']} not found."
+        )
         
     except Exception as e:
         logger.error(f"⚠️ Error during broadcast: {e}")
@@ -1290,18 +1312,9 @@ async def process_user_input_handler(message: Message, state: FSMContext, bot: B
         # Если это username (начинается с @)
         elif user_input.startswith("@"):
             username = user_input[1:]  # Убираем @
-            # Ищем пользователя по username через SQL
-            with get_sqlite_connection() as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT * FROM users WHERE username = ? LIMIT 1",
-                    (username,)
-                )
-                row = cursor.fetchone()
-                if row:
-                    target_user_id = row["user_id"]
-                    target_user_data = await db.get_user(target_user_id)
+            target_user_id = await db.get_user_id_by_username(username)
+            if target_user_id:
+                target_user_data = await db.get_user(target_user_id)
         else:
             # Пробуем как ID без @
             try:
@@ -1519,28 +1532,12 @@ async def manual_credit_confirm_handler(callback: CallbackQuery, state: FSMConte
         return
     
     try:
-        # Начисляем запросы
-        success = await db.update_user_requests(
-            user_id=target_user_id,
-            premium_requests=requests_count
-        )
+        # Начисляем запросы и записываем платёж в payments одной транзакцией
+        payment_id = await db.credit_manual_payment(target_user_id, requests_count, user_id)
         
-        if not success:
+        if payment_id is None:
             raise Exception("Failed to update user requests")
         
-        # Записываем в таблицу payments
-        with get_sqlite_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO payments (user_id, amount, requests, status, admin_id)
-                VALUES (?, ?, ?, 'manual', ?)
-                """,
-                (target_user_id, 0, requests_count, user_id)
-            )
-            payment_id = cursor.lastrowid
-            conn.commit()
-        
         # Уведомляем пользователя
         username_display = target_user_data.get('username', 'Без username')
         first_name = target_user_data.get('first_name', '')
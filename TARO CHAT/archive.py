@@ -0,0 +1,242 @@
+"""
+archive.py
+Помесячный архив старых записей history и user_activity в отдельных файлах SQLite.
+"""
+
+import logging
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+from config import ARCHIVE_DIR
+from storage import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Имя, под которым файл архива подключается к соединению
+ARCHIVE_SCHEMA: str = "archive"
+
+
+def archive_path(month: str) -> Path:
+    """
+    Файл архива за месяц (month в формате YYYY_MM).
+    """
+    return ARCHIVE_DIR / f"archive_{month}.db"
+
+
+def _attach(conn: sqlite3.Connection, month: str) -> None:
+    conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (str(archive_path(month)),))
+
+
+def _detach(conn: sqlite3.Connection) -> None:
+    conn.execute(f"DETACH DATABASE {ARCHIVE_SCHEMA}")
+
+
+def read_archive(conn: sqlite3.Connection, month: str, fn: Callable[[sqlite3.Connection], T], default: T) -> T:
+    """
+    Подключает архив месяца к соединению, выполняет fn(conn) и отключает архив.
+    Вызывается внутри функций, переданных в SQLitePool.read().
+    """
+    if not archive_path(month).exists():
+        return default
+    _attach(conn, month)
+    try:
+        return fn(conn)
+    finally:
+        _detach(conn)
+
+
+def _create_archive_schema(conn: sqlite3.Connection) -> None:
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.history (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            question TEXT,
+            cards TEXT,
+            response TEXT,
+            reading_type TEXT,
+            is_premium BOOLEAN,
+            timestamp TEXT
+        )
+    """)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.history_responses (
+            history_id INTEGER PRIMARY KEY,
+            dictionary INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )
+    """)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.user_activity (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            activity_type TEXT,
+            details TEXT,
+            timestamp TEXT
+        )
+    """)
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_history_user_id_id ON history(user_id, id DESC)"
+    )
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_user_activity_user_id ON user_activity(user_id, timestamp)"
+    )
+
+
+def _placeholders(ids: List[int]) -> str:
+    return ",".join("?" * len(ids))
+
+
+async def _move_batch(pool: SQLitePool, table: str, month: str, ids: List[int]) -> None:
+    """
+    Переносит строки ids таблицы table в архив месяца.
+
+    Транзакции по нескольким подключённым базам в режиме WAL не атомарны,
+    поэтому перенос идёт в два шага: копирование в архив (INSERT OR IGNORE,
+    повтор безопасен) и удаление из основной базы с обновлением учёта.
+    При сбое между шагами следующий запуск повторит перенос без потерь.
+    """
+    marks = _placeholders(ids)
+
+    def copy(conn: sqlite3.Connection) -> None:
+        if table == "history":
+            conn.execute(
+                f"""
+                INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.history
+                    (id, user_id, question, cards, response, reading_type, is_premium, timestamp)
+                SELECT id, user_id, question, cards, response, reading_type, is_premium, timestamp
+                FROM main.history WHERE id IN ({marks})
+                """,
+                ids
+            )
+            conn.execute(
+                f"""
+                INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.history_responses (history_id, dictionary, body)
+                SELECT history_id, dictionary, body
+                FROM main.history_responses WHERE history_id IN ({marks})
+                """,
+                ids
+            )
+        else:
+            conn.execute(
+                f"""
+                INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.user_activity (id, user_id, activity_type, details, timestamp)
+                SELECT id, user_id, activity_type, details, timestamp
+                FROM main.user_activity WHERE id IN ({marks})
+                """,
+                ids
+            )
+
+    def remove(conn: sqlite3.Connection) -> None:
+        if table == "history":
+            # Учёт по пользователям: по нему чтение находит нужные месяцы архива
+            conn.execute(
+                f"""
+                INSERT INTO history_archive_index (user_id, month, readings, min_id, max_id)
+                SELECT user_id, ?, COUNT(*), MIN(id), MAX(id)
+                FROM main.history WHERE id IN ({marks}) AND user_id IS NOT NULL
+                GROUP BY user_id
+                ON CONFLICT(user_id, month) DO UPDATE SET
+                    readings = readings + excluded.readings,
+                    min_id = MIN(min_id, excluded.min_id),
+                    max_id = MAX(max_id, excluded.max_id)
+                """,
+                [month, *ids]
+            )
+            conn.execute(
+                """
+                INSERT INTO archive_months (month, min_history_id, max_history_id, history_rows)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(month) DO UPDATE SET
+                    min_history_id = MIN(COALESCE(min_history_id, excluded.min_history_id), excluded.min_history_id),
+                    max_history_id = MAX(COALESCE(max_history_id, excluded.max_history_id), excluded.max_history_id),
+                    history_rows = history_rows + excluded.history_rows
+                """,
+                (month, min(ids), max(ids), len(ids))
+            )
+            conn.execute(f"DELETE FROM main.history_responses WHERE history_id IN ({marks})", ids)
+            conn.execute(f"DELETE FROM main.history WHERE id IN ({marks})", ids)
+        else:
+            conn.execute(
+                """
+                INSERT INTO archive_months (month, activity_rows) VALUES (?, ?)
+                ON CONFLICT(month) DO UPDATE SET activity_rows = activity_rows + excluded.activity_rows
+                """,
+                (month, len(ids))
+            )
+            conn.execute(f"DELETE FROM main.user_activity WHERE id IN ({marks})", ids)
+
+    await pool.write(copy)
+    await pool.write(remove)
+
+
+async def archive_old_rows(pool: SQLitePool, cutoff: str, batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Переносит строки history и user_activity старше cutoff в помесячные архивы.
+
+    Каждая пачка — отдельные короткие транзакции, так что запись в основную
+    базу между пачками не блокируется.
+
+    Args:
+        cutoff: граница в формате CURRENT_TIMESTAMP ('YYYY-MM-DD HH:MM:SS', UTC)
+
+    Returns:
+        {"history": перенесено строк, "user_activity": перенесено строк}
+    """
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    moved = {"history": 0, "user_activity": 0}
+
+    for table in moved:
+        def select_batch(conn: sqlite3.Connection) -> List[Tuple[int, str]]:
+            return conn.execute(
+                f"""
+                SELECT id, strftime('%Y_%m', timestamp) FROM {table}
+                WHERE timestamp < ?
+                ORDER BY timestamp
+                LIMIT ?
+                """,
+                (cutoff, batch_size)
+            ).fetchall()
+
+        while True:
+            rows = await pool.read(select_batch)
+            if not rows:
+                break
+
+            by_month: Dict[str, List[int]] = defaultdict(list)
+            for row_id, month in rows:
+                by_month[month].append(row_id)
+
+            for month, ids in by_month.items():
+                # ATTACH/DETACH вне транзакции, на соединении писателя
+                await pool.write(lambda conn: _attach(conn, month))
+                try:
+                    await pool.write(_create_archive_schema)
+                    await _move_batch(pool, table, month, ids)
+                finally:
+                    await pool.write(_detach)
+                moved[table] += len(ids)
+
+    if moved["history"] or moved["user_activity"]:
+        logger.info(
+            f"🗄️ Archived {moved['history']} history and {moved['user_activity']} activity rows older than {cutoff}"
+        )
+    return moved
+
+
+def archive_months_for_user(conn: sqlite3.Connection, user_id: int) -> List[Dict[str, Any]]:
+    """
+    Месяцы архива с раскладами пользователя, от новых к старым.
+    """
+    rows = conn.execute(
+        """
+        SELECT month, readings, min_id, max_id FROM history_archive_index
+        WHERE user_id = ?
+        ORDER BY max_id DESC
+        """,
+        (user_id,)
+    ).fetchall()
+    return [dict(row) for row in rows]
@@ -0,0 +1,116 @@
+"""
+audience.py
+Сегменты аудитории рассылок: условия на таблицу users, которые можно комбинировать.
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class Segment:
+    """
+    Условие отбора пользователей (фрагмент WHERE по users u) с параметрами.
+
+    Сегменты объединяются через & (и) и | (или), ~ — отрицание:
+        Segment.active(7) & ~Segment.paid()
+
+    Забаненные и недоступные чаты исключаются всегда (см. Database.iter_audience),
+    поэтому сегмент описывает только дополнительные условия.
+    """
+
+    def __init__(self, sql: str = "1", params: Tuple[Any, ...] = (), name: str = "все") -> None:
+        self.sql: str = sql
+        self.params: Tuple[Any, ...] = tuple(params)
+        self.name: str = name
+
+    def __and__(self, other: "Segment") -> "Segment":
+        return Segment(f"({self.sql}) AND ({other.sql})", self.params + other.params, f"{self.name} и {other.name}")
+
+    def __or__(self, other: "Segment") -> "Segment":
+        return Segment(f"({self.sql}) OR ({other.sql})", self.params + other.params, f"{self.name} или {other.name}")
+
+    def __invert__(self) -> "Segment":
+        return Segment(f"NOT ({self.sql})", self.params, f"не {self.name}")
+
+    def __repr__(self) -> str:
+        return f"Segment({self.name!r})"
+
+    @classmethod
+    def everyone(cls) -> "Segment":
+        return cls()
+
+    @classmethod
+    def active(cls, days: int) -> "Segment":
+        """
+        Активные за последние days дней (по индексу idx_users_last_activity).
+        Граница вычисляется один раз, чтобы все пачки рассылки видели одну аудиторию.
+        """
+        since = (datetime.utcnow() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        return cls("u.last_activity >= ?", (since,), f"активные за {days} дн.")
+
+    @classmethod
+    def premium_balance(cls) -> "Segment":
+        """
+        Есть неизрасходованные премиум-запросы.
+        """
+        return cls("u.premium_requests > 0", (), "с премиум-запросами")
+
+    @classmethod
+    def paid(cls) -> "Segment":
+        """
+        Хотя бы один подтверждённый платёж (по индексу idx_payments_user_status).
+        """
+        return cls(
+            "EXISTS (SELECT 1 FROM payments p WHERE p.user_id = u.user_id AND p.status = 'confirmed')",
+            (),
+            "платившие"
+        )
+
+    @classmethod
+    def never_paid(cls) -> "Segment":
+        return ~cls.paid()
+
+    @classmethod
+    def referred(cls, referrer_id: Optional[int] = None) -> "Segment":
+        """
+        Пришли по реферальной ссылке (любой или конкретного пользователя).
+        """
+        if referrer_id is None:
+            return cls("u.referral_id IS NOT NULL", (), "приглашённые")
+        return cls("u.referral_id = ?", (referrer_id,), f"приглашённые {referrer_id}")
+
+
+def audience_query(segment: Segment, after_id: int, limit: int) -> Tuple[str, List[Any]]:
+    """
+    Следующая пачка ID аудитории после after_id (keyset-пагинация по user_id).
+    """
+    sql = f"""
+        SELECT u.user_id FROM users u
+        WHERE u.user_id > ? AND u.is_banned = FALSE AND u.delivery_status IS NULL
+          AND ({segment.sql})
+        ORDER BY u.user_id
+        LIMIT ?
+    """
+    return sql, [after_id, *segment.params, limit]
+
+
+def audience_count_query(segment: Segment) -> Tuple[str, List[Any]]:
+    """
+    Размер аудитории сегмента.
+    """
+    sql = f"""
+        SELECT COUNT(*) FROM users u
+        WHERE u.is_banned = FALSE AND u.delivery_status IS NULL
+          AND ({segment.sql})
+    """
+    return sql, list(segment.params)
+
+
+# Сегменты, которые администратор выбирает для рассылки: ключ -> (кнопка, сегмент)
+BROADCAST_SEGMENTS: Dict[str, Tuple[str, Callable[[], Segment]]] = {
+    "all": ("👥 Все", Segment.everyone),
+    "active": ("🔥 Активные 7 дней", lambda: Segment.active(7)),
+    "premium": ("💎 С премиум-запросами", Segment.premium_balance),
+    "never_paid": ("🆕 Не платившие", Segment.never_paid),
+    "referred": ("🤝 Приглашённые", Segment.referred),
+}
@@ -0,0 +1,225 @@
+"""
+backup.py
+Онлайн-бэкапы SQLite через backup API: пошагово, со сжатием и ротацией.
+"""
+
+import asyncio
+import gzip
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from config import (
+    DB_PATH, BACKUP_DIR, BACKUP_PAGES_PER_STEP,
+    BACKUP_KEEP_HOURLY, BACKUP_KEEP_DAILY, BACKUP_KEEP_WEEKLY
+)
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PREFIX: str = "tarot_bot_backup_"
+BACKUP_SUFFIX: str = ".db.gz"
+BACKUP_TIME_FORMAT: str = "%Y%m%d_%H%M%S"
+
+# Размер блока при сжатии
+COMPRESS_CHUNK_SIZE: int = 1024 * 1024
+
+
+class BackupManager:
+    """
+    Создание и ротация бэкапов базы данных.
+
+    Копирование идёт через sqlite3.Connection.backup по pages_per_step
+    страниц за шаг в отдельном потоке, поэтому копия согласована даже при
+    параллельной записи и не блокирует event loop. Затем копия сжимается
+    gzip, временный файл удаляется, и применяется ротация:
+    keep_hourly последних бэкапов, последний за каждый из keep_daily дней
+    и последний за каждую из keep_weekly недель.
+
+    progress во время работы содержит {"stage", "copied", "total"}.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        backup_dir: Path,
+        pages_per_step: int = 4096,
+        step_pause: float = 0.005,
+        keep_hourly: int = 24,
+        keep_daily: int = 7,
+        keep_weekly: int = 4
+    ) -> None:
+        self.db_path: Path = Path(db_path)
+        self.backup_dir: Path = Path(backup_dir)
+        self.pages_per_step: int = pages_per_step
+        self.step_pause: float = step_pause
+        self.keep_hourly: int = keep_hourly
+        self.keep_daily: int = keep_daily
+        self.keep_weekly: int = keep_weekly
+        self.progress: Optional[Dict[str, Any]] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def in_progress(self) -> bool:
+        return self._lock.locked()
+
+    async def create_backup(self) -> Dict[str, Any]:
+        """
+        Создаёт сжатый бэкап и применяет ротацию.
+        Параллельные вызовы выполняются по очереди.
+
+        Returns:
+            {"path", "raw_size", "compressed_size", "duration", "throughput_mb_s", "removed"}
+        """
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(None, self._create_backup_sync)
+            finally:
+                self.progress = None
+
+        logger.info(
+            f"💾 Backup {result['path'].name}: {result['raw_size'] // 1024} KB -> "
+            f"{result['compressed_size'] // 1024} KB in {result['duration']:.1f}s "
+            f"({result['throughput_mb_s']:.1f} MB/s), rotated out {len(result['removed'])}"
+        )
+        return result
+
+    def _create_backup_sync(self) -> Dict[str, Any]:
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        started = time.monotonic()
+        created_at = datetime.now()
+        name = f"{BACKUP_PREFIX}{created_at.strftime(BACKUP_TIME_FORMAT)}"
+        raw_path = self.backup_dir / f"{name}.db.tmp"
+        gz_path = self.backup_dir / f"{name}{BACKUP_SUFFIX}"
+
+        try:
+            self._copy_database(raw_path)
+            raw_size = raw_path.stat().st_size
+
+            self.progress = {"stage": "compress", "copied": 0, "total": raw_size}
+            with open(raw_path, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+                while True:
+                    chunk = src.read(COMPRESS_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    self.progress["copied"] += len(chunk)
+        except BaseException:
+            gz_path.unlink(missing_ok=True)
+            raise
+        finally:
+            raw_path.unlink(missing_ok=True)
+
+        duration = time.monotonic() - started
+        removed = self.rotate()
+        return {
+            "path": gz_path,
+            "raw_size": raw_size,
+            "compressed_size": gz_path.stat().st_size,
+            "duration": duration,
+            "throughput_mb_s": raw_size / 1024 / 1024 / duration if duration > 0 else 0.0,
+            "removed": removed,
+        }
+
+    def _copy_database(self, target_path: Path) -> None:
+        """
+        Копирует базу через backup API порциями по pages_per_step страниц.
+        """
+        self.progress = {"stage": "copy", "copied": 0, "total": 0}
+
+        def on_progress(status: int, remaining: int, total: int) -> None:
+            self.progress = {"stage": "copy", "copied": total - remaining, "total": total}
+            # Между шагами источник свободен для писателей
+            if remaining and self.step_pause:
+                time.sleep(self.step_pause)
+
+        source = sqlite3.connect(str(self.db_path))
+        target = sqlite3.connect(str(target_path))
+        try:
+            # Держим один снимок (read-транзакцию в WAL) на все шаги: запись других
+            # соединений не перезапускает копирование и не блокируется им
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            source.backup(target, pages=self.pages_per_step, progress=on_progress)
+        finally:
+            if source.in_transaction:
+                source.rollback()
+            target.close()
+            source.close()
+
+    def list_backups(self) -> List[Path]:
+        """
+        Возвращает бэкапы от новых к старым.
+        """
+        if not self.backup_dir.exists():
+            return []
+        return sorted(
+            self.backup_dir.glob(f"{BACKUP_PREFIX}*{BACKUP_SUFFIX}"),
+            key=lambda path: path.name,
+            reverse=True
+        )
+
+    @staticmethod
+    def _backup_time(path: Path) -> Optional[datetime]:
+        stamp = path.name[len(BACKUP_PREFIX):-len(BACKUP_SUFFIX)]
+        try:
+            return datetime.strptime(stamp, BACKUP_TIME_FORMAT)
+        except ValueError:
+            return None
+
+    def rotate(self) -> List[Path]:
+        """
+        Удаляет бэкапы, не попадающие ни в один уровень ротации.
+
+        Returns:
+            Удалённые файлы
+        """
+        backups = [(path, self._backup_time(path)) for path in self.list_backups()]
+        backups = [(path, created) for path, created in backups if created is not None]
+
+        keep: Set[Path] = {path for path, _ in backups[:self.keep_hourly]}
+        days: Set[Any] = set()
+        weeks: Set[Any] = set()
+        for path, created in backups:
+            # Список отсортирован от новых к старым: первый за период — последний бэкап периода
+            day = created.date()
+            if day not in days and len(days) < self.keep_daily:
+                days.add(day)
+                keep.add(path)
+            week = created.isocalendar()[:2]
+            if week not in weeks and len(weeks) < self.keep_weekly:
+                weeks.add(week)
+                keep.add(path)
+
+        removed = []
+        for path, _ in backups:
+            if path not in keep:
+                try:
+                    path.unlink()
+                    removed.append(path)
+                except OSError as e:
+                    logger.warning(f"⚠️ Could not remove old backup {path.name}: {e}")
+        return removed
+
+
+def format_size(size: int) -> str:
+    """
+    Размер файла для сообщений («12 МБ», «340 КБ»).
+    """
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f} МБ"
+    return f"{size // 1024} КБ"
+
+
+# Глобальный экземпляр
+backup_manager = BackupManager(
+    DB_PATH,
+    BACKUP_DIR,
+    pages_per_step=BACKUP_PAGES_PER_STEP,
+    keep_hourly=BACKUP_KEEP_HOURLY,
+    keep_daily=BACKUP_KEEP_DAILY,
+    keep_weekly=BACKUP_KEEP_WEEKLY
+)
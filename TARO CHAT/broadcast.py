@@ -0,0 +1,279 @@
+"""
+broadcast.py
+Массовая отправка сообщений с учётом лимитов Telegram.
+"""
+
+import asyncio
+import logging
+import time
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Generic,
+    Iterable, Optional, TypeVar, Union
+)
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from config import (
+    NOTIFY_RATE_PER_SECOND, NOTIFY_CONCURRENCY, NOTIFY_PER_CHAT_INTERVAL, NOTIFY_MAX_RETRIES
+)
+from database import db
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Статусы недоступных получателей (users.delivery_status)
+DELIVERY_BLOCKED: str = "blocked"
+DELIVERY_NOT_FOUND: str = "not_found"
+
+# Ответы Telegram, после которых писать в чат бессмысленно
+NOT_FOUND_ERRORS = ("chat not found", "user is deactivated", "bot can't initiate conversation")
+
+# Недоступные получатели записываются в базу пачками такого размера
+DEAD_FLUSH_SIZE: int = 100
+
+
+def undeliverable_status(error: Exception) -> Optional[str]:
+    """
+    Статус получателя по ошибке отправки или None, если ошибка временная.
+    """
+    if isinstance(error, TelegramForbiddenError):
+        return DELIVERY_BLOCKED
+    if isinstance(error, TelegramBadRequest):
+        message = str(error).lower()
+        if any(text in message for text in NOT_FOUND_ERRORS):
+            return DELIVERY_NOT_FOUND
+    return None
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости: rate токенов в секунду, не больше capacity в запасе.
+    pause() останавливает выдачу токенов всем ожидающим (после retry_after).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate: float = rate
+        self.capacity: float = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens: float = self.capacity
+        self._updated: float = time.monotonic()
+        self._paused_until: float = 0.0
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Не выдавать токены seconds секунд.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        """
+        Ждёт, пока не появится токен, и забирает его.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                # Во время паузы токены не копятся
+                self._updated = max(self._updated, self._paused_until)
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatPacer:
+    """
+    Не чаще одного сообщения в interval секунд в один чат.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval: float = interval
+        self._next_at: Dict[int, float] = {}
+
+    async def wait(self, chat_id: int) -> None:
+        now = time.monotonic()
+        next_at = self._next_at.get(chat_id, 0.0)
+        self._next_at[chat_id] = max(now, next_at) + self.interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+
+        # Забываем чаты, в которые давно не писали
+        if len(self._next_at) > 10000:
+            self._next_at = {chat: at for chat, at in self._next_at.items() if at > now}
+
+
+class Broadcast(Generic[T]):
+    """
+    Рассылка: concurrency обработчиков берут получателей из общего источника,
+    каждая отправка ждёт токен общего лимита и очередь своего чата.
+
+    При TelegramRetryAfter общий лимит ставится на паузу на retry_after
+    секунд, а сообщение отправляется повторно (до max_retries раз).
+    TelegramForbiddenError (бот заблокирован) считается в blocked,
+    «chat not found» / удалённый аккаунт — в not_found; такие чаты
+    передаются пачками в dead_sink, чтобы следующие рассылки их пропускали.
+
+    Пока идёт run(), счётчики sent / failed / blocked / not_found / retries
+    можно читать для отображения прогресса.
+    """
+
+    def __init__(
+        self,
+        limiter: TokenBucket,
+        pacer: ChatPacer,
+        concurrency: int = NOTIFY_CONCURRENCY,
+        max_retries: int = NOTIFY_MAX_RETRIES,
+        dead_sink: Optional[Callable[[Dict[int, str]], Awaitable[Any]]] = None
+    ) -> None:
+        self.limiter: TokenBucket = limiter
+        self.pacer: ChatPacer = pacer
+        self.concurrency: int = max(concurrency, 1)
+        self.max_retries: int = max_retries
+        self.dead_sink: Optional[Callable[[Dict[int, str]], Awaitable[Any]]] = dead_sink
+        self.dead: Dict[int, str] = {}
+        self.total: Optional[int] = None
+        self.sent: int = 0
+        self.failed: int = 0
+        self.blocked: int = 0
+        self.not_found: int = 0
+        self.retries: int = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked + self.not_found
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    async def run(
+        self,
+        recipients: Union[Iterable[T], AsyncIterable[T]],
+        send: Callable[[T], Awaitable[Any]],
+        chat_id: Callable[[T], int] = lambda recipient: recipient,
+        total: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Отправляет send(recipient) всем получателям.
+
+        Args:
+            recipients: получатели (список, генератор или асинхронный курсор)
+            chat_id: как получить ID чата из получателя
+            total: сколько получателей ожидается (для прогресса)
+
+        Returns:
+            Отчёт о доставке (см. report())
+        """
+        self.total = total if total is not None else (len(recipients) if hasattr(recipients, "__len__") else None)
+        self.started_at = time.monotonic()
+        source = _aiter(recipients)
+        source_lock = asyncio.Lock()
+
+        async def worker() -> None:
+            while True:
+                async with source_lock:
+                    try:
+                        recipient = await source.__anext__()
+                    except StopAsyncIteration:
+                        return
+                await self._deliver(recipient, send, chat_id(recipient))
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        finally:
+            self.finished_at = time.monotonic()
+            await self._flush_dead()
+
+        report = self.report()
+        logger.info(
+            f"📬 Broadcast finished: {report['sent']} sent, {report['failed']} failed, "
+            f"{report['blocked']} blocked, {report['not_found']} not found, "
+            f"{report['retries']} retries in {report['duration']:.1f}s"
+        )
+        return report
+
+    async def _deliver(self, recipient: T, send: Callable[[T], Awaitable[Any]], chat: int) -> None:
+        for _ in range(self.max_retries + 1):
+            await self.pacer.wait(chat)
+            await self.limiter.acquire()
+            try:
+                await send(recipient)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Флуд-контроль общий для бота: притормаживаем всех
+                self.retries += 1
+                self.limiter.pause(e.retry_after)
+                logger.warning(f"⚠️ Telegram flood control: pausing broadcast for {e.retry_after}s")
+            except Exception as e:
+                status = undeliverable_status(e)
+                if status is None:
+                    self.failed += 1
+                    logger.debug(f"Failed to deliver message to {chat}: {e}")
+                    return
+                if status == DELIVERY_BLOCKED:
+                    self.blocked += 1
+                else:
+                    self.not_found += 1
+                self.dead[chat] = status
+                if len(self.dead) >= DEAD_FLUSH_SIZE:
+                    await self._flush_dead()
+                return
+        self.failed += 1
+
+    async def _flush_dead(self) -> None:
+        if not self.dead or self.dead_sink is None:
+            return
+        dead, self.dead = self.dead, {}
+        try:
+            await self.dead_sink(dead)
+        except Exception as e:
+            logger.error(f"⚠️ Error saving undeliverable recipients: {e}")
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Итоги рассылки: total, sent, failed, blocked, not_found, retries, duration, rate.
+        """
+        duration = self.elapsed
+        return {
+            "total": self.total if self.total is not None else self.processed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "not_found": self.not_found,
+            "retries": self.retries,
+            "duration": duration,
+            "rate": self.sent / duration if duration > 0 else 0.0,
+        }
+
+
+async def _aiter(items: Union[Iterable[T], AsyncIterable[T]]) -> AsyncIterator[T]:
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def new_broadcast(concurrency: int = NOTIFY_CONCURRENCY) -> Broadcast:
+    """
+    Рассылка с общими для всего бота лимитами; недоступные чаты
+    отмечаются в базе и исключаются из следующих рассылок.
+    """
+    return Broadcast(notify_limiter, chat_pacer, concurrency=concurrency, dead_sink=db.mark_undeliverable)
+
+
+# Глобальные экземпляры: общие лимиты для всех массовых отправок бота
+notify_limiter = TokenBucket(NOTIFY_RATE_PER_SECOND)
+chat_pacer = ChatPacer(NOTIFY_PER_CHAT_INTERVAL)
@@ -0,0 +1,82 @@
+"""
+cache.py
+Кэш в памяти процесса с ограничением по размеру и времени жизни записей.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class TTLCache:
+    """
+    LRU-кэш с TTL и счётчиками попаданий/промахов.
+
+    generation увеличивается при каждой инвалидации. Читатель запоминает её
+    до запроса к базе и передаёт в set(): если за время запроса данные были
+    инвалидированы, устаревший результат в кэш не попадёт.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.generation: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает значение или None, если записи нет или она устарела.
+        """
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        """
+        Сохраняет значение.
+
+        Args:
+            generation: значение self.generation на момент начала чтения из базы
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """
+        Удаляет записи по ключам.
+        """
+        self.generation += 1
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Удаляет все записи.
+        """
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Возвращает размер кэша и счётчики попаданий/промахов.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total * 100, 1) if total else 0.0,
+        }
@@ -0,0 +1,67 @@
+"""
+compression.py
+Сжатие текстов раскладов zlib с предустановленным словарём.
+"""
+
+import zlib
+from typing import Dict, Tuple
+
+# Уровень сжатия zlib (ответы пишутся один раз, читаются редко)
+COMPRESSION_LEVEL: int = 9
+
+# Словари сжатия по версиям. Словарь нельзя менять после того, как им сжаты
+# данные: для новых заголовков добавляется новая версия. Версия 0 — без словаря.
+# zlib лучше всего использует строки из конца словаря, поэтому самые частые
+# фрагменты (заголовки разделов из системного промпта) идут последними.
+RESPONSE_DICTIONARIES: Dict[int, bytes] = {
+    0: b"",
+    1: (
+        "Старшие Арканы Младшие Арканы Кубков Мечей Жезлов Пентаклей "
+        "Туз Двойка Тройка Четвёрка Пятёрка Шестёрка Семёрка Восьмёрка Девятка Десятка "
+        "Паж Рыцарь Королева Король Шут Маг Верховная Жрица Императрица Император "
+        "Иерофант Влюблённые Колесница Сила Отшельник Колесо Фортуны Справедливость "
+        "Повешенный Смерть Умеренность Дьявол Башня Звезда Луна Солнце Суд Мир "
+        "в перевёрнутом положении прямом положении "
+        "Относительно твоего вопроса о В контексте твоего вопроса "
+        "это значит для тебя, что карты говорят о том, что "
+        "• Название: → Как это относится к твоему вопросу → Что это значит для твоей ситуации "
+        "→ Личное прозрение: \n\n"
+        "💎 ЭКСКЛЮЗИВ ДЛЯ ТЕБЯ\n"
+        "💫 ЭНЕРГЕТИКА ВОПРОСА\n"
+        "🌀 ДИАЛОГ КАРТ\n"
+        "🌟 ЧТО СКРЫВАЕТСЯ ЗА КАРТАМИ\n"
+        "🎯 ПРЯМОЙ ОТВЕТ\n"
+        "📝 ПРАКТИЧЕСКИЕ ШАГИ\n"
+        "💖 ПОДДЕРЖКА И ВЕРА\n"
+        "🌙 НАПУТСТВИЕ ОТ ЛУНЫ\n"
+        "🃏 КАРТЫ ГОВОРЯТ\n"
+        "✨ ОТКРОВЕНИЕ КАРТ\n"
+    ).encode("utf-8"),
+}
+
+# Версия словаря для новых записей
+CURRENT_DICTIONARY: int = 1
+
+
+def compress_text(text: str, dictionary: int = CURRENT_DICTIONARY) -> Tuple[int, bytes]:
+    """
+    Сжимает текст.
+
+    Returns:
+        (версия словаря, сжатые данные) — версию нужно хранить рядом с данными
+    """
+    zdict = RESPONSE_DICTIONARIES[dictionary]
+    if zdict:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    return dictionary, compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+
+def decompress_text(dictionary: int, data: bytes) -> str:
+    """
+    Распаковывает текст, сжатый compress_text().
+    """
+    zdict = RESPONSE_DICTIONARIES[dictionary]
+    decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
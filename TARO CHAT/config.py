@@ -3,6 +3,7 @@ config.py
 Обновлён для работы с OhMyGPT API, ЮMoney и улучшенной конфигурацией.
 """
 
+import math
 import os
 from pathlib import Path
 from dotenv import load_dotenv
@@ -27,6 +28,51 @@ OHMYGPT_API_URL: str = "https://api.ohmygpt.com/v1/chat/completions"
 OHMYGPT_MODEL: str = "gpt-4o-mini"  # Более быстрая и дешевая модель
 OHMYGPT_FALLBACK_MODELS: list = ["TA/deepseek-ai/DeepSeek-R1-Distill-Llama-70B-free", "glm-4.5-flash", "glm-4-flash"]
 
+# Общий HTTP-клиент OhMyGPT: HTTP/2 (нужен пакет h2), пул соединений и таймауты (секунды)
+OHMYGPT_HTTP2: bool = os.getenv("OHMYGPT_HTTP2", "true").lower() in ("1", "true", "yes")
+OHMYGPT_MAX_CONNECTIONS: int = int(os.getenv("OHMYGPT_MAX_CONNECTIONS", "20"))
+OHMYGPT_MAX_KEEPALIVE: int = int(os.getenv("OHMYGPT_MAX_KEEPALIVE", "10"))
+OHMYGPT_KEEPALIVE_EXPIRY: float = float(os.getenv("OHMYGPT_KEEPALIVE_EXPIRY", "120"))
+OHMYGPT_CONNECT_TIMEOUT: float = float(os.getenv("OHMYGPT_CONNECT_TIMEOUT", "10"))
+OHMYGPT_READ_TIMEOUT: float = float(os.getenv("OHMYGPT_READ_TIMEOUT", "60"))
+OHMYGPT_POOL_TIMEOUT: float = float(os.getenv("OHMYGPT_POOL_TIMEOUT", "10"))
+# Попыток на один расклад (с переключением на другие модели)
+OHMYGPT_MAX_RETRIES: int = int(os.getenv("OHMYGPT_MAX_RETRIES", "3"))
+
+# Выбор модели: окно последних результатов, минимум результатов для оценки,
+# доля ошибок или неудач подряд, после которых модель выключается, на сколько
+# секунд (срок удваивается при неудачной пробе) и доля запросов на пробу
+ROUTER_WINDOW: int = int(os.getenv("ROUTER_WINDOW", "50"))
+ROUTER_MIN_SAMPLES: int = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_ERROR_THRESHOLD: float = float(os.getenv("ROUTER_ERROR_THRESHOLD", "0.5"))
+ROUTER_CONSECUTIVE_FAILURES: int = int(os.getenv("ROUTER_CONSECUTIVE_FAILURES", "3"))
+ROUTER_OPEN_SECONDS: float = float(os.getenv("ROUTER_OPEN_SECONDS", "30"))
+ROUTER_MAX_OPEN_SECONDS: float = float(os.getenv("ROUTER_MAX_OPEN_SECONDS", "600"))
+ROUTER_PROBE_SHARE: float = float(os.getenv("ROUTER_PROBE_SHARE", "0.1"))
+
+# Хеджирование: если модель не ответила (первый фрагмент) за HEDGE_PERCENTILE
+# недавних задержек (но не раньше HEDGE_MIN_DELAY секунд), запрос дублируется
+# в следующую модель. Дубли — не больше HEDGE_BUDGET доли запросов
+# за последние HEDGE_BUDGET_WINDOW_SECONDS секунд
+HEDGE_ENABLED: bool = os.getenv("HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE: float = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_DELAY: float = float(os.getenv("HEDGE_MIN_DELAY", "3"))
+HEDGE_BUDGET: float = float(os.getenv("HEDGE_BUDGET", "0.05"))
+HEDGE_BUDGET_WINDOW_SECONDS: float = float(os.getenv("HEDGE_BUDGET_WINDOW_SECONDS", "600"))
+
+# Потоковый ответ: текст расклада появляется по мере генерации. Сообщение
+# редактируется не чаще раза в STREAM_EDIT_INTERVAL секунд, при
+# STREAM_MESSAGE_LIMIT символах продолжение уходит новым сообщением
+OHMYGPT_STREAMING: bool = os.getenv("OHMYGPT_STREAMING", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_MESSAGE_LIMIT: int = int(os.getenv("STREAM_MESSAGE_LIMIT", "3800"))
+
+# Очередь запросов к ИИ: одновременных запросов, максимум ожидающих и как часто
+# (секунды) обновлять ожидающему его место в очереди
+LLM_CONCURRENCY: int = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_QUEUE_MAX_SIZE: int = int(os.getenv("LLM_QUEUE_MAX_SIZE", "200"))
+LLM_QUEUE_POSITION_INTERVAL: float = float(os.getenv("LLM_QUEUE_POSITION_INTERVAL", "3"))
+
 # ЮMoney конфигурация
 YOOMONEY_CLIENT_ID: str = os.getenv("YOOMONEY_CLIENT_ID", "1A1C309BB6BC9FC0121B7588F653C0685C7753568C323BF75050C590EC0D1189")
 YOOMONEY_CLIENT_SECRET: str = os.getenv("YOOMONEY_CLIENT_SECRET", "FC937EAB4D2AF7BCE570B47921DC3B7A48ADA882A588C4C59A35EBB5B3D3ECA30872E5A86D5891445B18B1A31B1114695B061BBEB1E8B75F405F8F9F476F423E")
@@ -53,6 +99,78 @@ LOG_PATH: Path = project_root / "logs" / "bot.log"
 YOOMONEY_LOG_PATH: Path = project_root / "logs" / "yoomoney.log"
 LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+# Пул соединений SQLite: потоки-читатели (писатель всегда один)
+DB_READER_CONNECTIONS: int = int(os.getenv("DB_READER_CONNECTIONS", "4"))
+
+# Профиль SQLite, применяемый к каждому соединению пула
+DB_JOURNAL_MODE: str = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS: str = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB: int = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # 16 МБ страничного кэша на соединение
+DB_MMAP_SIZE: int = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))  # 128 МБ
+DB_CHECKPOINT_INTERVAL_MINUTES: int = int(os.getenv("DB_CHECKPOINT_INTERVAL_MINUTES", "15"))
+DB_CHECKPOINT_MODE: str = os.getenv("DB_CHECKPOINT_MODE", "PASSIVE")  # PASSIVE | FULL | RESTART | TRUNCATE
+
+# Отложенная запись журнала активности (user_activity)
+ACTIVITY_LOG_QUEUE_SIZE: int = int(os.getenv("ACTIVITY_LOG_QUEUE_SIZE", "10000"))
+ACTIVITY_LOG_BATCH_SIZE: int = int(os.getenv("ACTIVITY_LOG_BATCH_SIZE", "500"))
+ACTIVITY_LOG_FLUSH_MS: int = int(os.getenv("ACTIVITY_LOG_FLUSH_MS", "1000"))
+
+# Кэш данных пользователей в памяти процесса
+USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS: int = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+
+# Время жизни кэша сводной статистики админ-панели
+ADMIN_STATS_CACHE_TTL_SECONDS: int = int(os.getenv("ADMIN_STATS_CACHE_TTL_SECONDS", "60"))
+
+# Бэкапы базы данных (SQLite backup API + gzip, ротация по часам/дням/неделям)
+BACKUP_DIR: Path = Path(os.getenv("BACKUP_DIR", str(project_root / "backups")))
+BACKUP_INTERVAL_MINUTES: int = int(os.getenv("BACKUP_INTERVAL_MINUTES", "60"))
+BACKUP_PAGES_PER_STEP: int = int(os.getenv("BACKUP_PAGES_PER_STEP", "4096"))
+BACKUP_KEEP_HOURLY: int = int(os.getenv("BACKUP_KEEP_HOURLY", "24"))
+BACKUP_KEEP_DAILY: int = int(os.getenv("BACKUP_KEEP_DAILY", "7"))
+BACKUP_KEEP_WEEKLY: int = int(os.getenv("BACKUP_KEEP_WEEKLY", "4"))
+
+# Архивирование старых раскладов и журнала активности в помесячные файлы
+ARCHIVE_DIR: Path = Path(os.getenv("ARCHIVE_DIR", str(project_root / "archive")))
+ARCHIVE_AFTER_DAYS: int = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE: int = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+
+# Холды запросов на время расклада: через сколько минут незавершённый холд
+# возвращается пользователю и сколько дней хранятся закрытые записи журнала.
+# Холд берётся до очереди, поэтому по умолчанию таймаут — худший расклад
+# с запасом 50%: ждём полную очередь (LLM_QUEUE_MAX_SIZE / LLM_CONCURRENCY
+# волн) и свой расклад, каждый — OHMYGPT_MAX_RETRIES попыток до таймаутов
+LLM_READING_MAX_SECONDS: float = OHMYGPT_MAX_RETRIES * (
+    OHMYGPT_POOL_TIMEOUT + OHMYGPT_CONNECT_TIMEOUT + OHMYGPT_READ_TIMEOUT
+)
+_CREDIT_HOLD_WORST_CASE_SECONDS: float = (
+    math.ceil(LLM_QUEUE_MAX_SIZE / max(LLM_CONCURRENCY, 1)) + 1
+) * LLM_READING_MAX_SECONDS
+CREDIT_HOLD_TIMEOUT_MINUTES: int = int(os.getenv(
+    "CREDIT_HOLD_TIMEOUT_MINUTES",
+    str(math.ceil(_CREDIT_HOLD_WORST_CASE_SECONDS * 1.5 / 60))
+))
+CREDIT_LEDGER_RETENTION_DAYS: int = int(os.getenv("CREDIT_LEDGER_RETENTION_DAYS", "30"))
+
+# Ежедневное начисление бесплатных запросов: пачка пользователей на транзакцию
+FREE_REQUESTS_BATCH_SIZE: int = int(os.getenv("FREE_REQUESTS_BATCH_SIZE", "500"))
+
+# Аудитория рассылок читается из базы пачками по столько ID
+AUDIENCE_BATCH_SIZE: int = int(os.getenv("AUDIENCE_BATCH_SIZE", "1000"))
+
+# Массовые уведомления: сообщений в секунду (лимит Telegram ~30) и одновременных отправок
+NOTIFY_RATE_PER_SECOND: float = float(os.getenv("NOTIFY_RATE_PER_SECOND", "25"))
+NOTIFY_CONCURRENCY: int = int(os.getenv("NOTIFY_CONCURRENCY", "10"))
+# Не чаще одного сообщения в секунду в один чат; повторы после flood control (retry_after)
+NOTIFY_PER_CHAT_INTERVAL: float = float(os.getenv("NOTIFY_PER_CHAT_INTERVAL", "1.0"))
+NOTIFY_MAX_RETRIES: int = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+
+# Недоступные получатели (заблокировали бота / удалили аккаунт) повторно
+# проверяются через столько дней, не больше DELIVERY_REPROBE_BATCH за запуск
+DELIVERY_REPROBE_DAYS: int = int(os.getenv("DELIVERY_REPROBE_DAYS", "30"))
+DELIVERY_REPROBE_BATCH: int = int(os.getenv("DELIVERY_REPROBE_BATCH", "1000"))
+
 # Константы функционала бота
 TIMEZONE: str = "Europe/Moscow"
 DATETIME_FORMAT: str = "%Y-%m-%d %H:%M:%S"
@@ -79,23 +197,13 @@ PAYMENT_OPTIONS: dict = {
 
 def get_payment_options() -> dict:
     """
-    Получает тарифы из базы данных или возвращает значения по умолчанию.
+    Получает тарифы из памяти (загружаются из БД при старте бота)
+    или возвращает значения по умолчанию.
     """
     try:
-        import asyncio
         from database import db
-        
-        # Пытаемся получить из БД
-        rates = asyncio.run(db.get_all_rates())
-        
-        if rates:
-            options = {}
-            for rate in rates:
-                options[rate["package_key"]] = {
-                    "requests": rate["requests"],
-                    "price": rate["price"],
-                    "label": rate.get("label", f"{rate['requests']} запросов ({rate['price']} руб.)")
-                }
+        options = db.get_payment_options()
+        if options:
             return options
     except Exception:
         pass
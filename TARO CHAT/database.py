@@ -5,15 +5,52 @@ database.py
 
 import sqlite3
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from pytz import timezone
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from collections import OrderedDict
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 
-from config import DB_PATH, TIMEZONE
+from config import (
+    DB_PATH, DB_READER_CONNECTIONS, TIMEZONE,
+    DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT_MS,
+    DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_CHECKPOINT_MODE,
+    ACTIVITY_LOG_QUEUE_SIZE, ACTIVITY_LOG_BATCH_SIZE, ACTIVITY_LOG_FLUSH_MS,
+    USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS, ADMIN_STATS_CACHE_TTL_SECONDS,
+    ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE,
+    CREDIT_HOLD_TIMEOUT_MINUTES, CREDIT_LEDGER_RETENTION_DAYS, AUDIENCE_BATCH_SIZE
+)
+from achievements import PROGRESS_COUNTERS, achievement_progress, load_counters, unlock_achievements
+from activity_log import ActivityLogger
+from audience import Segment, audience_count_query, audience_query
+from archive import ARCHIVE_SCHEMA, archive_months_for_user, archive_old_rows, read_archive
+from cache import TTLCache
+from compression import compress_text, decompress_text
+from leaderboard import Leaderboard
+from storage import SQLitePool
+from migrations import run_migrations
 
 logger = logging.getLogger(__name__)
 
+# Сколько пользователей держать в кэше количества раскладов
+HISTORY_COUNT_CACHE_SIZE: int = 10000
+
+# Статистика реферальной программы пользователя без приглашённых
+EMPTY_REFERRAL_STATS: Dict[str, int] = {
+    "referrals_count": 0,
+    "total_bonuses": 0,
+    "active_referrals": 0,
+    "premium_referrals": 0,
+    "total_referral_readings": 0
+}
+
+# Имя задачи ежедневного начисления в job_checkpoints
+FREE_REQUESTS_JOB: str = "free_requests"
+
+# Колонки истории для списков (без текста ответа)
+HISTORY_LIST_COLUMNS: str = "id, user_id, question, cards, reading_type, is_premium, timestamp"
+HISTORY_PAGE_COLUMNS: str = "id, question, cards, reading_type, is_premium, timestamp"
+
 class Database:
     def __init__(self) -> None:
         """
@@ -21,245 +58,112 @@ class Database:
         """
         self.db_path: Path = Path(DB_PATH)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.pool: SQLitePool = SQLitePool(
+            self.db_path,
+            readers=DB_READER_CONNECTIONS,
+            pragmas={
+                # busy_timeout первым: остальные PRAGMA уже могут ждать блокировку
+                "busy_timeout": DB_BUSY_TIMEOUT_MS,
+                "journal_mode": DB_JOURNAL_MODE,
+                "synchronous": DB_SYNCHRONOUS,
+                "cache_size": -DB_CACHE_SIZE_KB,  # отрицательное значение — размер в КБ
+                "mmap_size": DB_MMAP_SIZE,
+            }
+        )
+        self._history_counts: OrderedDict = OrderedDict()
+        # Тарифы в памяти: package_key -> строка rates (по возрастанию requests)
+        self._rates: Optional[OrderedDict] = None
+        self.rates_version: int = 0
+        # Кэш строк пользователей: ключи ("user", user_id) и ("stats", user_id)
+        self.user_cache: TTLCache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+        # Сводная статистика для админ-панели
+        self._bot_stats_cache: TTLCache = TTLCache(1, ADMIN_STATS_CACHE_TTL_SECONDS)
+        # Рейтинг по количеству раскладов (загружается в load_leaderboard)
+        self.leaderboard: Leaderboard = Leaderboard()
+        self.activity_log: ActivityLogger = ActivityLogger(
+            self.pool,
+            max_queue=ACTIVITY_LOG_QUEUE_SIZE,
+            batch_size=ACTIVITY_LOG_BATCH_SIZE,
+            flush_interval_ms=ACTIVITY_LOG_FLUSH_MS
+        )
         self.init_db()
     
     def init_db(self) -> None:
         """
-        Инициализация структуры базы данных.
+        Инициализация структуры базы данных: применяет недостающие миграции.
+        Если схема актуальна, выполняется только проверка PRAGMA user_version.
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Таблица пользователей
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        last_name TEXT,
-                        requests_left INTEGER DEFAULT 3,
-                        premium_requests INTEGER DEFAULT 1,
-                        referral_id INTEGER,
-                        referrals_count INTEGER DEFAULT 0,
-                        last_free_request_time TEXT,
-                        is_banned BOOLEAN DEFAULT FALSE,
-                        ban_expires TEXT,
-                        forbidden_attempts INTEGER DEFAULT 0,
-                        agreed_rules BOOLEAN DEFAULT FALSE,
-                        last_activity TEXT DEFAULT CURRENT_TIMESTAMP,
-                        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Таблица истории
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        question TEXT,
-                        cards TEXT,
-                        response TEXT,
-                        reading_type TEXT DEFAULT 'classic',
-                        is_premium BOOLEAN DEFAULT FALSE,
-                        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Таблица платежей
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS payments (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        amount INTEGER,
-                        requests INTEGER,
-                        status TEXT DEFAULT 'pending',
-                        screenshot_id TEXT,
-                        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Таблица отзывов
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS feedback (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        feedback TEXT,
-                        rating INTEGER DEFAULT 5,
-                        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Таблица реферальных начислений
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS referral_rewards (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        referrer_id INTEGER,
-                        referred_id INTEGER,
-                        reward_type TEXT,
-                        amount INTEGER,
-                        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (referrer_id) REFERENCES users(user_id),
-                        FOREIGN KEY (referred_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Таблица достижений пользователей
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS user_achievements (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        achievement_name TEXT,
-                        achievement_emoji TEXT,
-                        description TEXT,
-                        unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id),
-                        UNIQUE(user_id, achievement_name)
-                    )
-                """)
-                
-                # Таблица уровней пользователей
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS user_levels (
-                        user_id INTEGER PRIMARY KEY,
-                        level INTEGER DEFAULT 1,
-                        experience INTEGER DEFAULT 0,
-                        total_readings INTEGER DEFAULT 0,
-                        premium_readings INTEGER DEFAULT 0,
-                        referrals_count INTEGER DEFAULT 0,
-                        last_level_up TEXT,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Таблица активности пользователей
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS user_activity (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        activity_type TEXT,
-                        details TEXT,
-                        timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Таблица статистики пользователей
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS user_stats (
-                        user_id INTEGER PRIMARY KEY,
-                        total_readings INTEGER DEFAULT 0,
-                        total_cards INTEGER DEFAULT 0,
-                        total_words INTEGER DEFAULT 0,
-                        favorite_reading_type TEXT,
-                        most_used_cards TEXT,
-                        reading_days_active INTEGER DEFAULT 0,
-                        last_7_days_active INTEGER DEFAULT 0,
-                        streak_days INTEGER DEFAULT 0,
-                        last_streak_date TEXT,
-                        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users(user_id)
-                    )
-                """)
-                
-                # Индексы для оптимизации запросов
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id ON history(user_id)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_reading_type ON history(reading_type)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referral_id ON users(referral_id)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_user_id ON feedback(user_id)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_user_id ON user_activity(user_id)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_achievements_user_id ON user_achievements(user_id)")
-                
-                # Таблица тарифов
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS rates (
-                        package_key TEXT PRIMARY KEY,
-                        requests INTEGER NOT NULL,
-                        price INTEGER NOT NULL,
-                        label TEXT,
-                        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Инициализация тарифов из config.PAYMENT_OPTIONS, если таблица пуста
-                cursor.execute("SELECT COUNT(*) FROM rates")
-                if cursor.fetchone()[0] == 0:
-                    from config import PAYMENT_OPTIONS
-                    for package_key, package_data in PAYMENT_OPTIONS.items():
-                        cursor.execute("""
-                            INSERT INTO rates (package_key, requests, price, label)
-                            VALUES (?, ?, ?, ?)
-                        """, (
-                            package_key,
-                            package_data["requests"],
-                            package_data["price"],
-                            package_data.get("label", f"{package_data['requests']} запросов ({package_data['price']} руб.)")
-                        ))
-                    logger.info("🔮 Initialized rates table with default values")
-
-                from config import PAYMENT_OPTIONS
-                for package_key, package_data in PAYMENT_OPTIONS.items():
-                    cursor.execute(
-                        "INSERT OR IGNORE INTO rates (package_key, requests, price, label) VALUES (?, ?, ?, ?)",
-                        (
-                            package_key,
-                            package_data["requests"],
-                            package_data["price"],
-                            package_data.get("label", f"{package_data['requests']} запросов ({package_data['price']} руб.)")
-                        )
-                    )
-                
-                # Миграция: добавляем колонки в payments, если их нет
-                try:
-                    cursor.execute("ALTER TABLE payments ADD COLUMN yoomoney_label TEXT")
-                except sqlite3.OperationalError:
-                    pass  # Колонка уже существует
-                
-                try:
-                    cursor.execute("ALTER TABLE payments ADD COLUMN admin_id INTEGER")
-                except sqlite3.OperationalError:
-                    pass  # Колонка уже существует
-
-                try:
-                    cursor.execute("ALTER TABLE payments ADD COLUMN yoomoney_operation_id TEXT")
-                except sqlite3.OperationalError:
-                    pass  # Колонка уже существует
-
-                try:
-                    cursor.execute("ALTER TABLE payments ADD COLUMN amount_received REAL")
-                except sqlite3.OperationalError:
-                    pass  # Колонка уже существует
-                
-                # Создаём уникальный индекс для yoomoney_label (только для не-NULL значений)
-                try:
-                    cursor.execute("""
-                        CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_yoomoney_label 
-                        ON payments(yoomoney_label) 
-                        WHERE yoomoney_label IS NOT NULL
-                    """)
-                except sqlite3.OperationalError:
-                    # Если не удалось создать уникальный индекс, создаём обычный
-                    try:
-                        cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_yoomoney_label ON payments(yoomoney_label)")
-                    except sqlite3.OperationalError:
-                        pass
-                
-                try:
-                    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_yoomoney_operation_id ON payments(yoomoney_operation_id)")
-                except sqlite3.OperationalError:
-                    pass
-                
-                conn.commit()
-                logger.info("🔮 Database initialized successfully with achievements support")
-                
+            version = run_migrations(self.pool)
+            logger.info(f"🔮 Database initialized successfully (schema version {version})")
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error initializing database: {e}")
+
+    def _invalidate_users(self, *user_ids: Optional[int]) -> None:
+        """
+        Сбрасывает кэшированные данные пользователей после изменения.
+        """
+        keys = []
+        for user_id in user_ids:
+            if user_id is not None:
+                keys.extend((("user", user_id), ("stats", user_id)))
+        self.user_cache.invalidate(*keys)
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает статистику кэша пользователей (размер, попадания, промахи).
+        """
+        return self.user_cache.stats()
+
+    def _log_activity(self, activity: List[Tuple[int, str, str]]) -> None:
+        """
+        Передаёт записи активности в отложенный журнал.
+        """
+        for user_id, activity_type, details in activity:
+            self.activity_log.log(user_id, activity_type, details)
+
+    def close(self) -> None:
+        """
+        Закрывает пул соединений (вызывается при остановке бота).
+        """
+        self.pool.close()
+
+    async def get_storage_settings(self) -> Dict[str, Any]:
+        """
+        Возвращает фактические настройки SQLite (journal_mode, synchronous и т.д.).
+        """
+        try:
+            return await self.pool.settings()
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error reading SQLite settings: {e}")
+            return {}
+
+    async def run_maintenance(self) -> Dict[str, int]:
+        """
+        Обслуживание базы: checkpoint WAL и PRAGMA optimize.
+
+        Returns:
+            Результат wal_checkpoint (пустой словарь при ошибке)
+        """
+        try:
+            result = await self.pool.checkpoint(DB_CHECKPOINT_MODE)
+            await self.pool.optimize()
+            return result
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error during database maintenance: {e}")
+            return {}
+    
+    async def archive_old_rows(self) -> Dict[str, int]:
+        """
+        Переносит расклады и журнал активности старше ARCHIVE_AFTER_DAYS дней
+        в помесячные файлы архива.
+        """
+        cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            return await archive_old_rows(self.pool, cutoff, ARCHIVE_BATCH_SIZE)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error archiving old rows: {e}")
+            return {"history": 0, "user_activity": 0}
     
     async def add_user(
         self,
@@ -272,173 +176,236 @@ class Database:
         """
         Добавляет нового пользователя с правильным начислением запросов и инициализацией статистики.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Проверяем, есть ли уже пользователь
-                cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-                if cursor.fetchone():
-                    return False
-                
-                # Если есть реферал, проверяем его существование
-                if referral_id:
-                    cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (referral_id,))
-                    if not cursor.fetchone():
-                        referral_id = None
-                
-                # Добавляем пользователя
+        # Записи журнала активности; пишутся отложенно после фиксации транзакции
+        activity: List[Tuple[int, str, str]] = []
+
+        def transaction(conn: sqlite3.Connection) -> bool:
+            nonlocal referral_id
+            cursor = conn.cursor()
+            
+            # Проверяем, есть ли уже пользователь
+            cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+            if cursor.fetchone():
+                # Вернулся после блокировки бота — снова получает рассылки
                 cursor.execute(
                     """
-                    INSERT INTO users 
-                    (user_id, username, first_name, last_name, referral_id, requests_left, premium_requests) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    UPDATE users SET delivery_status = NULL, delivery_failed_at = NULL
+                    WHERE user_id = ? AND delivery_status IS NOT NULL
                     """,
-                    (user_id, username, first_name, last_name, referral_id, 3, 1)
+                    (user_id,)
                 )
-                
-                # Инициализируем статистику пользователя
+                return False
+            
+            # Если есть реферал, проверяем его существование
+            if referral_id:
+                cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (referral_id,))
+                if not cursor.fetchone():
+                    referral_id = None
+            
+            # Добавляем пользователя
+            cursor.execute(
+                """
+                INSERT INTO users 
+                (user_id, username, first_name, last_name, referral_id, requests_left, premium_requests) 
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (user_id, username, first_name, last_name, referral_id, 3, 1)
+            )
+            
+            # Инициализируем статистику пользователя
+            cursor.execute(
+                """
+                INSERT INTO user_stats (user_id) VALUES (?)
+                """,
+                (user_id,)
+            )
+            
+            # Инициализируем уровень пользователя
+            cursor.execute(
+                """
+                INSERT INTO user_levels (user_id) VALUES (?)
+                """,
+                (user_id,)
+            )
+            
+            # Если есть валидный реферал, начисляем ему бонус
+            if referral_id:
+                # Начисляем рефералу +1 бесплатный запрос
                 cursor.execute(
-                    """
-                    INSERT INTO user_stats (user_id) VALUES (?)
-                    """,
-                    (user_id,)
+                    "UPDATE users SET requests_left = requests_left + 1 WHERE user_id = ?",
+                    (referral_id,)
                 )
-                
-                # Инициализируем уровень пользователя
+                # Увеличиваем счетчик рефералов
                 cursor.execute(
-                    """
-                    INSERT INTO user_levels (user_id) VALUES (?)
-                    """,
-                    (user_id,)
+                    "UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?",
+                    (referral_id,)
                 )
-                
-                # Если есть валидный реферал, начисляем ему бонус
-                if referral_id:
-                    # Начисляем рефералу +1 бесплатный запрос
-                    cursor.execute(
-                        "UPDATE users SET requests_left = requests_left + 1 WHERE user_id = ?",
-                        (referral_id,)
-                    )
-                    # Увеличиваем счетчик рефералов
-                    cursor.execute(
-                        "UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?",
-                        (referral_id,)
-                    )
-                    # Обновляем уровень реферала
-                    cursor.execute(
-                        "UPDATE user_levels SET referrals_count = referrals_count + 1 WHERE user_id = ?",
-                        (referral_id,)
-                    )
-                    # Записываем в историю начислений
-                    cursor.execute(
-                        """
-                        INSERT INTO referral_rewards (referrer_id, referred_id, reward_type, amount)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (referral_id, user_id, 'free_request', 1)
-                    )
-                    
-                    # Добавляем достижение "Наставник" если нужно
-                    cursor.execute(
-                        "SELECT referrals_count FROM users WHERE user_id = ?",
-                        (referral_id,)
-                    )
-                    ref_count = cursor.fetchone()[0] or 0
-                    
-                    if ref_count == 1:
-                        cursor.execute(
-                            """
-                            INSERT INTO user_achievements (user_id, achievement_name, achievement_emoji, description)
-                            VALUES (?, ?, ?, ?)
-                            ON CONFLICT(user_id, achievement_name) DO NOTHING
-                            """,
-                            (referral_id, "Наставник", "🤝", "Пригласил первого друга")
-                        )
-                    
-                    logger.info(f"🔮 Added referral bonus for user {referral_id}")
-                
-                # Добавляем первое достижение "Новичок"
+                # Обновляем уровень реферала
+                cursor.execute(
+                    "UPDATE user_levels SET referrals_count = referrals_count + 1 WHERE user_id = ?",
+                    (referral_id,)
+                )
+                # Записываем в историю начислений
                 cursor.execute(
                     """
-                    INSERT INTO user_achievements (user_id, achievement_name, achievement_emoji, description)
+                    INSERT INTO referral_rewards (referrer_id, referred_id, reward_type, amount)
                     VALUES (?, ?, ?, ?)
                     """,
-                    (user_id, "Новичок", "🌱", "Сделал первый шаг в мир Таро")
+                    (referral_id, user_id, 'free_request', 1)
                 )
-                
-                # Логируем активность
                 cursor.execute(
                     """
-                    INSERT INTO user_activity (user_id, activity_type, details)
-                    VALUES (?, ?, ?)
+                    INSERT INTO referral_stats (referrer_id, referrals_count, total_bonuses)
+                    VALUES (?, 1, 1)
+                    ON CONFLICT(referrer_id) DO UPDATE SET
+                        referrals_count = referrals_count + 1,
+                        total_bonuses = total_bonuses + 1
                     """,
-                    (user_id, "registration", f"Регистрация через реферала {referral_id if referral_id else 'нет'}")
+                    (referral_id,)
                 )
                 
-                conn.commit()
-                logger.info(f"🔮 Added new user {user_id} (@{username}) with achievements system")
-                return True
+                # Достижения реферала за приглашённых друзей
+                unlock_achievements(conn, referral_id, ["referrals"])
                 
+                logger.info(f"🔮 Added referral bonus for user {referral_id}")
+            
+            # Первое достижение "Новичок"
+            unlock_achievements(conn, user_id, ["registered"])
+            
+            # Логируем активность
+            activity.append(
+                (user_id, "registration", f"Регистрация через реферала {referral_id if referral_id else 'нет'}")
+            )
+            
+            logger.info(f"🔮 Added new user {user_id} (@{username}) with achievements system")
+            return True
+
+        try:
+            added = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error adding user: {e}")
             return False
+
+        self._invalidate_users(user_id, referral_id)
+        self._log_activity(activity)
+        return added
     
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """
-        Получает данные пользователя.
+        Получает данные пользователя (через кэш).
         """
+        cached = self.user_cache.get(("user", user_id))
+        if cached is not None:
+            return dict(cached)
+        generation = self.user_cache.generation
+
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            
+            if row:
+                return dict(row)
+            return None
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-                row = cursor.fetchone()
-                
-                if row:
-                    return dict(row)
-                return None
-                
+            user = await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting user {user_id}: {e}")
             return None
+
+        if user is None:
+            return None
+        self.user_cache.set(("user", user_id), user, generation)
+        return dict(user)
     
     async def get_user_with_stats(self, user_id: int) -> Optional[Dict[str, Any]]:
         """
-        Получает данные пользователя с расширенной статистикой.
+        Получает данные пользователя с расширенной статистикой (через кэш).
         """
+        cached = self.user_cache.get(("stats", user_id))
+        if cached is not None:
+            return dict(cached)
+        generation = self.user_cache.generation
+
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            # Получаем основную информацию пользователя
+            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            user_data = cursor.fetchone()
+            
+            if not user_data:
+                return None
+            
+            result = dict(user_data)
+            
+            # Получаем статистику
+            cursor.execute("SELECT * FROM user_stats WHERE user_id = ?", (user_id,))
+            stats_data = cursor.fetchone()
+            if stats_data:
+                result.update(dict(stats_data))
+            
+            # Получаем уровень
+            cursor.execute("SELECT * FROM user_levels WHERE user_id = ?", (user_id,))
+            level_data = cursor.fetchone()
+            if level_data:
+                result.update(dict(level_data))
+            
+            return result
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                # Получаем основную информацию пользователя
-                cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-                user_data = cursor.fetchone()
-                
-                if not user_data:
-                    return None
-                
-                result = dict(user_data)
-                
-                # Получаем статистику
-                cursor.execute("SELECT * FROM user_stats WHERE user_id = ?", (user_id,))
-                stats_data = cursor.fetchone()
-                if stats_data:
-                    result.update(dict(stats_data))
-                
-                # Получаем уровень
-                cursor.execute("SELECT * FROM user_levels WHERE user_id = ?", (user_id,))
-                level_data = cursor.fetchone()
-                if level_data:
-                    result.update(dict(level_data))
-                
-                return result
-                
+            user = await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting user with stats {user_id}: {e}")
             return None
+
+        if user is None:
+            return None
+        self.user_cache.set(("stats", user_id), user, generation)
+        return dict(user)
+    
+    async def get_user_id_by_username(self, username: str) -> Optional[int]:
+        """
+        Находит ID пользователя по username (без @).
+        """
+        def query(conn: sqlite3.Connection) -> Optional[int]:
+            row = conn.execute(
+                "SELECT user_id FROM users WHERE username = ? LIMIT 1",
+                (username,)
+            ).fetchone()
+            return row[0] if row else None
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error finding user by username {username}: {e}")
+            return None
+    
+    async def get_recent_users(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Последние зарегистрированные пользователи для админ-панели.
+        """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT user_id, username, first_name, last_name,
+                       requests_left, premium_requests, is_banned, created_at
+                FROM users
+                ORDER BY created_at DESC
+                LIMIT ?
+                """,
+                (limit,)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting recent users: {e}")
+            return []
     
     async def update_user_requests(
         self, 
@@ -449,124 +416,275 @@ class Database:
         """
         Обновляет количество запросов пользователя.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                if free_requests != 0:
-                    cursor.execute(
-                        "UPDATE users SET requests_left = requests_left + ? WHERE user_id = ?",
-                        (free_requests, user_id)
-                    )
-                
-                if premium_requests != 0:
-                    cursor.execute(
-                        "UPDATE users SET premium_requests = premium_requests + ? WHERE user_id = ?",
-                        (premium_requests, user_id)
-                    )
-                
-                # Обновляем время последней активности
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.cursor()
+            
+            if free_requests != 0:
                 cursor.execute(
-                    "UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ?",
-                    (user_id,)
+                    "UPDATE users SET requests_left = requests_left + ? WHERE user_id = ?",
+                    (free_requests, user_id)
                 )
-                
-                conn.commit()
-                logger.info(f"🔮 Updated requests for user {user_id}: +{free_requests} free, +{premium_requests} premium")
-                return True
-                
+            
+            if premium_requests != 0:
+                cursor.execute(
+                    "UPDATE users SET premium_requests = premium_requests + ? WHERE user_id = ?",
+                    (premium_requests, user_id)
+                )
+            
+            # Обновляем время последней активности
+            cursor.execute(
+                "UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ?",
+                (user_id,)
+            )
+            
+            logger.info(f"🔮 Updated requests for user {user_id}: +{free_requests} free, +{premium_requests} premium")
+            return True
+
+        try:
+            updated = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error updating requests for user {user_id}: {e}")
             return False
+
+        self._invalidate_users(user_id)
+        return updated
     
-    async def use_request(self, user_id: int, use_premium: bool = False) -> bool:
+    async def set_agreed_rules(self, user_id: int) -> bool:
         """
-        Использует один запрос пользователя. УМНАЯ ЛОГИКА:
-        - Если use_premium=True и премиумы есть -> списываем премиум.
-        - Если use_premium=False:
-            - Если есть бесплатные -> списываем бесплатный.
-            - Если бесплатных НЕТ, но есть премиумы -> автоматически списываем премиум.
-            - Если нет ничего -> возвращаем False.
+        Отмечает, что пользователь согласился с правилами.
         """
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE users SET agreed_rules = TRUE WHERE user_id = ?",
+                (user_id,)
+            )
+            return cursor.rowcount > 0
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Получаем текущие значения
-                cursor.execute(
-                    "SELECT requests_left, premium_requests FROM users WHERE user_id = ?", 
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-                if not result:
-                    logger.warning(f"⚠️ User {user_id} not found")
-                    return False
-                    
-                free, premium = result
-                
-                # ЛОГИКА ВЫБОРА, ЧТО СПИСЫВАТЬ
-                actual_use_premium = use_premium
-                log_type = "free"
-                activity_type = "free_reading"
-                
-                if not use_premium and free <= 0 and premium > 0:
-                    # Хотели бесплатный, но их нет, а премиумы есть -> списываем премиум
-                    actual_use_premium = True
+            updated = await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error saving rules agreement for user {user_id}: {e}")
+            return False
+
+        self._invalidate_users(user_id)
+        return updated
+
+    @staticmethod
+    def _charge(conn: sqlite3.Connection, user_id: int, use_premium: bool) -> Optional[str]:
+        """
+        Списывает один запрос условным UPDATE ... RETURNING (без предварительного SELECT).
+        - Если use_premium=True -> списываем только премиум.
+        - Если use_premium=False -> бесплатный, а если бесплатных нет — премиум.
+
+        Returns:
+            'free' / 'premium' или None, если списывать нечего
+        """
+        kinds = [("premium", "premium_requests")] if use_premium else [
+            ("free", "requests_left"), ("premium", "premium_requests")
+        ]
+        for kind, column in kinds:
+            row = conn.execute(
+                f"""
+                UPDATE users SET {column} = {column} - 1, last_activity = CURRENT_TIMESTAMP,
+                                 delivery_status = NULL, delivery_failed_at = NULL
+                WHERE user_id = ? AND {column} > 0
+                RETURNING {column}
+                """,
+                (user_id,)
+            ).fetchone()
+            if row is not None:
+                if kind == "premium" and not use_premium:
                     logger.info(f"🔄 Auto-switched to premium request for user {user_id} (no free left)")
-                
-                if actual_use_premium:
-                    if premium <= 0:
-                        logger.warning(f"⚠️ No premium requests for user {user_id}")
-                        return False
-                    cursor.execute(
-                        "UPDATE users SET premium_requests = premium_requests - 1 WHERE user_id = ?",
-                        (user_id,)
-                    )
-                    log_type = "premium"
-                    activity_type = "premium_reading"
-                else:
-                    if free <= 0:
-                        logger.warning(f"⚠️ No free requests for user {user_id}")
-                        return False
-                    cursor.execute(
-                        "UPDATE users SET requests_left = requests_left - 1 WHERE user_id = ?",
-                        (user_id,)
-                    )
-                    log_type = "free"
-                    activity_type = "free_reading"
-                
-                rows_affected = cursor.rowcount
-                
-                if rows_affected > 0:
-                    # Обновляем время последней активности
-                    cursor.execute(
-                        "UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ?",
-                        (user_id,)
-                    )
-                    
-                    # Логируем активность (если таблица user_activity существует)
-                    try:
-                        cursor.execute(
-                            """
-                            INSERT INTO user_activity (user_id, activity_type, details)
-                            VALUES (?, ?, ?)
-                            """,
-                            (user_id, activity_type, f"Used {log_type} request")
-                        )
-                    except sqlite3.Error:
-                        # Если таблицы нет - пропускаем, не критично
-                        pass
-                    
-                    conn.commit()
-                    logger.info(f"🔮 Used {log_type} request for user {user_id}")
-                    return True
-                else:
-                    logger.error(f"❌ Critical error: failed to deduct {log_type} request for user {user_id}")
-                    return False
-                    
+                return kind
+        return None
+
+    @staticmethod
+    def _refund(conn: sqlite3.Connection, user_id: int, kind: str, count: int = 1) -> None:
+        column = "premium_requests" if kind == "premium" else "requests_left"
+        conn.execute(
+            f"UPDATE users SET {column} = {column} + ? WHERE user_id = ?",
+            (count, user_id)
+        )
+
+    async def use_request(self, user_id: int, use_premium: bool = False) -> bool:
+        """
+        Использует один запрос пользователя без холда (см. _charge).
+        Для раскладов используется hold_request / capture_request / refund_request.
+        """
+        # Записи журнала активности; пишутся отложенно после фиксации транзакции
+        activity: List[Tuple[int, str, str]] = []
+
+        def transaction(conn: sqlite3.Connection) -> bool:
+            kind = self._charge(conn, user_id, use_premium)
+            if kind is None:
+                logger.warning(f"⚠️ No requests left for user {user_id}")
+                return False
+            
+            activity.append((user_id, f"{kind}_reading", f"Used {kind} request"))
+            logger.info(f"🔮 Used {kind} request for user {user_id}")
+            return True
+
+        try:
+            used = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error using request for user {user_id}: {e}")
             return False
+
+        self._invalidate_users(user_id)
+        self._log_activity(activity)
+        return used
+    
+    async def hold_request(self, user_id: int, reading_id: str, use_premium: bool = False) -> Optional[str]:
+        """
+        Холдирует запрос на время расклада: списывает его и записывает холд
+        в credit_ledger одной транзакцией. Повторный вызов с тем же reading_id
+        ничего не списывает и возвращает тип уже взятого холда.
+
+        Returns:
+            'free' / 'premium' — что было списано, или None, если запросов нет
+        """
+        activity: List[Tuple[int, str, str]] = []
+
+        def transaction(conn: sqlite3.Connection) -> Optional[str]:
+            existing = conn.execute(
+                "SELECT kind FROM credit_ledger WHERE reading_id = ?",
+                (reading_id,)
+            ).fetchone()
+            if existing:
+                return existing[0]
+            
+            kind = self._charge(conn, user_id, use_premium)
+            if kind is None:
+                logger.warning(f"⚠️ No requests left for user {user_id}")
+                return None
+            
+            conn.execute(
+                "INSERT INTO credit_ledger (reading_id, user_id, kind) VALUES (?, ?, ?)",
+                (reading_id, user_id, kind)
+            )
+            activity.append((user_id, f"{kind}_reading", f"Used {kind} request"))
+            logger.info(f"🔮 Held {kind} request for user {user_id} (reading {reading_id})")
+            return kind
+
+        try:
+            kind = await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error holding request for user {user_id}: {e}")
+            return None
+
+        self._invalidate_users(user_id)
+        self._log_activity(activity)
+        return kind
+    
+    async def capture_request(self, reading_id: str) -> bool:
+        """
+        Окончательно списывает холд после успешного расклада.
+
+        Returns:
+            True, если холд был открыт и теперь списан
+        """
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute(
+                """
+                UPDATE credit_ledger SET state = 'captured', updated_at = CURRENT_TIMESTAMP
+                WHERE reading_id = ? AND state = 'held'
+                """,
+                (reading_id,)
+            )
+            return cursor.rowcount > 0
+
+        try:
+            return await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error capturing reading {reading_id}: {e}")
+            return False
+    
+    async def refund_request(self, reading_id: str) -> bool:
+        """
+        Возвращает холдированный запрос пользователю. Возврат происходит
+        ровно один раз: повторный вызов или вызов после списания ничего не меняет.
+
+        Returns:
+            True, если запрос возвращён этим вызовом
+        """
+        refunded: List[Tuple[int, str]] = []
+
+        def transaction(conn: sqlite3.Connection) -> bool:
+            row = conn.execute(
+                """
+                UPDATE credit_ledger SET state = 'refunded', updated_at = CURRENT_TIMESTAMP
+                WHERE reading_id = ? AND state = 'held'
+                RETURNING user_id, kind
+                """,
+                (reading_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            
+            self._refund(conn, row[0], row[1])
+            refunded.append((row[0], row[1]))
+            return True
+
+        try:
+            result = await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error refunding reading {reading_id}: {e}")
+            return False
+
+        for user_id, kind in refunded:
+            self._invalidate_users(user_id)
+            logger.info(f"🔄 Refunded {kind} request to user {user_id} (reading {reading_id})")
+        return result
+    
+    async def release_stale_holds(
+        self,
+        timeout_minutes: int = CREDIT_HOLD_TIMEOUT_MINUTES,
+        retention_days: int = CREDIT_LEDGER_RETENTION_DAYS
+    ) -> int:
+        """
+        Возвращает запросы по холдам, не закрытым за timeout_minutes
+        (например, процесс упал посреди расклада), и удаляет закрытые
+        записи журнала старше retention_days.
+
+        Returns:
+            Количество возвращённых запросов
+        """
+        def transaction(conn: sqlite3.Connection) -> List[Tuple[int, str, int]]:
+            rows = conn.execute(
+                """
+                UPDATE credit_ledger SET state = 'refunded', updated_at = CURRENT_TIMESTAMP
+                WHERE state = 'held' AND created_at < datetime('now', ?)
+                RETURNING user_id, kind
+                """,
+                (f"-{timeout_minutes} minutes",)
+            ).fetchall()
+            
+            totals: Dict[Tuple[int, str], int] = {}
+            for user_id, kind in rows:
+                totals[(user_id, kind)] = totals.get((user_id, kind), 0) + 1
+            for (user_id, kind), count in totals.items():
+                self._refund(conn, user_id, kind, count)
+            
+            conn.execute(
+                """
+                DELETE FROM credit_ledger
+                WHERE state != 'held' AND updated_at < datetime('now', ?)
+                """,
+                (f"-{retention_days} days",)
+            )
+            return [(user_id, kind, count) for (user_id, kind), count in totals.items()]
+
+        try:
+            released = await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error releasing stale credit holds: {e}")
+            return 0
+
+        if released:
+            self._invalidate_users(*{user_id for user_id, _, _ in released})
+            logger.info(f"🔄 Released {sum(count for _, _, count in released)} stale credit holds")
+        return sum(count for _, _, count in released)
     
     async def add_history(
         self,
@@ -580,213 +698,203 @@ class Database:
         """
         Добавляет запись в историю раскладов и обновляет статистику.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Добавляем запись в историю
-                cursor.execute(
-                    """
-                    INSERT INTO history (user_id, question, cards, response, reading_type, is_premium)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    """,
-                    (user_id, question, cards, response, reading_type, is_premium)
-                )
-                
-                # Обновляем статистику пользователя
-                card_count = len(cards.split(',')) if cards else 0
-                word_count = len(response.split())
-                
-                cursor.execute(
-                    """
-                    UPDATE user_stats 
-                    SET total_readings = total_readings + 1,
-                        total_cards = total_cards + ?,
-                        total_words = total_words + ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ?
-                    """,
-                    (card_count, word_count, user_id)
-                )
-                
-                # Обновляем уровень пользователя
-                cursor.execute(
-                    """
-                    UPDATE user_levels 
-                    SET total_readings = total_readings + 1,
-                        experience = experience + ?,
-                        premium_readings = premium_readings + ?
-                    WHERE user_id = ?
-                    """,
-                    (10 if is_premium else 5, 1 if is_premium else 0, user_id)
-                )
-                
-                # Проверяем достижения по количеству раскладов
-                cursor.execute(
-                    "SELECT total_readings FROM user_stats WHERE user_id = ?",
-                    (user_id,)
-                )
-                total_readings = cursor.fetchone()[0] or 0
-                
-                # Добавляем достижения в зависимости от количества раскладов
-                achievements_to_add = []
-                
-                if total_readings == 1:
-                    achievements_to_add.append(("Искатель", "🔮", "Первый расклад"))
-                elif total_readings == 5:
-                    achievements_to_add.append(("Любознательный", "🌟", "5 раскладов"))
-                elif total_readings == 10:
-                    achievements_to_add.append(("Мудрец", "💫", "10 раскладов"))
-                elif total_readings == 20:
-                    achievements_to_add.append(("Мастер", "✨", "20 раскладов"))
-                elif total_readings == 50:
-                    achievements_to_add.append(("Великий Маг", "👑", "50 раскладов"))
-                
-                # Добавляем достижение за премиум-расклад
-                if is_premium:
-                    cursor.execute(
-                        "SELECT premium_readings FROM user_levels WHERE user_id = ?",
-                        (user_id,)
-                    )
-                    premium_count = cursor.fetchone()[0] or 0
-                    
-                    if premium_count == 1:
-                        achievements_to_add.append(("Коллекционер", "💎", "Первый премиум-расклад"))
-                    elif premium_count == 5:
-                        achievements_to_add.append(("Элитный", "💎💎", "5 премиум-раскладов"))
-                    elif premium_count == 10:
-                        achievements_to_add.append(("Королевский", "👑💎", "10 премиум-раскладов"))
-                
-                # Добавляем все достижения
-                for achievement_name, emoji, description in achievements_to_add:
-                    cursor.execute(
-                        """
-                        INSERT OR IGNORE INTO user_achievements 
-                        (user_id, achievement_name, achievement_emoji, description)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (user_id, achievement_name, emoji, description)
-                    )
-                
-                # Обновляем любимый тип раскладов
+        # Сжимаем до транзакции, чтобы не держать блокировку записи
+        dictionary, body = compress_text(response)
+        readings_total = 0
+
+        def transaction(conn: sqlite3.Connection) -> bool:
+            nonlocal readings_total
+            cursor = conn.cursor()
+            
+            # Добавляем запись в историю; текст ответа хранится отдельно в сжатом виде
+            cursor.execute(
+                """
+                INSERT INTO history (user_id, question, cards, reading_type, is_premium)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (user_id, question, cards, reading_type, is_premium)
+            )
+            cursor.execute(
+                "INSERT INTO history_responses (history_id, dictionary, body) VALUES (?, ?, ?)",
+                (cursor.lastrowid, dictionary, body)
+            )
+            
+            # Обновляем статистику пользователя
+            card_count = len(cards.split(',')) if cards else 0
+            word_count = len(response.split())
+            
+            cursor.execute(
+                """
+                UPDATE user_stats 
+                SET total_readings = total_readings + 1,
+                    total_cards = total_cards + ?,
+                    total_words = total_words + ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+                """,
+                (card_count, word_count, user_id)
+            )
+            
+            # Обновляем уровень пользователя
+            cursor.execute(
+                """
+                UPDATE user_levels 
+                SET total_readings = total_readings + 1,
+                    experience = experience + ?,
+                    premium_readings = premium_readings + ?
+                WHERE user_id = ?
+                """,
+                (10 if is_premium else 5, 1 if is_premium else 0, user_id)
+            )
+            
+            cursor.execute(
+                "SELECT total_readings FROM user_stats WHERE user_id = ?",
+                (user_id,)
+            )
+            total_readings = cursor.fetchone()[0] or 0
+            readings_total = total_readings
+            
+            # Статистика пригласившего: первый расклад делает реферала активным,
+            # первый премиум-расклад — премиальным
+            cursor.execute(
+                """
+                SELECT u.referral_id, ul.premium_readings
+                FROM users u LEFT JOIN user_levels ul ON ul.user_id = u.user_id
+                WHERE u.user_id = ?
+                """,
+                (user_id,)
+            )
+            referrer = cursor.fetchone()
+            if referrer and referrer[0]:
                 cursor.execute(
                     """
-                    SELECT reading_type, COUNT(*) as count
-                    FROM history 
-                    WHERE user_id = ? AND reading_type IS NOT NULL
-                    GROUP BY reading_type
-                    ORDER BY count DESC
-                    LIMIT 1
+                    UPDATE referral_stats
+                    SET total_referral_readings = total_referral_readings + 1,
+                        active_referrals = active_referrals + ?,
+                        premium_referrals = premium_referrals + ?
+                    WHERE referrer_id = ?
                     """,
-                    (user_id,)
-                )
-                favorite_type_result = cursor.fetchone()
-                if favorite_type_result:
-                    cursor.execute(
-                        "UPDATE user_stats SET favorite_reading_type = ? WHERE user_id = ?",
-                        (favorite_type_result[0], user_id)
+                    (
+                        1 if total_readings == 1 else 0,
+                        1 if is_premium and referrer[1] == 1 else 0,
+                        referrer[0]
                     )
-                
-                # Обновляем активные дни
-                cursor.execute(
-                    """
-                    SELECT COUNT(DISTINCT DATE(timestamp)) 
-                    FROM history 
-                    WHERE user_id = ? AND timestamp >= datetime('now', '-30 days')
-                    """,
-                    (user_id,)
-                )
-                active_days = cursor.fetchone()[0] or 0
-                cursor.execute(
-                    "UPDATE user_stats SET reading_days_active = ? WHERE user_id = ?",
-                    (active_days, user_id)
                 )
-                
-                # Обновляем последние 7 дней
+            
+            # Инкрементальные счётчики активности по дням и типам раскладов
+            cursor.execute(
+                """
+                INSERT INTO user_daily_activity (user_id, day, readings, premium_readings)
+                VALUES (?, DATE('now'), 1, ?)
+                ON CONFLICT(user_id, day) DO UPDATE SET
+                    readings = readings + 1,
+                    premium_readings = premium_readings + excluded.premium_readings
+                """,
+                (user_id, 1 if is_premium else 0)
+            )
+            if reading_type:
                 cursor.execute(
                     """
-                    SELECT COUNT(DISTINCT DATE(timestamp)) 
-                    FROM history 
-                    WHERE user_id = ? AND timestamp >= datetime('now', '-7 days')
+                    INSERT INTO user_reading_types (user_id, reading_type, readings)
+                    VALUES (?, ?, 1)
+                    ON CONFLICT(user_id, reading_type) DO UPDATE SET readings = readings + 1
                     """,
-                    (user_id,)
-                )
-                last_7_days = cursor.fetchone()[0] or 0
-                cursor.execute(
-                    "UPDATE user_stats SET last_7_days_active = ? WHERE user_id = ?",
-                    (last_7_days, user_id)
+                    (user_id, reading_type)
                 )
-                
-                # Обновляем стрик дней
-                cursor.execute(
-                    """
-                    SELECT last_streak_date, streak_days FROM user_stats WHERE user_id = ?
-                    """,
-                    (user_id,)
+            
+            # Обновляем любимый тип раскладов (несколько строк на пользователя)
+            cursor.execute(
+                """
+                SELECT reading_type FROM user_reading_types
+                WHERE user_id = ?
+                ORDER BY readings DESC
+                LIMIT 1
+                """,
+                (user_id,)
+            )
+            favorite_type_result = cursor.fetchone()
+            
+            # Активные дни за 30 и 7 дней — не больше 31 строки по первичному ключу
+            cursor.execute(
+                """
+                SELECT
+                    COUNT(*),
+                    SUM(CASE WHEN day >= DATE('now', '-7 days') THEN 1 ELSE 0 END)
+                FROM user_daily_activity
+                WHERE user_id = ? AND day >= DATE('now', '-30 days')
+                """,
+                (user_id,)
+            )
+            active_days, last_7_days = cursor.fetchone()
+            cursor.execute(
+                """
+                UPDATE user_stats
+                SET favorite_reading_type = COALESCE(?, favorite_reading_type),
+                    reading_days_active = ?,
+                    last_7_days_active = ?
+                WHERE user_id = ?
+                """,
+                (
+                    favorite_type_result[0] if favorite_type_result else None,
+                    active_days or 0,
+                    last_7_days or 0,
+                    user_id
                 )
-                streak_data = cursor.fetchone()
-                
-                today = datetime.now().strftime('%Y-%m-%d')
-                if streak_data and streak_data[0]:
-                    last_streak_date = datetime.strptime(streak_data[0], '%Y-%m-%d').date()
-                    today_date = datetime.now().date()
-                    
-                    if (today_date - last_streak_date).days == 1:
-                        # Продолжаем стрик
-                        new_streak = streak_data[1] + 1
-                        cursor.execute(
-                            "UPDATE user_stats SET streak_days = ?, last_streak_date = ? WHERE user_id = ?",
-                            (new_streak, today, user_id)
-                        )
-                        
-                        # Проверяем достижения стрика
-                        if new_streak == 3:
-                            cursor.execute(
-                                """
-                                INSERT OR IGNORE INTO user_achievements 
-                                (user_id, achievement_name, achievement_emoji, description)
-                                VALUES (?, ?, ?, ?)
-                                """,
-                                (user_id, "Постоянный", "🔥", "3 дня подряд")
-                            )
-                        elif new_streak == 7:
-                            cursor.execute(
-                                """
-                                INSERT OR IGNORE INTO user_achievements 
-                                (user_id, achievement_name, achievement_emoji, description)
-                                VALUES (?, ?, ?, ?)
-                                """,
-                                (user_id, "Ежедневный практик", "🔥🔥", "7 дней подряд")
-                            )
-                        elif new_streak == 30:
-                            cursor.execute(
-                                """
-                                INSERT OR IGNORE INTO user_achievements 
-                                (user_id, achievement_name, achievement_emoji, description)
-                                VALUES (?, ?, ?, ?)
-                                """,
-                                (user_id, "Непрерывный путь", "🔥🔥🔥", "30 дней подряд")
-                            )
-                    elif (today_date - last_streak_date).days > 1:
-                        # Сбрасываем стрик
-                        cursor.execute(
-                            "UPDATE user_stats SET streak_days = 1, last_streak_date = ? WHERE user_id = ?",
-                            (today, user_id)
-                        )
-                else:
-                    # Начинаем новый стрик
-                    cursor.execute(
-                        "UPDATE user_stats SET streak_days = 1, last_streak_date = ? WHERE user_id = ?",
-                        (today, user_id)
-                    )
-                
-                conn.commit()
-                logger.info(f"🔮 Added history for user {user_id} with stats update")
-                return True
-                
+            )
+            
+            # Обновляем стрик дней
+            cursor.execute(
+                """
+                SELECT last_streak_date, streak_days FROM user_stats WHERE user_id = ?
+                """,
+                (user_id,)
+            )
+            streak_data = cursor.fetchone()
+            
+            # День в UTC, как DATE('now') в счётчиках user_daily_activity
+            today = datetime.utcnow().date()
+            new_streak = 1
+            if streak_data and streak_data[0]:
+                last_streak_date = datetime.strptime(streak_data[0], '%Y-%m-%d').date()
+                days_since = (today - last_streak_date).days
+                
+                if days_since == 0:
+                    # Сегодня уже был расклад — стрик не меняется
+                    new_streak = streak_data[1]
+                elif days_since == 1:
+                    # Продолжаем стрик
+                    new_streak = streak_data[1] + 1
+                # Иначе стрик прервался и начинается заново
+            
+            cursor.execute(
+                "UPDATE user_stats SET streak_days = ?, last_streak_date = ? WHERE user_id = ?",
+                (new_streak, today.strftime('%Y-%m-%d'), user_id)
+            )
+            
+            # Достижения по обновлённым счётчикам — одной пачкой
+            changed = ["readings", "reading_types", "streak", "active_days"]
+            if is_premium:
+                changed.append("premium")
+            unlock_achievements(
+                conn, user_id, changed,
+                values={"readings": total_readings, "streak": new_streak, "active_days": active_days or 0}
+            )
+            
+            logger.info(f"🔮 Added history for user {user_id} with stats update")
+            return True
+
+        try:
+            added = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error adding history for user {user_id}: {e}")
             return False
+        
+        self._invalidate_users(user_id)
+        if added and user_id in self._history_counts:
+            self._history_counts[user_id] += 1
+        if added and self.leaderboard.loaded:
+            self.leaderboard.update(user_id, readings_total)
+        return added
     
     async def get_history(
         self, 
@@ -795,90 +903,329 @@ class Database:
         offset: int = 0
     ) -> List[Dict[str, Any]]:
         """
-        Получает историю пользователя.
+        Получает историю пользователя (без текста ответа, см. get_history_response).
+        Если offset уходит за пределы основной базы, записи дочитываются из архива.
         """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                f"""
+                SELECT {HISTORY_LIST_COLUMNS}
+                FROM history 
+                WHERE user_id = ? 
+                ORDER BY id DESC 
+                LIMIT ? OFFSET ?
+                """,
+                (user_id, limit, offset)
+            )
+            
+            rows = [dict(row) for row in cursor.fetchall()]
+            if len(rows) >= limit:
+                return rows
+
+            months = archive_months_for_user(conn, user_id)
+            if not months:
+                return rows
+
+            # Архивные записи старше записей основной базы: пропускаем сколько нужно по учёту
+            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,))
+            skip = max(0, offset - cursor.fetchone()[0])
+            for month in months:
+                need = limit - len(rows)
+                if need <= 0:
+                    break
+                if skip >= month["readings"]:
+                    skip -= month["readings"]
+                    continue
+
+                def archive_query(archive_conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+                    archive_rows = archive_conn.execute(
+                        f"""
+                        SELECT {HISTORY_LIST_COLUMNS}
+                        FROM {ARCHIVE_SCHEMA}.history
+                        WHERE user_id = ?
+                        ORDER BY id DESC
+                        LIMIT ? OFFSET ?
+                        """,
+                        (user_id, need, skip)
+                    ).fetchall()
+                    return [dict(row) for row in archive_rows]
+
+                rows.extend(read_archive(conn, month["month"], archive_query, []))
+                skip = 0
+            return rows
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT * FROM history 
-                    WHERE user_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT ? OFFSET ?
-                    """,
-                    (user_id, limit, offset)
-                )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting history for user {user_id}: {e}")
             return []
     
+
+    async def get_history_response(self, history_id: int, user_id: Optional[int] = None) -> Optional[str]:
+        """
+        Возвращает полный текст расклада. Распаковка выполняется только здесь,
+        при показе конкретного расклада.
+
+        Args:
+            user_id: если указан, запись должна принадлежать этому пользователю
+        """
+        def lookup(conn: sqlite3.Connection, schema: str) -> Optional[sqlite3.Row]:
+            sql = f"""
+                SELECT h.response, r.dictionary, r.body
+                FROM {schema}.history h
+                LEFT JOIN {schema}.history_responses r ON r.history_id = h.id
+                WHERE h.id = ?
+            """
+            params: Tuple = (history_id,)
+            if user_id is not None:
+                sql += " AND h.user_id = ?"
+                params += (user_id,)
+            return conn.execute(sql, params).fetchone()
+
+        def query(conn: sqlite3.Connection) -> Optional[sqlite3.Row]:
+            row = lookup(conn, "main")
+            if row:
+                return row
+
+            # Старые записи ищем в архивах, чей диапазон id содержит history_id
+            months = conn.execute(
+                """
+                SELECT month FROM archive_months
+                WHERE min_history_id <= ? AND max_history_id >= ?
+                ORDER BY month DESC
+                """,
+                (history_id, history_id)
+            ).fetchall()
+            for month in months:
+                row = read_archive(conn, month[0], lambda archive_conn: lookup(archive_conn, ARCHIVE_SCHEMA), None)
+                if row:
+                    return row
+            return None
+
+        try:
+            row = await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting history response {history_id}: {e}")
+            return None
+
+        if not row:
+            return None
+        if row["body"] is not None:
+            return decompress_text(row["dictionary"], row["body"])
+        # Запись, ещё не перенесённая миграцией
+        return row["response"]
+    
+    async def get_history_page(
+        self,
+        user_id: int,
+        limit: int = 5,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Keyset-пагинация истории для списка раскладов (без текста ответа).
+        Архив подключается, только если страница доходит до его диапазона id.
+
+        Args:
+            before_id: вернуть записи старше этого ID (следующая страница)
+            after_id: вернуть записи новее этого ID (предыдущая страница)
+
+        Returns:
+            Записи от новых к старым: id, question, cards, reading_type, is_premium, timestamp
+        """
+        newer = after_id is not None
+
+        def page(conn: sqlite3.Connection, schema: str) -> List[Dict[str, Any]]:
+            if newer:
+                sql = f"""
+                    SELECT {HISTORY_PAGE_COLUMNS} FROM {schema}.history
+                    WHERE user_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                """
+                params: Tuple = (user_id, after_id, limit)
+            elif before_id is not None:
+                sql = f"""
+                    SELECT {HISTORY_PAGE_COLUMNS} FROM {schema}.history
+                    WHERE user_id = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """
+                params = (user_id, before_id, limit)
+            else:
+                sql = f"""
+                    SELECT {HISTORY_PAGE_COLUMNS} FROM {schema}.history
+                    WHERE user_id = ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """
+                params = (user_id, limit)
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            rows = page(conn, "main")
+            
+            for month in archive_months_for_user(conn, user_id):
+                # Пропускаем архивы, которые не могут попасть на страницу
+                if newer:
+                    if month["max_id"] <= after_id:
+                        continue
+                    if len(rows) >= limit and month["min_id"] >= rows[-1]["id"]:
+                        continue
+                else:
+                    if before_id is not None and month["min_id"] >= before_id:
+                        continue
+                    if len(rows) >= limit and month["max_id"] <= rows[-1]["id"]:
+                        continue
+                
+                rows.extend(read_archive(conn, month["month"], lambda archive_conn: page(archive_conn, ARCHIVE_SCHEMA), []))
+                rows.sort(key=lambda row: row["id"], reverse=not newer)
+                del rows[limit:]
+            
+            return list(reversed(rows)) if newer else rows
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting history page for user {user_id}: {e}")
+            return []
+    
+
     async def get_total_history_count(self, user_id: int) -> int:
         """
-        Получает общее количество записей в истории пользователя.
+        Получает общее количество записей в истории пользователя (включая архив).
+        Значение кэшируется и увеличивается в add_history.
         """
+        cached = self._history_counts.get(user_id)
+        if cached is not None:
+            self._history_counts.move_to_end(user_id)
+            return cached
+        
+        def query(conn: sqlite3.Connection) -> int:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT COUNT(*) FROM history WHERE user_id = ?",
+                (user_id,)
+            )
+            count = cursor.fetchone()[0]
+            
+            # Плюс записи, перенесённые в архив
+            cursor.execute(
+                "SELECT COALESCE(SUM(readings), 0) FROM history_archive_index WHERE user_id = ?",
+                (user_id,)
+            )
+            return count + cursor.fetchone()[0]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "SELECT COUNT(*) FROM history WHERE user_id = ?",
-                    (user_id,)
-                )
-                
-                return cursor.fetchone()[0]
-                
+            count = await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting history count for user {user_id}: {e}")
             return 0
+        
+        self._history_counts[user_id] = count
+        if len(self._history_counts) > HISTORY_COUNT_CACHE_SIZE:
+            self._history_counts.popitem(last=False)
+        return count
     
     async def get_premium_history_count(self, user_id: int) -> int:
         """
         Получает количество премиум-раскладов пользователя.
         """
+        def query(conn: sqlite3.Connection) -> int:
+            cursor = conn.cursor()
+            
+            # Счётчики учитывают и заархивированные расклады
+            cursor.execute(
+                "SELECT COALESCE(SUM(premium_readings), 0) FROM user_daily_activity WHERE user_id = ?",
+                (user_id,)
+            )
+            
+            return cursor.fetchone()[0]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "SELECT COUNT(*) FROM history WHERE user_id = ? AND is_premium = TRUE",
-                    (user_id,)
-                )
-                
-                return cursor.fetchone()[0]
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting premium history count for user {user_id}: {e}")
             return 0
     
+    async def get_reading_summary(self, user_id: int) -> Dict[str, Any]:
+        """
+        Сводка раскладов пользователя по счётчикам user_stats и user_daily_activity
+        (учитывает и заархивированные расклады, history не сканирует).
+
+        Returns:
+            total_readings, premium_readings, avg_cards, favorite_type,
+            active_days, first_reading и last_reading (дни в UTC)
+        """
+        def query(conn: sqlite3.Connection) -> Dict[str, Any]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT total_readings, total_cards, favorite_reading_type FROM user_stats WHERE user_id = ?",
+                (user_id,)
+            )
+            stats = cursor.fetchone()
+            total_readings, total_cards, favorite_type = stats if stats else (0, 0, None)
+            
+            cursor.execute(
+                """
+                SELECT COUNT(*), COALESCE(SUM(premium_readings), 0), MIN(day), MAX(day)
+                FROM user_daily_activity
+                WHERE user_id = ?
+                """,
+                (user_id,)
+            )
+            active_days, premium_readings, first_day, last_day = cursor.fetchone()
+            
+            return {
+                "total_readings": total_readings or 0,
+                "premium_readings": premium_readings,
+                "avg_cards": round((total_cards or 0) / total_readings, 1) if total_readings else 0,
+                "favorite_type": favorite_type or "Не определен",
+                "active_days": active_days,
+                "first_reading": first_day,
+                "last_reading": last_day
+            }
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting reading summary for user {user_id}: {e}")
+            return {
+                "total_readings": 0,
+                "premium_readings": 0,
+                "avg_cards": 0,
+                "favorite_type": "Не определен",
+                "active_days": 0,
+                "first_reading": None,
+                "last_reading": None
+            }
+    
     async def get_user_achievements(self, user_id: int) -> List[Dict[str, Any]]:
         """
         Получает достижения пользователя.
         """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                SELECT achievement_name, achievement_emoji, description, unlocked_at 
+                FROM user_achievements 
+                WHERE user_id = ?
+                ORDER BY unlocked_at DESC
+                """,
+                (user_id,)
+            )
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT achievement_name, achievement_emoji, description, unlocked_at 
-                    FROM user_achievements 
-                    WHERE user_id = ?
-                    ORDER BY unlocked_at DESC
-                    """,
-                    (user_id,)
-                )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting achievements for user {user_id}: {e}")
             return []
@@ -887,37 +1234,43 @@ class Database:
         """
         Получает информацию об уровне пользователя.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "SELECT * FROM user_levels WHERE user_id = ?",
-                    (user_id,)
-                )
-                
-                row = cursor.fetchone()
-                if row:
-                    return dict(row)
-                
-                # Если записи нет, создаем
-                cursor.execute(
-                    "INSERT INTO user_levels (user_id) VALUES (?)",
-                    (user_id,)
-                )
-                conn.commit()
-                
-                return {
-                    "user_id": user_id,
-                    "level": 1,
-                    "experience": 0,
-                    "total_readings": 0,
-                    "premium_readings": 0,
-                    "referrals_count": 0,
-                    "last_level_up": None
-                }
-                
+        created = False
+
+        def transaction(conn: sqlite3.Connection) -> Dict[str, Any]:
+            nonlocal created
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT * FROM user_levels WHERE user_id = ?",
+                (user_id,)
+            )
+            
+            row = cursor.fetchone()
+            if row:
+                return dict(row)
+            
+            # Если записи нет, создаем
+            cursor.execute(
+                "INSERT INTO user_levels (user_id) VALUES (?)",
+                (user_id,)
+            )
+            created = True
+            
+            return {
+                "user_id": user_id,
+                "level": 1,
+                "experience": 0,
+                "total_readings": 0,
+                "premium_readings": 0,
+                "referrals_count": 0,
+                "last_level_up": None
+            }
+
+        try:
+            level_info = await self.pool.write(transaction)
+            if created:
+                self._invalidate_users(user_id)
+            return level_info
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting level info for user {user_id}: {e}")
             return {
@@ -934,89 +1287,84 @@ class Database:
         """
         Получает полную статистику пользователя.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
+        def query(conn: sqlite3.Connection) -> Dict[str, Any]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT * FROM user_stats WHERE user_id = ?",
+                (user_id,)
+            )
+            
+            row = cursor.fetchone()
+            if row:
+                stats = dict(row)
                 
+                # Добавляем дополнительную статистику
                 cursor.execute(
-                    "SELECT * FROM user_stats WHERE user_id = ?",
+                    "SELECT COUNT(*) FROM user_reading_types WHERE user_id = ?",
                     (user_id,)
                 )
+                reading_types = cursor.fetchone()
+                stats["reading_types_count"] = reading_types[0] if reading_types else 0
                 
-                row = cursor.fetchone()
-                if row:
-                    stats = dict(row)
-                    
-                    # Добавляем дополнительную статистику
-                    cursor.execute(
-                        """
-                        SELECT COUNT(DISTINCT reading_type) as reading_types_count
-                        FROM history 
-                        WHERE user_id = ? AND reading_type IS NOT NULL
-                        """,
-                        (user_id,)
-                    )
-                    reading_types = cursor.fetchone()
-                    stats["reading_types_count"] = reading_types[0] if reading_types else 0
-                    
-                    # Среднее количество карт
-                    stats["avg_cards_per_reading"] = (
-                        stats["total_cards"] / stats["total_readings"] 
-                        if stats["total_readings"] > 0 else 0
-                    )
-                    
-                    # Среднее количество слов
-                    stats["avg_words_per_reading"] = (
-                        stats["total_words"] / stats["total_readings"] 
-                        if stats["total_readings"] > 0 else 0
-                    )
-                    
-                    # Процент премиум-раскладов
-                    cursor.execute(
-                        "SELECT COUNT(*) FROM history WHERE user_id = ? AND is_premium = TRUE",
-                        (user_id,)
-                    )
-                    premium_count = cursor.fetchone()[0] or 0
-                    stats["premium_percentage"] = (
-                        (premium_count / stats["total_readings"]) * 100 
-                        if stats["total_readings"] > 0 else 0
-                    )
-                    
-                    # Дни с раскладами
-                    cursor.execute(
-                        """
-                        SELECT DATE(timestamp) as date, COUNT(*) as count
-                        FROM history 
-                        WHERE user_id = ?
-                        GROUP BY DATE(timestamp)
-                        ORDER BY date DESC
-                        """,
-                        (user_id,)
-                    )
-                    daily_stats = cursor.fetchall()
-                    stats["daily_readings"] = [dict(row) for row in daily_stats]
-                    
-                    return stats
-                else:
-                    return {
-                        "user_id": user_id,
-                        "total_readings": 0,
-                        "total_cards": 0,
-                        "total_words": 0,
-                        "favorite_reading_type": None,
-                        "most_used_cards": None,
-                        "reading_days_active": 0,
-                        "last_7_days_active": 0,
-                        "streak_days": 0,
-                        "last_streak_date": None,
-                        "reading_types_count": 0,
-                        "avg_cards_per_reading": 0,
-                        "avg_words_per_reading": 0,
-                        "premium_percentage": 0,
-                        "daily_readings": []
-                    }
+                # Среднее количество карт
+                stats["avg_cards_per_reading"] = (
+                    stats["total_cards"] / stats["total_readings"] 
+                    if stats["total_readings"] > 0 else 0
+                )
+                
+                # Среднее количество слов
+                stats["avg_words_per_reading"] = (
+                    stats["total_words"] / stats["total_readings"] 
+                    if stats["total_readings"] > 0 else 0
+                )
+                
+                # Процент премиум-раскладов
+                cursor.execute(
+                    "SELECT SUM(premium_readings) FROM user_daily_activity WHERE user_id = ?",
+                    (user_id,)
+                )
+                premium_count = cursor.fetchone()[0] or 0
+                stats["premium_percentage"] = (
+                    (premium_count / stats["total_readings"]) * 100 
+                    if stats["total_readings"] > 0 else 0
+                )
+                
+                # Дни с раскладами
+                cursor.execute(
+                    """
+                    SELECT day as date, readings as count
+                    FROM user_daily_activity
+                    WHERE user_id = ?
+                    ORDER BY day DESC
+                    """,
+                    (user_id,)
+                )
+                daily_stats = cursor.fetchall()
+                stats["daily_readings"] = [dict(row) for row in daily_stats]
                 
+                return stats
+            else:
+                return {
+                    "user_id": user_id,
+                    "total_readings": 0,
+                    "total_cards": 0,
+                    "total_words": 0,
+                    "favorite_reading_type": None,
+                    "most_used_cards": None,
+                    "reading_days_active": 0,
+                    "last_7_days_active": 0,
+                    "streak_days": 0,
+                    "last_streak_date": None,
+                    "reading_types_count": 0,
+                    "avg_cards_per_reading": 0,
+                    "avg_words_per_reading": 0,
+                    "premium_percentage": 0,
+                    "daily_readings": []
+                }
+
+        try:
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting statistics for user {user_id}: {e}")
             return {
@@ -1040,133 +1388,278 @@ class Database:
     async def get_referrals(self, user_id: int) -> List[Dict[str, Any]]:
         """
         Получает список рефералов пользователя.
+        Количество раскладов берётся из счётчика user_stats, последний расклад —
+        по индексу history(user_id, id).
         """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                SELECT u.user_id, u.username, u.first_name, u.created_at,
+                       COALESCE(us.total_readings, 0) as readings_count,
+                       (SELECT h.timestamp FROM history h
+                        WHERE h.user_id = u.user_id
+                        ORDER BY h.id DESC LIMIT 1) as last_reading
+                FROM users u 
+                LEFT JOIN user_stats us ON us.user_id = u.user_id
+                WHERE u.referral_id = ?
+                ORDER BY u.created_at DESC
+                """,
+                (user_id,)
+            )
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT u.user_id, u.username, u.first_name, u.created_at,
-                           (SELECT COUNT(*) FROM history h WHERE h.user_id = u.user_id) as readings_count,
-                           (SELECT MAX(timestamp) FROM history h WHERE h.user_id = u.user_id) as last_reading
-                    FROM users u 
-                    WHERE u.referral_id = ?
-                    ORDER BY u.created_at DESC
-                    """,
-                    (user_id,)
-                )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting referrals for user {user_id}: {e}")
             return []
     
     async def get_referral_stats(self, user_id: int) -> Dict[str, Any]:
         """
-        Получает статистику по реферальной программе.
+        Получает статистику по реферальной программе (referral_stats,
+        обновляется в add_user и add_history).
+        """
+        def query(conn: sqlite3.Connection) -> Dict[str, Any]:
+            row = conn.execute(
+                """
+                SELECT referrals_count, total_bonuses, active_referrals,
+                       premium_referrals, total_referral_readings
+                FROM referral_stats
+                WHERE referrer_id = ?
+                """,
+                (user_id,)
+            ).fetchone()
+            return dict(row) if row else dict(EMPTY_REFERRAL_STATS)
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting referral stats for user {user_id}: {e}")
+            return dict(EMPTY_REFERRAL_STATS)
+    
+    async def get_pending_payments(self) -> List[Dict[str, Any]]:
+        """
+        Получает ожидающие платежи.
         """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                SELECT p.*, u.username 
+                FROM payments p 
+                JOIN users u ON p.user_id = u.user_id 
+                WHERE p.status = 'pending'
+                ORDER BY p.timestamp DESC
+                """
+            )
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Количество рефералов
-                cursor.execute(
-                    "SELECT COUNT(*) FROM users WHERE referral_id = ?",
-                    (user_id,)
-                )
-                referrals_count = cursor.fetchone()[0]
-                
-                # Полученные бонусы
-                cursor.execute(
-                    "SELECT SUM(amount) FROM referral_rewards WHERE referrer_id = ?",
-                    (user_id,)
-                )
-                total_bonuses = cursor.fetchone()[0] or 0
-                
-                # Активные рефералы (те, кто сделал хотя бы 1 расклад)
-                cursor.execute(
-                    """
-                    SELECT COUNT(DISTINCT u.user_id) 
-                    FROM users u 
-                    JOIN history h ON u.user_id = h.user_id 
-                    WHERE u.referral_id = ?
-                    """,
-                    (user_id,)
-                )
-                active_referrals = cursor.fetchone()[0]
-                
-                # Рефералы с премиум-раскладами
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting pending payments: {e}")
+            return []
+
+    async def create_payment(
+        self,
+        user_id: int,
+        amount: float,
+        requests: int,
+        yoomoney_label: str
+    ) -> Optional[int]:
+        """
+        Создаёт ожидающий платёж ЮMoney и возвращает его ID.
+        """
+        def transaction(conn: sqlite3.Connection) -> int:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO payments (user_id, amount, requests, yoomoney_label, status)
+                VALUES (?, ?, ?, ?, 'pending')
+                """,
+                (user_id, amount, requests, yoomoney_label)
+            )
+            return cursor.lastrowid
+
+        try:
+            return await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error creating payment for user {user_id}: {e}")
+            return None
+
+    async def credit_manual_payment(self, user_id: int, requests: int, admin_id: int) -> Optional[int]:
+        """
+        Начисляет премиум-запросы вручную и записывает платёж со статусом
+        'manual' одной транзакцией.
+
+        Returns:
+            ID платежа или None, если пользователь не найден или произошла ошибка
+        """
+        def transaction(conn: sqlite3.Connection) -> Optional[int]:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                UPDATE users
+                SET premium_requests = premium_requests + ?, last_activity = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+                """,
+                (requests, user_id)
+            )
+            if cursor.rowcount == 0:
+                return None
+            
+            cursor.execute(
+                """
+                INSERT INTO payments (user_id, amount, requests, status, admin_id)
+                VALUES (?, 0, ?, 'manual', ?)
+                """,
+                (user_id, requests, admin_id)
+            )
+            return cursor.lastrowid
+
+        try:
+            payment_id = await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error crediting manual payment to user {user_id}: {e}")
+            return None
+
+        if payment_id is not None:
+            self._invalidate_users(user_id)
+            logger.info(f"🔮 Admin {admin_id} credited {requests} premium requests to user {user_id} (payment {payment_id})")
+        return payment_id
+
+    async def get_payment(self, payment_id: int, user_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Получает платёж по ID (если указан user_id — только платёж этого пользователя).
+        """
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            cursor = conn.cursor()
+            if user_id is None:
                 cursor.execute(
                     """
-                    SELECT COUNT(DISTINCT u.user_id) 
-                    FROM users u 
-                    JOIN history h ON u.user_id = h.user_id 
-                    WHERE u.referral_id = ? AND h.is_premium = TRUE
+                    SELECT p.*, u.username
+                    FROM payments p
+                    LEFT JOIN users u ON p.user_id = u.user_id
+                    WHERE p.id = ?
                     """,
-                    (user_id,)
+                    (payment_id,)
                 )
-                premium_referrals = cursor.fetchone()[0]
-                
-                # Общее количество раскладов рефералов
+            else:
                 cursor.execute(
                     """
-                    SELECT COUNT(*) 
-                    FROM history h 
-                    JOIN users u ON h.user_id = u.user_id 
-                    WHERE u.referral_id = ?
+                    SELECT p.*, u.username
+                    FROM payments p
+                    LEFT JOIN users u ON p.user_id = u.user_id
+                    WHERE p.id = ? AND p.user_id = ?
                     """,
-                    (user_id,)
+                    (payment_id, user_id)
                 )
-                total_referral_readings = cursor.fetchone()[0]
-                
-                return {
-                    "referrals_count": referrals_count,
-                    "total_bonuses": total_bonuses,
-                    "active_referrals": active_referrals,
-                    "premium_referrals": premium_referrals,
-                    "total_referral_readings": total_referral_readings
-                }
-                
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+        try:
+            return await self.pool.read(query)
         except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting referral stats for user {user_id}: {e}")
-            return {
-                "referrals_count": 0,
-                "total_bonuses": 0,
-                "active_referrals": 0,
-                "premium_referrals": 0,
-                "total_referral_readings": 0
-            }
-    
-    async def get_pending_payments(self) -> List[Dict[str, Any]]:
+            logger.error(f"⚠️ Error getting payment {payment_id}: {e}")
+            return None
+
+    async def get_last_payment(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Получает последний платёж пользователя.
+        """
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, amount, requests, status, yoomoney_label, timestamp
+                FROM payments
+                WHERE user_id = ?
+                ORDER BY timestamp DESC
+                LIMIT 1
+                """,
+                (user_id,)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting last payment for user {user_id}: {e}")
+            return None
+
+    async def get_payment_by_label(self, yoomoney_label: str) -> Optional[Dict[str, Any]]:
+        """
+        Получает последний платёж с указанным label ЮMoney (с username плательщика).
+        """
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT p.*, u.username
+                FROM payments p
+                LEFT JOIN users u ON p.user_id = u.user_id
+                WHERE p.yoomoney_label = ?
+                ORDER BY p.timestamp DESC
+                LIMIT 1
+                """,
+                (yoomoney_label,)
+            )
+            row = cursor.fetchone()
+            return dict(row) if row else None
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting payment by label {yoomoney_label}: {e}")
+            return None
+
+    async def get_payment_by_operation(self, operation_id: str) -> Optional[int]:
+        """
+        Возвращает ID подтверждённого платежа, уже использовавшего операцию ЮMoney.
+        Исключения sqlite3 пробрасываются: вызывающий код сам решает, как реагировать.
+        """
+        def query(conn: sqlite3.Connection) -> Optional[int]:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id FROM payments WHERE yoomoney_operation_id = ? AND status = 'confirmed' LIMIT 1",
+                (operation_id,)
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+        return await self.pool.read(query)
+
+    async def set_payment_operation(
+        self,
+        payment_id: int,
+        operation_id: Optional[str],
+        amount_received: float
+    ) -> bool:
         """
-        Получает ожидающие платежи.
+        Сохраняет operation_id и фактически полученную сумму для платежа.
         """
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE payments SET yoomoney_operation_id = ?, amount_received = ? WHERE id = ?",
+                (operation_id, amount_received, payment_id)
+            )
+            return cursor.rowcount > 0
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT p.*, u.username 
-                    FROM payments p 
-                    JOIN users u ON p.user_id = u.user_id 
-                    WHERE p.status = 'pending'
-                    ORDER BY p.timestamp DESC
-                    """
-                )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            return await self.pool.write(transaction)
         except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting pending payments: {e}")
-            return []
-    
+            logger.warning(f"⚠️ Could not store operation info for payment {payment_id}: {e}")
+            return False
+
     async def confirm_payment(
         self, 
         payment_id: int, 
@@ -1176,53 +1669,58 @@ class Database:
         """
         Подтверждает платёж и начисляет запросы.
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Обновляем статус платежа
+        # Записи журнала активности; пишутся отложенно после фиксации транзакции
+        activity: List[Tuple[int, str, str]] = []
+        credited_user_id: Optional[int] = None
+
+        def transaction(conn: sqlite3.Connection) -> bool:
+            nonlocal credited_user_id
+            cursor = conn.cursor()
+            
+            # Обновляем статус платежа
+            cursor.execute(
+                "UPDATE payments SET status = ? WHERE id = ?",
+                (status, payment_id)
+            )
+            
+            # Если платёж подтверждён, начисляем запросы
+            if status == "confirmed":
+                # Получаем user_id и количество запросов из платежа
                 cursor.execute(
-                    "UPDATE payments SET status = ? WHERE id = ?",
-                    (status, payment_id)
+                    "SELECT user_id, requests FROM payments WHERE id = ?",
+                    (payment_id,)
                 )
-                
-                # Если платёж подтверждён, начисляем запросы
-                if status == "confirmed":
-                    # Получаем user_id и количество запросов из платежа
+                result = cursor.fetchone()
+                if result:
+                    user_id, payment_requests = result
+                    # Используем requests из аргумента или из базы данных
+                    requests_to_add = requests if requests > 0 else payment_requests
+                    
+                    # Начисляем премиум-запросы
                     cursor.execute(
-                        "SELECT user_id, requests FROM payments WHERE id = ?",
-                        (payment_id,)
+                        "UPDATE users SET premium_requests = premium_requests + ? WHERE user_id = ?",
+                        (requests_to_add, user_id)
                     )
-                    result = cursor.fetchone()
-                    if result:
-                        user_id, payment_requests = result
-                        # Используем requests из аргумента или из базы данных
-                        requests_to_add = requests if requests > 0 else payment_requests
-                        
-                        # Начисляем премиум-запросы
-                        cursor.execute(
-                            "UPDATE users SET premium_requests = premium_requests + ? WHERE user_id = ?",
-                            (requests_to_add, user_id)
-                        )
-                        
-                        # Логируем активность
-                        cursor.execute(
-                            """
-                            INSERT INTO user_activity (user_id, activity_type, details)
-                            VALUES (?, ?, ?)
-                            """,
-                            (user_id, "payment_confirmed", f"Получено {requests_to_add} премиум-запросов")
-                        )
-                        
-                        logger.info(f"🔮 Added {requests_to_add} premium requests to user {user_id}")
-                
-                conn.commit()
-                logger.info(f"🔮 Payment {payment_id} updated to status: {status}")
-                return True
-                
+                    
+                    credited_user_id = user_id
+                    
+                    # Логируем активность
+                    activity.append((user_id, "payment_confirmed", f"Получено {requests_to_add} премиум-запросов"))
+                    
+                    logger.info(f"🔮 Added {requests_to_add} premium requests to user {user_id}")
+            
+            logger.info(f"🔮 Payment {payment_id} updated to status: {status}")
+            return True
+
+        try:
+            confirmed = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error confirming payment {payment_id}: {e}")
             return False
+
+        self._invalidate_users(credited_user_id)
+        self._log_activity(activity)
+        return confirmed
     
     async def add_feedback(
         self,
@@ -1233,319 +1731,531 @@ class Database:
         """
         Добавляет отзыв и обновляет статистику.
         """
+        # Записи журнала активности; пишутся отложенно после фиксации транзакции
+        activity: List[Tuple[int, str, str]] = []
+
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                INSERT INTO feedback (user_id, feedback, rating)
+                VALUES (?, ?, ?)
+                """,
+                (user_id, feedback, rating)
+            )
+            
+            # Достижение за отзыв
+            unlock_achievements(conn, user_id, ["feedback"])
+            
+            # Логируем активность
+            activity.append((user_id, "feedback", f"Оценка: {rating}"))
+            
+            logger.info(f"🔮 Added feedback from user {user_id}")
+            return True
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    INSERT INTO feedback (user_id, feedback, rating)
-                    VALUES (?, ?, ?)
-                    """,
-                    (user_id, feedback, rating)
-                )
-                
-                # Добавляем достижение за отзыв
-                cursor.execute(
-                    """
-                    INSERT OR IGNORE INTO user_achievements 
-                    (user_id, achievement_name, achievement_emoji, description)
-                    VALUES (?, ?, ?, ?)
-                    """,
-                    (user_id, "Критик", "📝", "Оставил первый отзыв")
-                )
-                
-                # Логируем активность
-                cursor.execute(
-                    """
-                    INSERT INTO user_activity (user_id, activity_type, details)
-                    VALUES (?, ?, ?)
-                    """,
-                    (user_id, "feedback", f"Оценка: {rating}")
-                )
-                
-                conn.commit()
-                logger.info(f"🔮 Added feedback from user {user_id}")
-                return True
-                
+            added = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error adding feedback for user {user_id}: {e}")
             return False
+
+        self._log_activity(activity)
+        return added
     
     async def get_user_feedback(self, user_id: int) -> List[Dict[str, Any]]:
         """
         Получает отзывы пользователя.
         """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                SELECT * FROM feedback 
+                WHERE user_id = ? 
+                ORDER BY timestamp DESC
+                """,
+                (user_id,)
+            )
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT * FROM feedback 
-                    WHERE user_id = ? 
-                    ORDER BY timestamp DESC
-                    """,
-                    (user_id,)
-                )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting feedback for user {user_id}: {e}")
             return []
     
+    async def get_recent_feedback(self, limit: int = 5) -> List[Dict[str, Any]]:
+        """
+        Последние отзывы всех пользователей (с username) для админ-панели.
+        """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT f.user_id, f.feedback, f.timestamp, u.username
+                FROM feedback f
+                LEFT JOIN users u ON f.user_id = u.user_id
+                ORDER BY f.timestamp DESC
+                LIMIT ?
+                """,
+                (limit,)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+
+        try:
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting recent feedback: {e}")
+            return []
+    
+    async def iter_audience(
+        self,
+        segment: Optional[Segment] = None,
+        batch_size: int = AUDIENCE_BATCH_SIZE
+    ) -> AsyncIterator[int]:
+        """
+        ID пользователей сегмента для рассылки (без забаненных и недоступных чатов).
+
+        Читает пачками по batch_size с keyset-пагинацией по user_id, так что
+        в памяти одновременно только одна пачка, а пользователь, чья активность
+        изменилась во время рассылки, не попадёт в неё дважды.
+        Ошибка базы завершает поток (рассылка уходит уже прочитанным).
+        """
+        segment = segment or Segment.everyone()
+        last_id = 0
+        while True:
+            sql, params = audience_query(segment, last_id, batch_size)
+            try:
+                rows = await self.pool.read(lambda conn: conn.execute(sql, params).fetchall())
+            except sqlite3.Error as e:
+                logger.error(f"⚠️ Error reading audience '{segment.name}' after user {last_id}: {e}")
+                return
+            for row in rows:
+                yield row[0]
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+    
+    async def count_audience(self, segment: Optional[Segment] = None) -> int:
+        """
+        Размер аудитории сегмента (для прогресса рассылки).
+        """
+        sql, params = audience_count_query(segment or Segment.everyone())
+
+        try:
+            return await self.pool.read(lambda conn: conn.execute(sql, params).fetchone()[0])
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error counting audience: {e}")
+            return 0
+    
     async def get_all_users(self) -> List[Dict[str, Any]]:
         """
-        Получает всех пользователей для рассылки.
+        Получает всех пользователей для рассылки.
+        Для больших рассылок используйте iter_audience().
+        """
+        return [{"user_id": user_id} async for user_id in self.iter_audience()]
+            
+    async def get_bot_statistics(self) -> Dict[str, int]:
+        """
+        Сводная статистика бота для админ-панели (агрегирующими запросами,
+        результат кэшируется на ADMIN_STATS_CACHE_TTL_SECONDS).
+
+        Returns:
+            total_users, active_users, total_readings, free_requests,
+            premium_requests, total_referrals (пустой словарь при ошибке)
+        """
+        cached = self._bot_stats_cache.get("bot")
+        if cached is not None:
+            return dict(cached)
+
+        def query(conn: sqlite3.Connection) -> Dict[str, int]:
+            cursor = conn.cursor()
+            
+            # Активный — есть оставшиеся запросы или хотя бы один расклад
+            cursor.execute(
+                """
+                SELECT COUNT(*) AS total_users,
+                       COALESCE(SUM(u.requests_left), 0) AS free_requests,
+                       COALESCE(SUM(u.premium_requests), 0) AS premium_requests,
+                       COALESCE(SUM(r.readings), 0) AS total_readings,
+                       COALESCE(SUM(
+                           CASE WHEN u.requests_left > 0 OR u.premium_requests > 0 OR r.readings > 0
+                           THEN 1 ELSE 0 END
+                       ), 0) AS active_users
+                FROM users u
+                LEFT JOIN (
+                    SELECT user_id, SUM(readings) AS readings
+                    FROM user_daily_activity
+                    GROUP BY user_id
+                ) r ON r.user_id = u.user_id
+                WHERE u.is_banned = FALSE
+                """
+            )
+            stats = dict(cursor.fetchone())
+            
+            cursor.execute("SELECT COUNT(*) FROM users WHERE referral_id IS NOT NULL")
+            stats["total_referrals"] = cursor.fetchone()[0]
+            return stats
+
+        try:
+            stats = await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting bot statistics: {e}")
+            return {}
+
+        self._bot_stats_cache.set("bot", stats)
+        return dict(stats)
+    
+    async def get_active_users(self, days: int = 7) -> List[Dict[str, Any]]:
+        """
+        Получает пользователей, которые были активны в последние N дней.
+        Для больших рассылок используйте iter_audience(Segment.active(days)).
+        """
+        return [{"user_id": user_id} async for user_id in self.iter_audience(Segment.active(days))]
+    
+    async def mark_undeliverable(self, statuses: Dict[int, str]) -> None:
+        """
+        Отмечает чаты, в которые не удалось доставить сообщение
+        ('blocked' — бот заблокирован, 'not_found' — чат удалён).
+        Рассылки пропускают их до повторной проверки.
+        """
+        if not statuses:
+            return
+
+        def transaction(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                UPDATE users SET delivery_status = ?, delivery_failed_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+                """,
+                [(status, user_id) for user_id, status in statuses.items()]
+            )
+
+        try:
+            await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error marking {len(statuses)} users undeliverable: {e}")
+            return
+
+        logger.info(f"📭 Marked {len(statuses)} users undeliverable")
+        self._invalidate_users(*statuses)
+    
+    async def mark_deliverable(self, user_ids: List[int]) -> None:
+        """
+        Возвращает пользователей в рассылки (чат снова доступен).
         """
+        if not user_ids:
+            return
+
+        def transaction(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                """
+                UPDATE users SET delivery_status = NULL, delivery_failed_at = NULL
+                WHERE user_id = ? AND delivery_status IS NOT NULL
+                """,
+                [(user_id,) for user_id in user_ids]
+            )
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("SELECT user_id FROM users WHERE is_banned = FALSE")
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            await self.pool.write(transaction)
         except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting all users: {e}")
-            return []
-            
-    async def get_active_users(self, days: int = 7) -> List[Dict[str, Any]]:
-        """
-        Получает пользователей, которые были активны в последние N дней.
-        """
+            logger.error(f"⚠️ Error marking {len(user_ids)} users deliverable: {e}")
+            return
+
+        self._invalidate_users(*user_ids)
+    
+    async def get_undeliverable_users(self, older_than_days: int, limit: int = 1000) -> List[int]:
+        """
+        Недоступные пользователи, отмеченные больше older_than_days дней назад
+        (кандидаты на повторную проверку), от самых давних.
+        """
+        def query(conn: sqlite3.Connection) -> List[int]:
+            rows = conn.execute(
+                """
+                SELECT user_id FROM users
+                WHERE delivery_status IS NOT NULL
+                  AND delivery_failed_at < datetime('now', '-' || ? || ' days')
+                ORDER BY delivery_failed_at
+                LIMIT ?
+                """,
+                (older_than_days, limit)
+            ).fetchall()
+            return [row[0] for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT user_id FROM users WHERE last_activity >= datetime('now', '-' || ? || ' days') AND is_banned = FALSE",
-                    (days,)
-                )
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
+            return await self.pool.read(query)
         except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting active users: {e}")
+            logger.error(f"⚠️ Error getting undeliverable users: {e}")
             return []
     
     async def add_free_requests_to_all(self) -> Tuple[int, int]:
         """
         Добавляет бесплатные запросы всем пользователям.
         """
+        def transaction(conn: sqlite3.Connection) -> Tuple[int, int]:
+            cursor = conn.cursor()
+            
+            # Добавляем по 1 запросу всем пользователям
+            cursor.execute(
+                "UPDATE users SET requests_left = requests_left + 1 WHERE is_banned = FALSE"
+            )
+            
+            users_affected = cursor.rowcount
+            
+            logger.info(f"🔮 Added free requests to {users_affected} users")
+            return users_affected, users_affected
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Добавляем по 1 запросу всем пользователям
-                cursor.execute(
-                    "UPDATE users SET requests_left = requests_left + 1 WHERE is_banned = FALSE"
-                )
-                
-                users_affected = cursor.rowcount
-                conn.commit()
-                
-                logger.info(f"🔮 Added free requests to {users_affected} users")
-                return users_affected, users_affected
-                
+            result = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error adding free requests: {e}")
             return 0, 0
+
+        self.user_cache.clear()
+        return result
     
-    async def get_user_activity(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+    async def get_job_checkpoint(self, job: str, run_key: str) -> Optional[Dict[str, Any]]:
         """
-        Получает активность пользователя.
+        Контрольная точка запуска фоновой задачи (None, если запуска ещё не было).
         """
+        def query(conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            row = conn.execute(
+                "SELECT * FROM job_checkpoints WHERE job = ? AND run_key = ?",
+                (job, run_key)
+            ).fetchone()
+            return dict(row) if row else None
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT * FROM user_activity 
-                    WHERE user_id = ? 
-                    ORDER BY timestamp DESC 
+            return await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error getting checkpoint for job {job}: {e}")
+            return None
+    
+    async def finish_job(self, job: str, run_key: str) -> None:
+        """
+        Отмечает запуск фоновой задачи завершённым.
+        """
+        def transaction(conn: sqlite3.Connection) -> None:
+            conn.execute(
+                """
+                INSERT INTO job_checkpoints (job, run_key, finished_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(job, run_key) DO UPDATE SET finished_at = CURRENT_TIMESTAMP
+                """,
+                (job, run_key)
+            )
+
+        try:
+            await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error finishing job {job}: {e}")
+    
+    async def grant_free_requests_batch(
+        self,
+        run_key: str,
+        after_id: int,
+        batch_size: int = 500
+    ) -> Optional[List[Tuple[int, int, int, Optional[str]]]]:
+        """
+        Начисляет по 1 бесплатному запросу следующей пачке пользователей
+        (по возрастанию user_id после after_id) и в той же транзакции сдвигает
+        контрольную точку задачи, поэтому повторный запуск не начислит дважды.
+
+        Returns:
+            [(user_id, requests_left, premium_requests, delivery_status), ...]
+            после начисления (пустой список — пользователи закончились,
+            None — ошибка базы)
+        """
+        def transaction(conn: sqlite3.Connection) -> List[Tuple[int, int, int, Optional[str]]]:
+            rows = conn.execute(
+                """
+                UPDATE users SET requests_left = requests_left + 1
+                WHERE user_id IN (
+                    SELECT user_id FROM users
+                    WHERE user_id > ? AND is_banned = FALSE
+                    ORDER BY user_id
                     LIMIT ?
-                    """,
-                    (user_id, limit)
                 )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+                RETURNING user_id, requests_left, premium_requests, delivery_status
+                """,
+                (after_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return []
+            
+            conn.execute(
+                """
+                INSERT INTO job_checkpoints (job, run_key, last_id, processed) VALUES (?, ?, ?, ?)
+                ON CONFLICT(job, run_key) DO UPDATE SET
+                    last_id = excluded.last_id,
+                    processed = processed + excluded.processed
+                """,
+                (FREE_REQUESTS_JOB, run_key, max(row[0] for row in rows), len(rows))
+            )
+            return [tuple(row) for row in rows]
+
+        try:
+            granted = await self.pool.write(transaction)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error granting free requests after user {after_id}: {e}")
+            return None
+
+        self._invalidate_users(*(row[0] for row in granted))
+        return granted
+    
+    async def get_user_activity(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Получает активность пользователя.
+        """
+        # Дописываем отложенные записи, чтобы видеть актуальный журнал
+        await self.activity_log.flush()
+
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                """
+                SELECT * FROM user_activity 
+                WHERE user_id = ? 
+                ORDER BY timestamp DESC 
+                LIMIT ?
+                """,
+                (user_id, limit)
+            )
+            
+            rows = [dict(row) for row in cursor.fetchall()]
+            if len(rows) >= limit:
+                return rows
+            
+            # Не хватило — дочитываем из архивов, от новых месяцев к старым
+            cursor.execute("SELECT month FROM archive_months WHERE activity_rows > 0 ORDER BY month DESC")
+            for (month,) in cursor.fetchall():
+                need = limit - len(rows)
+                if need <= 0:
+                    break
+                archive_rows = read_archive(
+                    conn, month,
+                    lambda archive_conn: archive_conn.execute(
+                        f"""
+                        SELECT * FROM {ARCHIVE_SCHEMA}.user_activity
+                        WHERE user_id = ?
+                        ORDER BY timestamp DESC
+                        LIMIT ?
+                        """,
+                        (user_id, need)
+                    ).fetchall(),
+                    []
+                )
+                rows.extend(dict(row) for row in archive_rows)
+            return rows
+
+        try:
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting activity for user {user_id}: {e}")
             return []
     
+    async def load_leaderboard(self) -> int:
+        """
+        Строит рейтинг из user_stats (при старте бота).
+        Дальше рейтинг обновляется в add_history.
+
+        Returns:
+            Количество пользователей в рейтинге
+        """
+        def query(conn: sqlite3.Connection) -> List[Tuple[int, int]]:
+            return conn.execute(
+                """
+                SELECT us.user_id, us.total_readings
+                FROM user_stats us
+                JOIN users u ON u.user_id = us.user_id
+                WHERE u.is_banned = FALSE AND us.total_readings > 0
+                """
+            ).fetchall()
+
+        try:
+            rows = await self.pool.read(query)
+        except sqlite3.Error as e:
+            logger.error(f"⚠️ Error loading leaderboard: {e}")
+            return 0
+
+        self.leaderboard.load(rows)
+        logger.info(f"🏆 Leaderboard loaded: {len(self.leaderboard)} users")
+        return len(self.leaderboard)
+    
+    async def _leaderboard_rows(self, entries: List[Tuple[int, int, int]]) -> List[Dict[str, Any]]:
+        """
+        Дополняет места рейтинга данными пользователей (точечные выборки по ключу).
+        """
+        if not entries:
+            return []
+        user_ids = [user_id for _, user_id, _ in entries]
+
+        def query(conn: sqlite3.Connection) -> Dict[int, Dict[str, Any]]:
+            rows = conn.execute(
+                f"""
+                SELECT u.user_id, u.username, u.first_name,
+                       us.reading_days_active, ul.level, ul.experience
+                FROM users u
+                LEFT JOIN user_stats us ON u.user_id = us.user_id
+                LEFT JOIN user_levels ul ON u.user_id = ul.user_id
+                WHERE u.user_id IN ({",".join("?" * len(user_ids))})
+                """,
+                user_ids
+            ).fetchall()
+            return {row["user_id"]: dict(row) for row in rows}
+
+        users = await self.pool.read(query)
+        return [
+            {**users.get(user_id, {"user_id": user_id}), "rank": rank, "total_readings": readings}
+            for rank, user_id, readings in entries
+        ]
+    
     async def get_top_users_by_readings(self, limit: int = 10) -> List[Dict[str, Any]]:
         """
-        Получает топ пользователей по количеству раскладов.
+        Получает топ пользователей по количеству раскладов (из рейтинга в памяти).
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    """
-                    SELECT u.user_id, u.username, u.first_name,
-                           us.total_readings, us.reading_days_active,
-                           ul.level, ul.experience
-                    FROM users u
-                    JOIN user_stats us ON u.user_id = us.user_id
-                    JOIN user_levels ul ON u.user_id = ul.user_id
-                    WHERE u.is_banned = FALSE
-                    ORDER BY us.total_readings DESC, ul.level DESC
-                    LIMIT ?
-                    """,
-                    (limit,)
-                )
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            if not self.leaderboard.loaded:
+                await self.load_leaderboard()
+            return await self._leaderboard_rows(self.leaderboard.top(limit))
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting top users: {e}")
             return []
     
-    async def get_achievement_progress(self, user_id: int) -> Dict[str, Any]:
+    async def get_leaderboard_position(self, user_id: int, radius: int = 2) -> Dict[str, Any]:
         """
-        Получает прогресс пользователя по различным категориям достижений.
+        Место пользователя в рейтинге и соседи вокруг него.
+
+        Returns:
+            {"rank": место или None, "total": участников, "neighbours": [...]}
         """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Получаем текущие показатели
-                cursor.execute(
-                    "SELECT total_readings, reading_days_active, streak_days FROM user_stats WHERE user_id = ?",
-                    (user_id,)
-                )
-                stats = cursor.fetchone() or (0, 0, 0)
-                
-                cursor.execute(
-                    "SELECT premium_readings, referrals_count FROM user_levels WHERE user_id = ?",
-                    (user_id,)
-                )
-                level_stats = cursor.fetchone() or (0, 0)
-                
-                cursor.execute(
-                    """
-                    SELECT COUNT(DISTINCT reading_type) as types_count
-                    FROM history 
-                    WHERE user_id = ? AND reading_type IS NOT NULL
-                    """,
-                    (user_id,)
-                )
-                types_count = cursor.fetchone()[0] or 0
-                
-                return {
-                    "readings": {
-                        "current": stats[0],
-                        "next": 5 if stats[0] < 5 else 10 if stats[0] < 10 else 20 if stats[0] < 20 else 50,
-                        "progress": min(stats[0] / 50 * 100, 100) if stats[0] > 0 else 0
-                    },
-                    "premium": {
-                        "current": level_stats[0],
-                        "next": 1 if level_stats[0] < 1 else 5 if level_stats[0] < 5 else 10,
-                        "progress": min(level_stats[0] / 10 * 100, 100) if level_stats[0] > 0 else 0
-                    },
-                    "referrals": {
-                        "current": level_stats[1],
-                        "next": 1 if level_stats[1] < 1 else 3 if level_stats[1] < 3 else 5,
-                        "progress": min(level_stats[1] / 5 * 100, 100) if level_stats[1] > 0 else 0
-                    },
-                    "reading_types": {
-                        "current": types_count,
-                        "next": 3 if types_count < 3 else 5,
-                        "progress": min(types_count / 5 * 100, 100) if types_count > 0 else 0
-                    },
-                    "streak": {
-                        "current": stats[2],
-                        "next": 3 if stats[2] < 3 else 7 if stats[2] < 7 else 30,
-                        "progress": min(stats[2] / 30 * 100, 100) if stats[2] > 0 else 0
-                    },
-                    "active_days": {
-                        "current": stats[1],
-                        "next": 7 if stats[1] < 7 else 30,
-                        "progress": min(stats[1] / 30 * 100, 100) if stats[1] > 0 else 0
-                    }
-                }
-                
+            if not self.leaderboard.loaded:
+                await self.load_leaderboard()
+            neighbours = await self._leaderboard_rows(self.leaderboard.around(user_id, radius))
         except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting achievement progress for user {user_id}: {e}")
-            return {}
-        
-
+            logger.error(f"⚠️ Error getting leaderboard position for user {user_id}: {e}")
+            neighbours = []
+        return {
+            "rank": self.leaderboard.rank(user_id),
+            "total": len(self.leaderboard),
+            "neighbours": neighbours
+        }
+    
     async def get_achievement_progress(self, user_id: int) -> Dict[str, Any]:
         """
-        Получает прогресс пользователя по различным категориям достижений.
+        Получает прогресс пользователя по категориям достижений из счётчиков
+        (пороги берутся из ACHIEVEMENT_RULES).
         """
+        def query(conn: sqlite3.Connection) -> Dict[str, Any]:
+            return achievement_progress(load_counters(conn, user_id, PROGRESS_COUNTERS))
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Получаем текущие показатели
-                cursor.execute(
-                    "SELECT total_readings, reading_days_active, streak_days FROM user_stats WHERE user_id = ?",
-                    (user_id,)
-                )
-                stats = cursor.fetchone() or (0, 0, 0)
-                
-                cursor.execute(
-                    "SELECT premium_readings, referrals_count FROM user_levels WHERE user_id = ?",
-                    (user_id,)
-                )
-                level_stats = cursor.fetchone() or (0, 0)
-                
-                cursor.execute(
-                    """
-                    SELECT COUNT(DISTINCT reading_type) as types_count
-                    FROM history 
-                    WHERE user_id = ? AND reading_type IS NOT NULL
-                    """,
-                    (user_id,)
-                )
-                types_count = cursor.fetchone()[0] or 0
-                
-                return {
-                    "readings": {
-                        "current": stats[0],
-                        "next": 5 if stats[0] < 5 else 10 if stats[0] < 10 else 20 if stats[0] < 20 else 50,
-                        "progress": min(stats[0] / 50 * 100, 100) if stats[0] > 0 else 0
-                    },
-                    "premium": {
-                        "current": level_stats[0],
-                        "next": 1 if level_stats[0] < 1 else 5 if level_stats[0] < 5 else 10,
-                        "progress": min(level_stats[0] / 10 * 100, 100) if level_stats[0] > 0 else 0
-                    },
-                    "referrals": {
-                        "current": level_stats[1],
-                        "next": 1 if level_stats[1] < 1 else 3 if level_stats[1] < 3 else 5,
-                        "progress": min(level_stats[1] / 5 * 100, 100) if level_stats[1] > 0 else 0
-                    },
-                    "reading_types": {
-                        "current": types_count,
-                        "next": 3 if types_count < 3 else 5,
-                        "progress": min(types_count / 5 * 100, 100) if types_count > 0 else 0
-                    },
-                    "streak": {
-                        "current": stats[2],
-                        "next": 3 if stats[2] < 3 else 7 if stats[2] < 7 else 30,
-                        "progress": min(stats[2] / 30 * 100, 100) if stats[2] > 0 else 0
-                    },
-                    "active_days": {
-                        "current": stats[1],
-                        "next": 7 if stats[1] < 7 else 30,
-                        "progress": min(stats[1] / 30 * 100, 100) if stats[1] > 0 else 0
-                    }
-                }
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting achievement progress for user {user_id}: {e}")
             return {}
@@ -1557,53 +2267,55 @@ class Database:
         Returns:
             Словарь с количеством начисленных бонусов: {"free": X, "premium": Y}
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Получаем количество достижений
+        # Записи журнала активности; пишутся отложенно после фиксации транзакции
+        activity: List[Tuple[int, str, str]] = []
+
+        def transaction(conn: sqlite3.Connection) -> Dict[str, int]:
+            cursor = conn.cursor()
+            
+            # Получаем количество достижений
+            cursor.execute(
+                "SELECT COUNT(*) FROM user_achievements WHERE user_id = ?",
+                (user_id,)
+            )
+            achievements_count = cursor.fetchone()[0] or 0
+            
+            # Рассчитываем бонусы
+            free_bonuses = achievements_count // 5  # +1 за каждые 5 достижений
+            premium_bonuses = achievements_count // 10  # +1 за каждые 10 достижений
+            
+            # Начисляем бонусы
+            if free_bonuses > 0:
                 cursor.execute(
-                    "SELECT COUNT(*) FROM user_achievements WHERE user_id = ?",
-                    (user_id,)
+                    "UPDATE users SET requests_left = requests_left + ? WHERE user_id = ?",
+                    (free_bonuses, user_id)
                 )
-                achievements_count = cursor.fetchone()[0] or 0
-                
-                # Рассчитываем бонусы
-                free_bonuses = achievements_count // 5  # +1 за каждые 5 достижений
-                premium_bonuses = achievements_count // 10  # +1 за каждые 10 достижений
-                
-                # Начисляем бонусы
-                if free_bonuses > 0:
-                    cursor.execute(
-                        "UPDATE users SET requests_left = requests_left + ? WHERE user_id = ?",
-                        (free_bonuses, user_id)
-                    )
-                
-                if premium_bonuses > 0:
-                    cursor.execute(
-                        "UPDATE users SET premium_requests = premium_requests + ? WHERE user_id = ?",
-                        (premium_bonuses, user_id)
-                    )
-                
-                # Логируем активность
-                if free_bonuses > 0 or premium_bonuses > 0:
-                    cursor.execute(
-                        """
-                        INSERT INTO user_activity (user_id, activity_type, details)
-                        VALUES (?, ?, ?)
-                        """,
-                        (user_id, "achievement_bonus", 
-                         f"Получено бонусов: {free_bonuses}🆓 {premium_bonuses}💎")
-                    )
-                
-                conn.commit()
-                logger.info(f"🔮 Claimed bonuses for user {user_id}: {free_bonuses} free, {premium_bonuses} premium")
-                
-                return {"free": free_bonuses, "premium": premium_bonuses}
-                
+            
+            if premium_bonuses > 0:
+                cursor.execute(
+                    "UPDATE users SET premium_requests = premium_requests + ? WHERE user_id = ?",
+                    (premium_bonuses, user_id)
+                )
+            
+            # Логируем активность
+            if free_bonuses > 0 or premium_bonuses > 0:
+                activity.append(
+                    (user_id, "achievement_bonus", f"Получено бонусов: {free_bonuses}🆓 {premium_bonuses}💎")
+                )
+            
+            logger.info(f"🔮 Claimed bonuses for user {user_id}: {free_bonuses} free, {premium_bonuses} premium")
+            
+            return {"free": free_bonuses, "premium": premium_bonuses}
+
+        try:
+            bonuses = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error claiming achievement bonus for user {user_id}: {e}")
             return {"free": 0, "premium": 0}
+
+        self._invalidate_users(user_id)
+        self._log_activity(activity)
+        return bonuses
     
     async def get_user_payments(
         self, 
@@ -1614,33 +2326,33 @@ class Database:
         """
         Получает историю платежей пользователя с информацией о тарифах.
         """
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT 
+                    p.id,
+                    p.user_id,
+                    p.amount,
+                    p.requests,
+                    p.status,
+                    p.timestamp,
+                    p.yoomoney_label,
+                    p.admin_id,
+                    COALESCE(r.label, '') as tariff_name
+                FROM payments p
+                LEFT JOIN rates r ON p.requests = r.requests 
+                    AND CAST(p.amount AS REAL) = CAST(r.price AS REAL)
+                WHERE p.user_id = ?
+                ORDER BY p.timestamp DESC
+                LIMIT ? OFFSET ?
+            """, (user_id, limit, offset))
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT 
-                        p.id,
-                        p.user_id,
-                        p.amount,
-                        p.requests,
-                        p.status,
-                        p.timestamp,
-                        p.yoomoney_label,
-                        p.admin_id,
-                        COALESCE(r.label, '') as tariff_name
-                    FROM payments p
-                    LEFT JOIN rates r ON p.requests = r.requests 
-                        AND CAST(p.amount AS REAL) = CAST(r.price AS REAL)
-                    WHERE p.user_id = ?
-                    ORDER BY p.timestamp DESC
-                    LIMIT ? OFFSET ?
-                """, (user_id, limit, offset))
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting user payments for user {user_id}: {e}")
             return []
@@ -1649,144 +2361,180 @@ class Database:
         """
         Получает общее количество платежей пользователя.
         """
+        def query(conn: sqlite3.Connection) -> int:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT COUNT(*) FROM payments WHERE user_id = ?",
+                (user_id,)
+            )
+            
+            return cursor.fetchone()[0] or 0
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "SELECT COUNT(*) FROM payments WHERE user_id = ?",
-                    (user_id,)
-                )
-                
-                return cursor.fetchone()[0] or 0
-                
+            return await self.pool.read(query)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error getting user payments count for user {user_id}: {e}")
             return 0
     
-    async def get_all_rates(self) -> List[Dict[str, Any]]:
+    async def load_rates(self) -> List[Dict[str, Any]]:
         """
-        Получает все тарифы из базы данных.
+        Загружает тарифы из базы в память. Вызывается при старте и после
+        изменения тарифов; остальные методы работы с тарифами читают из памяти.
         """
+        version = self.rates_version
+
+        def query(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT package_key, requests, price, label, created_at, updated_at
+                FROM rates
+                ORDER BY requests ASC
+            """)
+            
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT package_key, requests, price, label, created_at, updated_at
-                    FROM rates
-                    ORDER BY requests ASC
-                """)
-                
-                rows = cursor.fetchall()
-                return [dict(row) for row in rows]
-                
+            rates = await self.pool.read(query)
         except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting all rates: {e}")
+            logger.error(f"⚠️ Error loading rates: {e}")
             return []
+
+        # Если тарифы изменились во время загрузки, результат уже устарел
+        if version == self.rates_version:
+            self._rates = OrderedDict((rate["package_key"], rate) for rate in rates)
+            logger.info(f"💰 Loaded {len(rates)} rates (version {self.rates_version})")
+        return [dict(rate) for rate in rates]
+
+    def _invalidate_rates(self) -> None:
+        """
+        Сбрасывает тарифы в памяти и увеличивает их версию.
+        """
+        self.rates_version += 1
+        self._rates = None
+
+    async def get_all_rates(self) -> List[Dict[str, Any]]:
+        """
+        Получает все тарифы (из памяти, при первом обращении — из базы данных).
+        """
+        if self._rates is None:
+            return await self.load_rates()
+        return [dict(rate) for rate in self._rates.values()]
     
     async def get_rate(self, package_key: str) -> Optional[Dict[str, Any]]:
         """
-        Получает информацию о конкретном тарифе.
+        Получает информацию о конкретном тарифе (из памяти).
         """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute("""
-                    SELECT package_key, requests, price, label, created_at, updated_at
-                    FROM rates
-                    WHERE package_key = ?
-                """, (package_key,))
-                
-                row = cursor.fetchone()
-                return dict(row) if row else None
-                
-        except sqlite3.Error as e:
-            logger.error(f"⚠️ Error getting rate {package_key}: {e}")
-            return None
+        if self._rates is None:
+            await self.load_rates()
+        rate = (self._rates or {}).get(package_key)
+        return dict(rate) if rate else None
+
+    def get_payment_options(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Тарифы из памяти в формате config.PAYMENT_OPTIONS.
+        Пустой словарь, если тарифы ещё не загружены.
+        """
+        return {
+            package_key: {
+                "requests": rate["requests"],
+                "price": rate["price"],
+                "label": rate.get("label") or f"{rate['requests']} запросов ({rate['price']} руб.)"
+            }
+            for package_key, rate in (self._rates or {}).items()
+        }
     
     async def update_rate_price(self, package_key: str, price: int) -> bool:
         """
         Обновляет цену тарифа и автоматически обновляет label.
         """
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.cursor()
+            
+            # Сначала получаем количество запросов для обновления label
+            cursor.execute("SELECT requests FROM rates WHERE package_key = ?", (package_key,))
+            result = cursor.fetchone()
+            
+            if not result:
+                logger.warning(f"⚠️ Rate {package_key} not found for price update")
+                return False
+            
+            requests = result[0]
+            # Обновляем label автоматически
+            new_label = f"{requests} запросов ({price} руб.)"
+            
+            cursor.execute("""
+                UPDATE rates
+                SET price = ?, label = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE package_key = ?
+            """, (price, new_label, package_key))
+            
+            rows_affected = cursor.rowcount
+            
+            if rows_affected > 0:
+                logger.info(f"🔮 Updated rate {package_key} price to {price}, label to '{new_label}' (rows affected: {rows_affected})")
+                return True
+            else:
+                logger.warning(f"⚠️ Rate {package_key} not found for price update")
+                return False
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Сначала получаем количество запросов для обновления label
-                cursor.execute("SELECT requests FROM rates WHERE package_key = ?", (package_key,))
-                result = cursor.fetchone()
-                
-                if not result:
-                    logger.warning(f"⚠️ Rate {package_key} not found for price update")
-                    return False
-                
-                requests = result[0]
-                # Обновляем label автоматически
-                new_label = f"{requests} запросов ({price} руб.)"
-                
-                cursor.execute("""
-                    UPDATE rates
-                    SET price = ?, label = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE package_key = ?
-                """, (price, new_label, package_key))
-                
-                rows_affected = cursor.rowcount
-                conn.commit()
-                
-                if rows_affected > 0:
-                    logger.info(f"🔮 Updated rate {package_key} price to {price}, label to '{new_label}' (rows affected: {rows_affected})")
-                    return True
-                else:
-                    logger.warning(f"⚠️ Rate {package_key} not found for price update")
-                    return False
-                
+            updated = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error updating rate price for {package_key}: {e}")
             return False
+
+        if updated:
+            self._invalidate_rates()
+            await self.load_rates()
+        return updated
     
     async def update_rate_requests(self, package_key: str, requests: int) -> bool:
         """
         Обновляет количество запросов в тарифе и автоматически обновляет label.
         """
+        def transaction(conn: sqlite3.Connection) -> bool:
+            cursor = conn.cursor()
+            
+            # Сначала получаем цену для обновления label
+            cursor.execute("SELECT price FROM rates WHERE package_key = ?", (package_key,))
+            result = cursor.fetchone()
+            
+            if not result:
+                logger.warning(f"⚠️ Rate {package_key} not found for requests update")
+                return False
+            
+            price = result[0]
+            # Обновляем label автоматически
+            new_label = f"{requests} запросов ({price} руб.)"
+            
+            cursor.execute("""
+                UPDATE rates
+                SET requests = ?, label = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE package_key = ?
+            """, (requests, new_label, package_key))
+            
+            rows_affected = cursor.rowcount
+            
+            if rows_affected > 0:
+                logger.info(f"🔮 Updated rate {package_key} requests to {requests}, label to '{new_label}' (rows affected: {rows_affected})")
+                return True
+            else:
+                logger.warning(f"⚠️ Rate {package_key} not found for requests update")
+                return False
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Сначала получаем цену для обновления label
-                cursor.execute("SELECT price FROM rates WHERE package_key = ?", (package_key,))
-                result = cursor.fetchone()
-                
-                if not result:
-                    logger.warning(f"⚠️ Rate {package_key} not found for requests update")
-                    return False
-                
-                price = result[0]
-                # Обновляем label автоматически
-                new_label = f"{requests} запросов ({price} руб.)"
-                
-                cursor.execute("""
-                    UPDATE rates
-                    SET requests = ?, label = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE package_key = ?
-                """, (requests, new_label, package_key))
-                
-                rows_affected = cursor.rowcount
-                conn.commit()
-                
-                if rows_affected > 0:
-                    logger.info(f"🔮 Updated rate {package_key} requests to {requests}, label to '{new_label}' (rows affected: {rows_affected})")
-                    return True
-                else:
-                    logger.warning(f"⚠️ Rate {package_key} not found for requests update")
-                    return False
-                
+            updated = await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error updating rate requests for {package_key}: {e}")
             return False
+
+        if updated:
+            self._invalidate_rates()
+            await self.load_rates()
+        return updated
     
     async def cleanup_old_pending(self, days: int = 7) -> int:
         """
@@ -1798,27 +2546,27 @@ class Database:
         Returns:
             Количество удалённых записей
         """
+        def transaction(conn: sqlite3.Connection) -> int:
+            cursor = conn.cursor()
+            
+            # Удаляем pending платежи старше days дней
+            cursor.execute("""
+                DELETE FROM payments 
+                WHERE status = 'pending' 
+                AND datetime(timestamp) < datetime('now', ?)
+            """, (f'-{days} days',))
+            
+            deleted_count = cursor.rowcount
+            
+            if deleted_count > 0:
+                logger.info(f"🧹 Cleaned up {deleted_count} old pending payments (older than {days} days)")
+            else:
+                logger.debug(f"🧹 No old pending payments to clean up (older than {days} days)")
+            
+            return deleted_count
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Удаляем pending платежи старше days дней
-                cursor.execute("""
-                    DELETE FROM payments 
-                    WHERE status = 'pending' 
-                    AND datetime(timestamp) < datetime('now', ?)
-                """, (f'-{days} days',))
-                
-                deleted_count = cursor.rowcount
-                conn.commit()
-                
-                if deleted_count > 0:
-                    logger.info(f"🧹 Cleaned up {deleted_count} old pending payments (older than {days} days)")
-                else:
-                    logger.debug(f"🧹 No old pending payments to clean up (older than {days} days)")
-                
-                return deleted_count
-                
+            return await self.pool.write(transaction)
         except sqlite3.Error as e:
             logger.error(f"⚠️ Error cleaning up old pending payments: {e}")
             return 0
@@ -4,11 +4,12 @@ handlers.py
 """
 
 from datetime import datetime, timedelta
-import sqlite3
 from pytz import timezone
 import logging
 import asyncio
+import html
 import random
+import uuid
 from aiogram import Router, Bot, F
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import Message, CallbackQuery
@@ -23,7 +24,7 @@ from config import (
     INITIAL_PREMIUM_REQUESTS, FREE_REQUEST_INTERVAL,
     MAX_CARDS, FORBIDDEN_KEYWORDS, MAX_FORBIDDEN_ATTEMPTS,
     BOT_USERNAME, MAX_QUESTION_LENGTH, BAN_DURATION_HOURS,
-    TIMEZONE, PAYMENT_OPTIONS, TAROT_READER_NAME
+    TIMEZONE, PAYMENT_OPTIONS, TAROT_READER_NAME, OHMYGPT_STREAMING
 )
 from keyboards import (
     achievements_progress_keyboard, examples_category_keyboard, feedback_keyboard, main_menu_keyboard, readings_submenu_keyboard,
@@ -31,17 +32,22 @@ from keyboards import (
     payment_options_keyboard, cards_number_keyboard,
     reading_type_keyboard, history_pagination_keyboard,
     confirmation_keyboard, referral_keyboard,
-    examples_keyboard, achievements_keyboard, user_stats_keyboard, achievements_bonus_keyboard
+    examples_keyboard, achievements_keyboard, user_stats_keyboard, achievements_bonus_keyboard,
+    leaderboard_keyboard
 )
 from utils import (
     generate_tarot_cards, get_all_tarot_cards_list,
     send_admin_notification, check_free_request_interval,
     parse_custom_cards, format_datetime, get_random_advice,
     get_random_quote, get_referral_link, format_tarot_response,
+    format_reading_header, format_reading_footer,
     get_user_achievements, get_user_level  # Добавим эти функции
 )
 from database import db
-from ohmygpt_api import get_tarot_response
+from achievements import ACHIEVEMENT_RULES
+from ohmygpt_api import get_tarot_response, stream_tarot_response
+from live_message import LiveMessage
+from llm_queue import llm_queue, LLMQueueError, QueueFull
 from yoomoney import yoomoney_payment
 
 router = Router()
@@ -88,6 +94,9 @@ class UserState(StatesGroup):
     awaiting_feedback = State()
     awaiting_reading_type = State()
 
+# Сколько мест показывать на экране рейтинга
+LEADERBOARD_TOP_SIZE = 10
+
 # Список типов раскладов
 READING_TYPES = {
     "situation_reading": {
@@ -314,13 +323,7 @@ async def agree_rules_handler(callback: CallbackQuery, state: FSMContext) -> Non
     user_id = callback.from_user.id
     
     # Обновляем статус согласия
-    with sqlite3.connect(str(db.db_path)) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET agreed_rules = TRUE WHERE user_id = ?",
-            (user_id,)
-        )
-        conn.commit()
+    await db.set_agreed_rules(user_id)
     
     # Получаем обновленные данные
     user_data = await db.get_user(user_id)
@@ -559,6 +562,52 @@ async def cards_number_handler(callback: CallbackQuery, state: FSMContext) -> No
     await state.set_state(UserState.awaiting_question)
     await safe_answer(callback)
 
+async def stream_reading(
+    bot: Bot,
+    thinking_msg: Message,
+    question: str,
+    cards: List[str],
+    is_premium: bool,
+    full_history: str,
+    user_id: int,
+    username: str
+) -> Optional[str]:
+    """
+    Получает ответ потоком и печатает его в сообщение «размышляет...»
+    (первые слова видны через секунду-другую, а не после всего ответа).
+
+    Returns:
+        Текст ответа или None, если ИИ ничего не вернул
+        (сообщение о размышлении при этом остаётся как было)
+    """
+    live = LiveMessage(
+        bot,
+        thinking_msg.chat.id,
+        thinking_msg.message_id,
+        header=format_reading_header(question, cards)
+    )
+    try:
+        async for delta in stream_tarot_response(
+            question=question,
+            cards=cards,
+            is_premium=is_premium,
+            full_history=full_history,
+            user_id=user_id,
+            username=username
+        ):
+            await live.append(delta)
+    except Exception:
+        if live.text:
+            await live.finish("\n\n<i>⚠️ Ответ прервался...</i>")
+        raise
+    
+    if not live.text:
+        return None
+    
+    answer = await live.finish()
+    logger.info(f"🔮 Streamed reading for user {user_id}: {len(answer)} chars in {live.messages} messages, {live.edits} edits")
+    return answer
+
 @router.message(StateFilter(UserState.awaiting_question))
 async def process_question(message: Message, state: FSMContext, bot: Bot) -> None:
     """Обработчик вопроса для расклада."""
@@ -655,6 +704,15 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
     # Генерируем карты
     cards = generate_tarot_cards(num_cards)
     
+    # Один расклад за раз: второй вопрос, пока первый в очереди или в работе, не принимаем
+    if llm_queue.busy(user_id):
+        await message.answer(
+            "⏳🔮 <b>Твой расклад уже готовится!</b>\n\n"
+            "Дождись ответа на предыдущий вопрос, а потом задай следующий.",
+            parse_mode='HTML'
+        )
+        return
+    
     # ---- УМНАЯ ЛОГИКА ИСПОЛЬЗОВАНИЯ ЗАПРОСОВ ----
     use_premium = False
     
@@ -677,12 +735,14 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
         use_premium = False
         logger.info(f"📊 Используется бесплатный запрос (премиумов нет) для user {user_id}")
     
-    # Если нет ничего - use_premium остаётся False, но use_request вернёт ошибку
+    # Если нет ничего - use_premium остаётся False, но hold_request вернёт None
     
-    # Используем запрос (функция use_request тоже умная и проверит доступность)
-    success = await db.use_request(user_id, use_premium)
+    # Холдируем запрос на время расклада: списание и запись в журнал одной транзакцией.
+    # hold_request сам переключается на премиум, если бесплатных не осталось
+    reading_id = uuid.uuid4().hex
+    held_kind = await db.hold_request(user_id, reading_id, use_premium)
     
-    if not success:
+    if held_kind is None:
         await message.answer(
             "❌🔮 <b>Не удалось использовать запрос!</b>\n\n"
             "Пожалуйста, проверь количество запросов в профиле.\n\n"
@@ -696,6 +756,8 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
         await state.clear()
         return
     
+    use_premium = held_kind == "premium"
+    
     # Создаем красивый список карт с эмодзи
     cards_with_emoji = []
     card_emojis = ["🃏", "✨", "🌟", "💫", "🌙"]
@@ -718,14 +780,21 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
         f"✨ Сегодняшние карты:\n" + "\n".join(cards_with_emoji)
     ]
     
+    thinking_text = random.choice(thinking_msgs)
     thinking_msg = await message.answer(
-        random.choice(thinking_msgs),
+        thinking_text,
         parse_mode='HTML'
     )
     
+    async def show_queue_position(position: int) -> None:
+        await thinking_msg.edit_text(
+            f"{thinking_text}\n\n⏳ <i>Ты {position}-й в очереди — {TAROT_READER_NAME} скоро возьмётся за твой расклад</i>",
+            parse_mode='HTML'
+        )
+    
     try:
         # Получаем историю для контекста
-        history = await db.get_history(user_id, limit=3)
+        history = await db.get_history_page(user_id, limit=3)
         full_history = ""
         
         if history:
@@ -735,22 +804,40 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
                 full_history += f"🃏 Карты: {record['cards']}\n"
                 full_history += f"💫 Тип: {record.get('reading_type', 'классический')}\n\n"
         
-        # Получаем ответ от ИИ
-        response_data = await get_tarot_response(
-            question=question,
-            cards=cards,
-            is_premium=use_premium,
-            full_history=full_history,
-            user_id=user_id,
-            username=message.from_user.username or "user"
-        )
-        
-        # Удаляем сообщение о размышлении
-        await bot.delete_message(message.chat.id, thinking_msg.message_id)
-        
-        if response_data and 'choices' in response_data:
-            answer = response_data['choices'][0]['message']['content']
+        # Получаем ответ от ИИ через общую очередь: премиум раньше, не больше LLM_CONCURRENCY одновременно
+        async with llm_queue.slot(user_id, premium=use_premium, on_position=show_queue_position):
+            if OHMYGPT_STREAMING:
+                # Ответ печатается в сообщение о размышлении по мере генерации
+                answer = await stream_reading(
+                    bot,
+                    thinking_msg,
+                    question=question,
+                    cards=cards,
+                    is_premium=use_premium,
+                    full_history=full_history,
+                    user_id=user_id,
+                    username=message.from_user.username or "user"
+                )
+                if answer is None:
+                    await bot.delete_message(message.chat.id, thinking_msg.message_id)
+            else:
+                response_data = await get_tarot_response(
+                    question=question,
+                    cards=cards,
+                    is_premium=use_premium,
+                    full_history=full_history,
+                    user_id=user_id,
+                    username=message.from_user.username or "user"
+                )
+            
+                # Удаляем сообщение о размышлении
+                await bot.delete_message(message.chat.id, thinking_msg.message_id)
             
+                answer = None
+                if response_data and 'choices' in response_data:
+                    answer = response_data['choices'][0]['message']['content']
+        
+        if answer is not None:
             # Сохраняем в историю
             await db.add_history(
                 user_id=user_id,
@@ -760,15 +847,23 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
                 reading_type=reading_type,
                 is_premium=use_premium
             )
-            
-            # Получаем список сообщений
-            formatted_messages = format_tarot_response(
-                answer=answer,
-                question=question,
-                cards=cards,
-                is_premium=use_premium,
-                reader_name=TAROT_READER_NAME
-            )
+            if not await db.capture_request(reading_id):
+                # Холд уже вернули по таймауту (расклад шёл дольше CREDIT_HOLD_TIMEOUT_MINUTES) — списываем заново
+                logger.warning(f"⚠️ Hold for reading {reading_id} of user {user_id} was already released, charging again")
+                if not await db.use_request(user_id, use_premium):
+                    logger.warning(f"⚠️ Could not charge user {user_id} for reading {reading_id}: delivered free")
+            
+            # Получаем список сообщений (при потоке сам ответ уже показан — остаётся финальное)
+            if OHMYGPT_STREAMING:
+                formatted_messages = [format_reading_footer(answer, use_premium, TAROT_READER_NAME)]
+            else:
+                formatted_messages = format_tarot_response(
+                    answer=answer,
+                    question=question,
+                    cards=cards,
+                    is_premium=use_premium,
+                    reader_name=TAROT_READER_NAME
+                )
             
             # Отправляем все сообщения по очереди
             for i, msg in enumerate(formatted_messages):
@@ -812,10 +907,7 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
             
         else:
             # Возвращаем запрос, если ошибка
-            await db.update_user_requests(user_id, 
-                free_requests=1 if not use_premium else 0,
-                premium_requests=1 if use_premium else 0
-            )
+            await db.refund_request(reading_id)
             
             await message.answer(
                 "❌🌙 <b>Карты сегодня отдыхают...</b>\n\n"
@@ -828,14 +920,28 @@ async def process_question(message: Message, state: FSMContext, bot: Bot) -> Non
                 parse_mode='HTML'
             )
     
+    except LLMQueueError as e:
+        # Расклад не начался — возвращаем запрос
+        logger.warning(f"⚠️ Reading for user {user_id} not queued: {type(e).__name__}")
+        await db.refund_request(reading_id)
+        
+        await thinking_msg.edit_text(
+            "⏳🌙 <b>Сейчас к картам очень много вопросов</b>\n\n"
+            "• 🔄 Твой запрос возвращён\n"
+            "• ⏳ Попробуй через пару минут\n\n"
+            "<i>Луна ответит каждому — просто чуть позже.</i>"
+            if isinstance(e, QueueFull) else
+            "⏳🔮 <b>Твой расклад уже готовится!</b>\n\n"
+            "• 🔄 Этот запрос возвращён\n"
+            "• ✨ Ответ на предыдущий вопрос скоро придёт",
+            parse_mode='HTML'
+        )
+    
     except Exception as e:
         logger.error(f"⚠️ Error in reading process: {e}")
         
-        # Возвращаем запрос при ошибке
-        await db.update_user_requests(user_id,
-            free_requests=1 if not use_premium else 0,
-            premium_requests=1 if use_premium else 0
-        )
+        # Возвращаем запрос при ошибке (если расклад уже сохранён, холд списан и возврата не будет)
+        await db.refund_request(reading_id)
         
         await message.answer(
             "⚠️🔮 <b>Произошла неожиданная ошибка!</b>\n\n"
@@ -998,14 +1104,8 @@ async def achievements_handler(callback: CallbackQuery) -> None:
     user_level = await get_user_level(user_id)
     
     all_achievements = [
-        {"name": "🌱 Новичок", "description": "Первый расклад", "emoji": "🌱"},
-        {"name": "🔮 Искатель", "description": "5 раскладов", "emoji": "🔮"},
-        {"name": "🌟 Мудрец", "description": "10 раскладов", "emoji": "🌟"},
-        {"name": "💎 Коллекционер", "description": "Первый премиум-расклад", "emoji": "💎"},
-        {"name": "🤝 Наставник", "description": "Пригласить друга", "emoji": "🤝"},
-        {"name": "📚 Энциклопедист", "description": "Использовать все типы раскладов", "emoji": "📚"},
-        {"name": "💫 Маг", "description": "20 раскладов", "emoji": "💫"},
-        {"name": "🌙 Проводник", "description": "Помочь 3 друзьям", "emoji": "🌙"},
+        {"name": rule.title, "description": rule.description}
+        for rule in ACHIEVEMENT_RULES
     ]
     
     achievements_text = f"🏆🌟 <b>Твои достижения</b>\n\n"
@@ -1015,15 +1115,15 @@ async def achievements_handler(callback: CallbackQuery) -> None:
         achievements_text += "✅ <b>Полученные:</b>\n"
         for achievement in all_achievements:
             if achievement["name"] in achievements:
-                achievements_text += f"{achievement['emoji']} <b>{achievement['name']}</b>\n"
+                achievements_text += f"<b>{achievement['name']}</b>\n"
                 achievements_text += f"<i>{achievement['description']}</i>\n\n"
     
     # Показываем ближайшие достижения
     achievements_text += "🎯 <b>Ближайшие цели:</b>\n"
-    for achievement in all_achievements[:3]:
-        if achievement["name"] not in achievements:
-            achievements_text += f"🔒 {achievement['emoji']} {achievement['name']}\n"
-            achievements_text += f"<i>{achievement['description']}</i>\n\n"
+    locked = [achievement for achievement in all_achievements if achievement["name"] not in achievements]
+    for achievement in locked[:3]:
+        achievements_text += f"🔒 {achievement['name']}\n"
+        achievements_text += f"<i>{achievement['description']}</i>\n\n"
     
     achievements_text += "💡 <b>Как получить достижения:</b>\n"
     achievements_text += "• 🔮 Делай расклады регулярно\n"
@@ -1169,32 +1269,17 @@ async def process_payment_option(callback: CallbackQuery, state: FSMContext) ->
     label = yoomoney_payment.generate_label(user_id=user_id, package_key=package_key)
 
     # Сохраняем информацию о платеже в базу данных
-    import sqlite3
-    from config import DB_PATH
-    
-    try:
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO payments (user_id, amount, requests, yoomoney_label, status)
-                VALUES (?, ?, ?, ?, 'pending')
-                """,
-                (user_id, package["price"], package["requests"], label)
-            )
-            payment_id = cursor.lastrowid
-
-            import random
-            unique_cents = random.randint(1, 99)
-            payable_amount = round(float(package["price"]) + (unique_cents / 100.0), 2)
-
-            cursor.execute(
-                "UPDATE payments SET amount = ? WHERE id = ?",
-                (payable_amount, payment_id)
-            )
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Error saving payment: {e}")
+    import random
+    unique_cents = random.randint(1, 99)
+    payable_amount = round(float(package["price"]) + (unique_cents / 100.0), 2)
+
+    payment_id = await db.create_payment(
+        user_id=user_id,
+        amount=payable_amount,
+        requests=package["requests"],
+        yoomoney_label=label
+    )
+    if payment_id is None:
         await safe_answer(callback, "⚠️ Ошибка при создании платежа. Попробуйте позже.")
         return
 
@@ -1267,25 +1352,12 @@ async def check_payment_handler(callback: CallbackQuery, state: FSMContext, bot:
         payment_id = int(callback.data.replace("check_payment_", ""))
         
         # Получаем информацию о платеже
-        import sqlite3
-        from config import DB_PATH
-        
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT p.*, u.username 
-                FROM payments p
-                LEFT JOIN users u ON p.user_id = u.user_id
-                WHERE p.id = ? AND p.user_id = ?
-            """, (payment_id, user_id))
-            payment = cursor.fetchone()
-        
-        if not payment:
+        payment_dict = await db.get_payment(payment_id, user_id=user_id)
+        
+        if not payment_dict:
             await safe_answer(callback, "⚠️ Платёж не найден!", show_alert=True)
             return
         
-        payment_dict = dict(payment)
         status = payment_dict.get("status", "unknown")
         yoomoney_label = payment_dict.get("yoomoney_label", "")
         
@@ -1328,26 +1400,17 @@ async def check_payment_handler(callback: CallbackQuery, state: FSMContext, bot:
             logger.error(f"Error calling check_yoomoney_payments: {e}", exc_info=True)
         
         # Проверяем статус снова после проверки
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT status FROM payments WHERE id = ?", (payment_id,))
-            result = cursor.fetchone()
-            new_status = result[0] if result else status
+        updated_payment = await db.get_payment(payment_id)
+        new_status = updated_payment["status"] if updated_payment else status
         
         if new_status == "confirmed":
-            # Платеж подтверждён - получаем обновлённые данные
-            with sqlite3.connect(str(DB_PATH)) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute("SELECT amount, requests FROM payments WHERE id = ?", (payment_id,))
-                result = cursor.fetchone()
-                if result:
-                    amount = result["amount"]
-                    requests = result["requests"]
-                else:
-                    amount = payment_dict.get("amount", 0)
-                    requests = payment_dict.get("requests", 0)
+            # Платеж подтверждён - используем обновлённые данные
+            if updated_payment:
+                amount = updated_payment["amount"]
+                requests = updated_payment["requests"]
+            else:
+                amount = payment_dict.get("amount", 0)
+                requests = payment_dict.get("requests", 0)
             
             user_data = await db.get_user(user_id)
             current_premium = user_data.get("premium_requests", 0) if user_data else 0
@@ -1399,24 +1462,12 @@ async def payment_support_handler(callback: CallbackQuery, state: FSMContext, bo
     user_id = callback.from_user.id
     
     # Получаем последний платеж пользователя
-    import sqlite3
-    from config import DB_PATH, ADMIN_ID
+    from config import ADMIN_ID
     
     try:
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, amount, requests, status, yoomoney_label, timestamp
-                FROM payments
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (user_id,))
-            payment = cursor.fetchone()
-        
-        if payment:
-            payment_dict = dict(payment)
+        payment_dict = await db.get_last_payment(user_id)
+        
+        if payment_dict:
             payment_id = payment_dict["id"]
             amount = payment_dict["amount"]
             requests = payment_dict["requests"]
@@ -1676,13 +1727,40 @@ async def purchase_history_pagination_handler(callback: CallbackQuery) -> None:
         logger.error(f"Error in purchase_history_pagination: {e}", exc_info=True)
         await safe_answer(callback, "⚠️ Ошибка при загрузке страницы", show_alert=True)
 
+def _format_history_page(history: List[Dict[str, Any]], first_number: int) -> str:
+    """
+    Форматирует страницу списка раскладов.
+    """
+    history_text = "📜 <b>Твоя история раскладов</b> 🌙\n\n"
+    
+    for i, record in enumerate(history, first_number):
+        question = record.get('question', 'Без вопроса')
+        if len(question) > 50:
+            question = question[:50] + "..."
+        
+        cards = record.get('cards', '')
+        if len(cards) > 30:
+            cards = cards[:30] + "..."
+        
+        date = format_datetime(record.get('timestamp', ''))
+        
+        history_text += (
+            f"{i}. <b>#{record['id']}</b>\n"
+            f"❓ {question}\n"
+            f"🃏 {cards}\n"
+            f"📅 {date}\n"
+            f"{'💎 Премиум' if record.get('is_premium') else '🆓 Бесплатно'}\n\n"
+        )
+    
+    return history_text
+
 @router.callback_query(F.data == "history")
 async def history_handler(callback: CallbackQuery) -> None:
     """Обработчик истории раскладов."""
     user_id = callback.from_user.id
     
     try:
-        history = await db.get_history(user_id, limit=5, offset=0)
+        history = await db.get_history_page(user_id, limit=5)
         total_count = await db.get_total_history_count(user_id)
         total_pages = (total_count + 4) // 5  # По 5 на страницу
         
@@ -1706,27 +1784,7 @@ async def history_handler(callback: CallbackQuery) -> None:
             await safe_answer(callback)
             return
         
-        history_text = "📜 <b>Твоя история раскладов</b> 🌙\n\n"
-        
-        for i, record in enumerate(history, 1):
-            question = record.get('question', 'Без вопроса')
-            if len(question) > 50:
-                question = question[:50] + "..."
-            
-            cards = record.get('cards', '')
-            if len(cards) > 30:
-                cards = cards[:30] + "..."
-            
-            date = format_datetime(record.get('timestamp', ''))
-            
-            history_text += (
-                f"{i}. <b>#{record['id']}</b>\n"
-                f"❓ {question}\n"
-                f"🃏 {cards}\n"
-                f"📅 {date}\n"
-                f"{'💎 Премиум' if record.get('is_premium') else '🆓 Бесплатно'}\n\n"
-            )
-        
+        history_text = _format_history_page(history, 1)
         history_text += f"<i>Всего раскладов: {total_count}</i>"
         
         if total_pages > 1:
@@ -1734,7 +1792,9 @@ async def history_handler(callback: CallbackQuery) -> None:
         
         await callback.message.edit_text(
             history_text,
-            reply_markup=history_pagination_keyboard(0, total_pages),
+            reply_markup=history_pagination_keyboard(
+                0, total_pages, first_id=history[0]['id'], last_id=history[-1]['id']
+            ),
             parse_mode='HTML'
         )
         await safe_answer(callback)
@@ -1745,53 +1805,34 @@ async def history_handler(callback: CallbackQuery) -> None:
 
 @router.callback_query(F.data.startswith("history_"))
 async def history_pagination_handler(callback: CallbackQuery) -> None:
-    """Обработчик пагинации истории раскладов."""
+    """
+    Обработчик пагинации истории раскладов.
+    callback_data: history_prev_{page}_{first_id} / history_next_{page}_{last_id}
+    """
     user_id = callback.from_user.id
     
     try:
-        data = callback.data
-        
-        if data.startswith("history_prev_"):
-            page = int(data.replace("history_prev_", ""))
-            new_page = max(0, page - 1)
-        elif data.startswith("history_next_"):
-            page = int(data.replace("history_next_", ""))
-            total_count = await db.get_total_history_count(user_id)
-            total_pages = (total_count + 4) // 5
-            new_page = min(total_pages - 1, page + 1)
+        parts = callback.data.split("_")
+        
+        # Кнопки старого формата (без курсора) открывают первую страницу
+        if len(parts) == 4 and parts[1] == "prev":
+            new_page = max(0, int(parts[2]) - 1)
+            history = await db.get_history_page(user_id, limit=5, after_id=int(parts[3]))
+        elif len(parts) == 4 and parts[1] == "next":
+            new_page = int(parts[2]) + 1
+            history = await db.get_history_page(user_id, limit=5, before_id=int(parts[3]))
         else:
             new_page = 0
-        
-        offset = new_page * 5
-        history = await db.get_history(user_id, limit=5, offset=offset)
-        total_count = await db.get_total_history_count(user_id)
-        total_pages = (total_count + 4) // 5
+            history = await db.get_history_page(user_id, limit=5)
         
         if not history:
             await safe_answer(callback, "⚠️ Больше нет записей")
             return
         
-        history_text = "📜 <b>Твоя история раскладов</b> 🌙\n\n"
-        
-        for i, record in enumerate(history, 1):
-            question = record.get('question', 'Без вопроса')
-            if len(question) > 50:
-                question = question[:50] + "..."
-            
-            cards = record.get('cards', '')
-            if len(cards) > 30:
-                cards = cards[:30] + "..."
-            
-            date = format_datetime(record.get('timestamp', ''))
-            
-            history_text += (
-                f"{offset + i}. <b>#{record['id']}</b>\n"
-                f"❓ {question}\n"
-                f"🃏 {cards}\n"
-                f"📅 {date}\n"
-                f"{'💎 Премиум' if record.get('is_premium') else '🆓 Бесплатно'}\n\n"
-            )
+        total_count = await db.get_total_history_count(user_id)
+        total_pages = max((total_count + 4) // 5, new_page + 1)
         
+        history_text = _format_history_page(history, new_page * 5 + 1)
         history_text += f"<i>Всего раскладов: {total_count}</i>"
         
         if total_pages > 1:
@@ -1799,7 +1840,9 @@ async def history_pagination_handler(callback: CallbackQuery) -> None:
         
         await callback.message.edit_text(
             history_text,
-            reply_markup=history_pagination_keyboard(new_page, total_pages),
+            reply_markup=history_pagination_keyboard(
+                new_page, total_pages, first_id=history[0]['id'], last_id=history[-1]['id']
+            ),
             parse_mode='HTML'
         )
         await safe_answer(callback)
@@ -2533,6 +2576,43 @@ async def user_stats_handler(callback: CallbackQuery) -> None:
     )
     await safe_answer(callback)
 
+@router.callback_query(F.data == "leaderboard")
+async def leaderboard_handler(callback: CallbackQuery) -> None:
+    """Обработчик рейтинга пользователей по количеству раскладов."""
+    user_id = callback.from_user.id
+    
+    top_users = await db.get_top_users_by_readings(LEADERBOARD_TOP_SIZE)
+    position = await db.get_leaderboard_position(user_id)
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    
+    def leaderboard_line(entry: Dict[str, Any]) -> str:
+        name = html.escape(entry.get("first_name") or "Аноним")
+        marker = medals.get(entry["rank"], f"{entry['rank']}.")
+        line = f"{marker} {name} — {entry['total_readings']} 🔮"
+        return f"<b>{line}</b>" if entry["user_id"] == user_id else line
+    
+    leaderboard_text = "🥇🌟 <b>Рейтинг знатоков Таро</b>\n\n"
+    
+    if top_users:
+        leaderboard_text += "\n".join(leaderboard_line(entry) for entry in top_users) + "\n\n"
+    else:
+        leaderboard_text += "<i>Рейтинг пока пуст — стань первым!</i>\n\n"
+    
+    if position["rank"] is None:
+        leaderboard_text += "🎯 <i>Сделай первый расклад, чтобы попасть в рейтинг!</i>"
+    else:
+        leaderboard_text += f"🎯 <b>Твоё место:</b> {position['rank']} из {position['total']}\n"
+        # Соседей показываем, только если пользователь не виден в топе
+        if position["rank"] > LEADERBOARD_TOP_SIZE:
+            leaderboard_text += "\n" + "\n".join(leaderboard_line(entry) for entry in position["neighbours"])
+    
+    await callback.message.edit_text(
+        leaderboard_text,
+        reply_markup=leaderboard_keyboard(),
+        parse_mode='HTML'
+    )
+    await safe_answer(callback)
+
 @router.callback_query(F.data == "referral_list")
 async def referral_list_handler(callback: CallbackQuery) -> None:
     """Обработчик списка приглашенных."""
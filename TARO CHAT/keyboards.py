@@ -2,6 +2,7 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
 from typing import Dict, Any, Optional
 from config import PAYMENT_OPTIONS
+from audience import BROADCAST_SEGMENTS
 
 async def main_menu_keyboard(user_data: Dict[str, Any]) -> InlineKeyboardBuilder:
     """
@@ -137,19 +138,25 @@ def reading_type_keyboard() -> InlineKeyboardBuilder:
     keyboard.adjust(1)
     return keyboard.as_markup()
 
-def history_pagination_keyboard(page: int, total_pages: int) -> InlineKeyboardBuilder:
+def history_pagination_keyboard(
+    page: int,
+    total_pages: int,
+    first_id: Optional[int] = None,
+    last_id: Optional[int] = None
+) -> InlineKeyboardBuilder:
     """
     Создаёт клавиатуру пагинации для истории.
+    first_id/last_id — ID первой и последней записи страницы (курсоры keyset-пагинации).
     """
     keyboard = InlineKeyboardBuilder()
     
-    if page > 0:
-        keyboard.button(text="⬅️ Назад", callback_data=f"history_prev_{page}")
+    if page > 0 and first_id is not None:
+        keyboard.button(text="⬅️ Назад", callback_data=f"history_prev_{page}_{first_id}")
     
     keyboard.button(text=f"{page + 1}/{total_pages}", callback_data="history_page")
     
-    if page < total_pages - 1:
-        keyboard.button(text="Вперёд ➡️", callback_data=f"history_next_{page}")
+    if page < total_pages - 1 and last_id is not None:
+        keyboard.button(text="Вперёд ➡️", callback_data=f"history_next_{page}_{last_id}")
     
     keyboard.button(text="📊 Статистика", callback_data="user_stats")
     keyboard.button(text="🔙 В профиль", callback_data="profile_submenu")
@@ -232,17 +239,23 @@ def pending_payment_keyboard(payment_id: int) -> InlineKeyboardBuilder:
     keyboard.adjust(2)
     return keyboard.as_markup()
 
-def broadcast_keyboard() -> InlineKeyboardBuilder:
+def broadcast_keyboard(segment: str = "all") -> InlineKeyboardBuilder:
     """
-    Создаёт клавиатуру для подтверждения или отмены рассылки.
+    Создаёт клавиатуру выбора аудитории, подтверждения или отмены рассылки.
+    
+    Args:
+        segment: выбранный ключ из BROADCAST_SEGMENTS
     
     Returns:
-        InlineKeyboardBuilder с кнопками отправки и отмены.
+        InlineKeyboardBuilder с сегментами и кнопками отправки и отмены.
     """
     keyboard = InlineKeyboardBuilder()
+    for key, (label, _) in BROADCAST_SEGMENTS.items():
+        mark = "✅ " if key == segment else ""
+        keyboard.button(text=f"{mark}{label}", callback_data=f"broadcast_segment_{key}")
     keyboard.button(text="📤 Отправить", callback_data="confirm_broadcast")
     keyboard.button(text="❌ Отмена", callback_data="cancel_broadcast")
-    keyboard.adjust(2)
+    keyboard.adjust(*([1] * len(BROADCAST_SEGMENTS)), 2)
     return keyboard.as_markup()
 
 def admin_panel_keyboard() -> InlineKeyboardBuilder:
@@ -308,11 +321,24 @@ def user_stats_keyboard() -> InlineKeyboardBuilder:
     keyboard.button(text="📅 Активность", callback_data="stats_activity")
     keyboard.button(text="🎯 Предпочтения", callback_data="stats_preferences")
     keyboard.button(text="🏆 Достижения", callback_data="achievements")
+    keyboard.button(text="🥇 Рейтинг", callback_data="leaderboard")
     keyboard.button(text="🔙 Назад", callback_data="profile_submenu")
     
     keyboard.adjust(1)
     return keyboard.as_markup()
 
+def leaderboard_keyboard() -> InlineKeyboardBuilder:
+    """
+    Создаёт клавиатуру рейтинга пользователей.
+    """
+    keyboard = InlineKeyboardBuilder()
+    
+    keyboard.button(text="🔄 Обновить", callback_data="leaderboard")
+    keyboard.button(text="🔙 Назад", callback_data="user_stats")
+    
+    keyboard.adjust(1)
+    return keyboard.as_markup()
+
 def referral_stats_keyboard() -> InlineKeyboardBuilder:
     """
     Создаёт клавиатуру статистики рефералов.
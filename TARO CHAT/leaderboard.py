@@ -0,0 +1,88 @@
+"""
+leaderboard.py
+Рейтинг пользователей по количеству раскладов в памяти процесса.
+"""
+
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Ключ сортировки: больше раскладов — выше; при равенстве выше меньший Telegram ID
+# (это не порядок регистрации, а просто устойчивый порядок для равных мест)
+RankKey = Tuple[int, int]
+
+
+class Leaderboard:
+    """
+    Отсортированный список ключей (-total_readings, user_id) и словарь
+    user_id -> ключ.
+
+    Место пользователя и соседи находятся бинарным поиском за O(log n).
+    Обновление — удаление и вставка в список (сдвиг памяти, без сравнений),
+    что для сотен тысяч пользователей занимает микросекунды.
+    Пользователи без раскладов в рейтинг не попадают.
+    """
+
+    def __init__(self) -> None:
+        self._keys: List[RankKey] = []
+        self._by_user: Dict[int, RankKey] = {}
+        self.loaded: bool = False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, rows: Iterable[Tuple[int, int]]) -> None:
+        """
+        Перестраивает рейтинг из снимка (user_id, total_readings).
+        """
+        self._by_user = {user_id: (-readings, user_id) for user_id, readings in rows if readings and readings > 0}
+        self._keys = sorted(self._by_user.values())
+        self.loaded = True
+
+    def update(self, user_id: int, readings: int) -> None:
+        """
+        Устанавливает количество раскладов пользователя.
+        """
+        self.remove(user_id)
+        if readings > 0:
+            key = (-readings, user_id)
+            self._by_user[user_id] = key
+            insort(self._keys, key)
+
+    def remove(self, user_id: int) -> None:
+        """
+        Убирает пользователя из рейтинга.
+        """
+        key = self._by_user.pop(user_id, None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, key)]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """
+        Место пользователя (с 1) или None, если его нет в рейтинге.
+        """
+        key = self._by_user.get(user_id)
+        if key is None:
+            return None
+        return bisect_left(self._keys, key) + 1
+
+    def top(self, limit: int) -> List[Tuple[int, int, int]]:
+        """
+        Первые limit мест: [(место, user_id, раскладов), ...]
+        """
+        return self._slice(0, limit)
+
+    def around(self, user_id: int, radius: int = 2) -> List[Tuple[int, int, int]]:
+        """
+        Пользователь и по radius соседей сверху и снизу: [(место, user_id, раскладов), ...]
+        """
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(rank - 1 - radius, 0)
+        return self._slice(start, rank + radius)
+
+    def _slice(self, start: int, stop: int) -> List[Tuple[int, int, int]]:
+        return [
+            (start + offset + 1, user_id, -negative_readings)
+            for offset, (negative_readings, user_id) in enumerate(self._keys[start:stop])
+        ]
@@ -0,0 +1,144 @@
+"""
+live_message.py
+Сообщение Telegram, которое дописывается по мере генерации ответа.
+"""
+
+import asyncio
+import html
+import logging
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import STREAM_EDIT_INTERVAL, STREAM_MESSAGE_LIMIT
+from utils import strip_html_tags
+
+logger = logging.getLogger(__name__)
+
+# Курсор в конце текста, пока ответ ещё пишется
+TYPING_CURSOR: str = " ▌"
+
+
+def split_point(text: str, limit: int) -> int:
+    """
+    Где разрезать text, чтобы первая часть была не длиннее limit:
+    по абзацу, строке или пробелу во второй половине, иначе ровно по limit.
+    """
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, 0, limit)
+        if index > limit // 2:
+            return index
+    return limit
+
+
+class LiveMessage:
+    """
+    Показывает текст ответа, пока он генерируется.
+
+    Первый фрагмент сразу редактирует исходное сообщение (например,
+    «Луна размышляет...»), дальше правки идут не чаще interval секунд
+    на сообщение — промежуточные фрагменты копятся и показываются
+    следующей правкой. Когда header + текст превышает limit символов,
+    сообщение завершается на границе абзаца, а продолжение уходит новым
+    сообщением. При TelegramRetryAfter промежуточные правки пропускаются,
+    завершающие ждут и повторяются.
+
+    Из текста ответа удаляются HTML-теги (как в format_tarot_response),
+    затем он экранируется; header — готовый HTML первого сообщения.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: int,
+        message_id: int,
+        header: str = "",
+        limit: int = STREAM_MESSAGE_LIMIT,
+        interval: float = STREAM_EDIT_INTERVAL
+    ) -> None:
+        self.bot: Bot = bot
+        self.chat_id: int = chat_id
+        self.limit: int = limit
+        self.interval: float = interval
+        self.text: str = ""
+        self.messages: int = 1
+        self.edits: int = 0
+        self._message_id: Optional[int] = message_id
+        self._prefix: str = header
+        self._part: str = ""
+        self._shown: Optional[str] = None
+        self._next_edit_at: float = 0.0
+
+    async def append(self, delta: str) -> None:
+        """
+        Добавляет фрагмент ответа и, если пора, обновляет сообщение.
+        """
+        self.text += delta
+        self._part += delta
+        while len(self._prefix) + len(self._part) > self.limit:
+            await self._rollover()
+        if time.monotonic() >= self._next_edit_at:
+            await self._render(final=False)
+
+    async def finish(self, note: str = "") -> str:
+        """
+        Показывает окончательный текст (без курсора) и возвращает весь ответ.
+
+        Args:
+            note: HTML-приписка в конце последнего сообщения (например, об обрыве)
+        """
+        await self._render(final=True, note=note)
+        return self.text
+
+    async def _rollover(self) -> None:
+        cut = split_point(self._part, max(self.limit - len(self._prefix), 1))
+        head, tail = self._part[:cut], self._part[cut:].lstrip()
+        self._part = head
+        await self._render(final=True)
+
+        # Продолжение — новым сообщением при следующей отрисовке
+        self._message_id = None
+        self._prefix = ""
+        self._part = tail
+        self._shown = None
+        self.messages += 1
+
+    async def _render(self, final: bool, note: str = "") -> None:
+        body = html.escape(strip_html_tags(self._part).strip())
+        if not body and not note:
+            return
+        text = self._prefix + body + (note if final else TYPING_CURSOR)
+        if text == self._shown:
+            return
+
+        while True:
+            if final:
+                # Завершающая правка обязательна: ждём, пока лимит позволит
+                wait = self._next_edit_at - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                if self._message_id is None:
+                    sent = await self.bot.send_message(self.chat_id, text, parse_mode='HTML')
+                    self._message_id = sent.message_id
+                else:
+                    await self.bot.edit_message_text(
+                        text,
+                        chat_id=self.chat_id,
+                        message_id=self._message_id,
+                        parse_mode='HTML'
+                    )
+                    self.edits += 1
+            except TelegramRetryAfter as e:
+                self._next_edit_at = time.monotonic() + e.retry_after
+                if final:
+                    continue
+                return
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+            self._shown = text
+            self._next_edit_at = time.monotonic() + self.interval
+            return
@@ -0,0 +1,200 @@
+"""
+llm_queue.py
+Очередь запросов к ИИ: ограничение параллельности, приоритет премиума, позиция в очереди.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config import LLM_CONCURRENCY, LLM_QUEUE_MAX_SIZE, LLM_QUEUE_POSITION_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+PRIORITY_PREMIUM: int = 0
+PRIORITY_FREE: int = 1
+
+
+class LLMQueueError(Exception):
+    """
+    Запрос не поставлен в очередь.
+    """
+
+
+class ReadingInProgress(LLMQueueError):
+    """
+    У пользователя уже есть расклад в очереди или в работе.
+    """
+
+
+class QueueFull(LLMQueueError):
+    """
+    Очередь заполнена.
+    """
+
+
+class _Ticket:
+    def __init__(self, user_id: int, priority: int, seq: int) -> None:
+        self.user_id: int = user_id
+        self.priority: int = priority
+        self.seq: int = seq
+        self.position: int = 0
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.moved: asyncio.Event = asyncio.Event()
+        self.enqueued_at: float = time.monotonic()
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        return self.priority, self.seq
+
+
+class LLMQueue:
+    """
+    Не больше concurrency запросов к ИИ одновременно, остальные ждут
+    в очереди: премиум-расклады раньше бесплатных, внутри приоритета —
+    по порядку. У пользователя одновременно не больше одного расклада,
+    в очереди не больше max_size ожидающих.
+
+    Ожидающий получает свою позицию через on_position (не чаще
+    position_interval секунд), чтобы показать «ты N-й в очереди».
+    """
+
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        max_size: int = LLM_QUEUE_MAX_SIZE,
+        position_interval: float = LLM_QUEUE_POSITION_INTERVAL
+    ) -> None:
+        self.concurrency: int = max(concurrency, 1)
+        self.max_size: int = max_size
+        self.position_interval: float = position_interval
+        self.active: int = 0
+        self.served: int = 0
+        self.rejected: int = 0
+        self.peak_waiting: int = 0
+        self.max_wait: float = 0.0
+        self._heap: List[Tuple[Tuple[int, int], _Ticket]] = []
+        self._users: Dict[int, _Ticket] = {}
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._heap)
+
+    def busy(self, user_id: int) -> bool:
+        """
+        Есть ли у пользователя расклад в очереди или в работе.
+        """
+        return user_id in self._users
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        premium: bool = False,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> AsyncIterator[None]:
+        """
+        Ждёт свободного места и держит его до выхода из блока:
+
+            async with llm_queue.slot(user_id, premium, on_position):
+                ...запрос к ИИ...
+
+        Raises:
+            ReadingInProgress: у пользователя уже есть расклад в очереди или в работе
+            QueueFull: в очереди max_size ожидающих
+        """
+        if user_id in self._users:
+            raise ReadingInProgress(user_id)
+
+        ticket = _Ticket(user_id, PRIORITY_PREMIUM if premium else PRIORITY_FREE, next(self._seq))
+        self._users[user_id] = ticket
+        if self.active < self.concurrency and not self._heap:
+            self.active += 1
+            ticket.granted.set_result(None)
+        elif len(self._heap) >= self.max_size:
+            del self._users[user_id]
+            self.rejected += 1
+            raise QueueFull(user_id)
+        else:
+            heapq.heappush(self._heap, (ticket.key, ticket))
+            self.peak_waiting = max(self.peak_waiting, len(self._heap))
+            self._reposition()
+
+        try:
+            await self._wait(ticket, on_position)
+            wait = time.monotonic() - ticket.enqueued_at
+            self.max_wait = max(self.max_wait, wait)
+            yield
+        finally:
+            del self._users[user_id]
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                self.served += 1
+                self.active -= 1
+                self._grant_next()
+            else:
+                # Ушёл из очереди, не дождавшись (отмена задачи)
+                ticket.granted.cancel()
+                self._heap = [(key, queued) for key, queued in self._heap if queued is not ticket]
+                heapq.heapify(self._heap)
+                self._reposition()
+
+    async def _wait(self, ticket: _Ticket, on_position: Optional[Callable[[int], Awaitable[None]]]) -> None:
+        reported = None
+        next_report_at = 0.0
+        while not ticket.granted.done():
+            now = time.monotonic()
+            if on_position and ticket.position != reported and now >= next_report_at:
+                reported = ticket.position
+                next_report_at = now + self.position_interval
+                try:
+                    await on_position(ticket.position)
+                except Exception as e:
+                    logger.debug(f"Failed to report queue position to {ticket.user_id}: {e}")
+                continue
+
+            # Ждём своей очереди, сдвига позиции или времени отложенного отчёта
+            ticket.moved.clear()
+            moved = asyncio.ensure_future(ticket.moved.wait())
+            timeout = next_report_at - now if on_position and ticket.position != reported else None
+            try:
+                await asyncio.wait({ticket.granted, moved}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                moved.cancel()
+
+    def _grant_next(self) -> None:
+        while self._heap and self.active < self.concurrency:
+            _, ticket = heapq.heappop(self._heap)
+            if ticket.granted.done():
+                continue
+            self.active += 1
+            ticket.granted.set_result(None)
+        self._reposition()
+
+    def _reposition(self) -> None:
+        for position, (_, ticket) in enumerate(sorted(self._heap), start=1):
+            if ticket.position != position:
+                ticket.position = position
+                ticket.moved.set()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Состояние очереди: active, waiting, peak_waiting, served, rejected, max_wait.
+        """
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "served": self.served,
+            "rejected": self.rejected,
+            "max_wait": self.max_wait,
+        }
+
+
+# Глобальный экземпляр
+llm_queue = LLMQueue()
@@ -19,12 +19,10 @@ from aiogram.client.default import DefaultBotProperties
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from pytz import timezone
-import sqlite3
 from config import (
     BOT_TOKEN,
     LOG_PATH,
     TIMEZONE,
-    DB_PATH,
     YOOMONEY_CHECK_INTERVAL,
     YOOMONEY_NOTIFICATION_SECRET,
     YOOMONEY_WEBHOOK_ENABLED,
@@ -32,12 +30,16 @@ from config import (
     YOOMONEY_WEBHOOK_PORT,
     YOOMONEY_WEBHOOK_PATH,
     YOOMONEY_DRY_RUN,
+    DB_CHECKPOINT_INTERVAL_MINUTES,
+    BACKUP_INTERVAL_MINUTES,
 )
 from handlers import router
 from admin_handlers import admin_router
-from utils import add_free_requests_task, send_promotional_message
+from utils import add_free_requests_task, send_promotional_message, reprobe_undeliverable_task
 from yoomoney import yoomoney_payment
 from database import db
+from ohmygpt_api import ohmygpt_api
+from backup import backup_manager
 
 # Глобальная переменная для бота (будет установлена в main)
 bot_instance = None
@@ -98,20 +100,12 @@ async def _yoomoney_webhook_handler(request: web.Request) -> web.Response:
         amount_received = 0.0
 
     try:
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, user_id, amount, requests, status FROM payments WHERE yoomoney_label = ? ORDER BY timestamp DESC LIMIT 1",
-                (label,),
-            )
-            row = cursor.fetchone()
+        payment = await db.get_payment_by_label(label)
 
-        if not row:
+        if not payment:
             logger.info(f"🔔 YooMoney webhook: payment not found for label={label} (op_id={operation_id})")
             return web.Response(status=200, text="ok")
 
-        payment = dict(row)
         payment_id = int(payment.get("id"))
         user_id = int(payment.get("user_id"))
         status = str(payment.get("status") or "")
@@ -121,18 +115,12 @@ async def _yoomoney_webhook_handler(request: web.Request) -> web.Response:
 
         if operation_id:
             try:
-                with sqlite3.connect(str(DB_PATH)) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "SELECT id FROM payments WHERE yoomoney_operation_id = ? AND status = 'confirmed' LIMIT 1",
-                        (operation_id,),
+                dup_payment_id = await db.get_payment_by_operation(operation_id)
+                if dup_payment_id:
+                    logger.warning(
+                        f"⚠️ YooMoney webhook op_id already used: op_id={operation_id} payment={dup_payment_id} current_payment={payment_id}"
                     )
-                    dup = cursor.fetchone()
-                    if dup:
-                        logger.warning(
-                            f"⚠️ YooMoney webhook op_id already used: op_id={operation_id} payment={dup[0]} current_payment={payment_id}"
-                        )
-                        return web.Response(status=200, text="ok")
+                    return web.Response(status=200, text="ok")
             except Exception as e:
                 logger.warning(f"⚠️ YooMoney webhook cannot check operation_id uniqueness: {e}")
 
@@ -141,16 +129,7 @@ async def _yoomoney_webhook_handler(request: web.Request) -> web.Response:
             logger.error(f"❌ YooMoney webhook failed to confirm payment_id={payment_id} (label={label})")
             return web.Response(status=200, text="ok")
 
-        try:
-            with sqlite3.connect(str(DB_PATH)) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE payments SET yoomoney_operation_id = ?, amount_received = ? WHERE id = ?",
-                    (operation_id or None, amount_received, payment_id),
-                )
-                conn.commit()
-        except Exception as e:
-            logger.warning(f"⚠️ YooMoney webhook could not store operation info for payment {payment_id}: {e}")
+        await db.set_payment_operation(payment_id, operation_id or None, amount_received)
 
         if bot_instance:
             try:
@@ -232,6 +211,57 @@ async def cleanup_old_pending_task() -> None:
     except Exception as e:
         logger.error(f"⚠️ Error in cleanup_old_pending_task: {e}", exc_info=True)
 
+async def db_maintenance_task() -> None:
+    """
+    Периодическое обслуживание SQLite: checkpoint WAL и PRAGMA optimize.
+    Заодно пишет в лог статистику кэша пользователей.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        result = await db.run_maintenance()
+        if result:
+            logger.info(
+                f"🗄️ WAL checkpoint: busy={result['busy']}, "
+                f"log_frames={result['log_frames']}, checkpointed={result['checkpointed_frames']}"
+            )
+        cache_stats = db.get_cache_stats()
+        logger.info(
+            f"🗄️ User cache: size={cache_stats['size']}, hits={cache_stats['hits']}, "
+            f"misses={cache_stats['misses']}, hit_rate={cache_stats['hit_rate']}%"
+        )
+    except Exception as e:
+        logger.error(f"⚠️ Error in db_maintenance_task: {e}", exc_info=True)
+
+async def db_backup_task() -> None:
+    """
+    Плановый бэкап базы данных с ротацией старых копий.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        await backup_manager.create_backup()
+    except Exception as e:
+        logger.error(f"⚠️ Error in db_backup_task: {e}", exc_info=True)
+
+async def archive_old_rows_task() -> None:
+    """
+    Переносит старые расклады и журнал активности в помесячные архивы (раз в день).
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        await db.archive_old_rows()
+    except Exception as e:
+        logger.error(f"⚠️ Error in archive_old_rows_task: {e}", exc_info=True)
+
+async def release_stale_holds_task() -> None:
+    """
+    Возвращает пользователям запросы, холды которых не закрылись (сбой посреди расклада).
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        await db.release_stale_holds()
+    except Exception as e:
+        logger.error(f"⚠️ Error in release_stale_holds_task: {e}", exc_info=True)
+
 async def check_yoomoney_payments() -> None:
     """
     Проверяет платежи через YooMoney и начисляет запросы.
@@ -509,18 +539,12 @@ async def check_yoomoney_payments() -> None:
 
             if operation_id and operation_id != "unknown":
                 try:
-                    with sqlite3.connect(str(DB_PATH)) as conn:
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "SELECT id FROM payments WHERE yoomoney_operation_id = ? AND status = 'confirmed' LIMIT 1",
-                            (operation_id,)
+                    dup_payment_id = await db.get_payment_by_operation(operation_id)
+                    if dup_payment_id:
+                        logger.warning(
+                            f"⚠️ Operation {operation_id} already used by payment {dup_payment_id}, skipping payment {pending_id}"
                         )
-                        dup = cursor.fetchone()
-                        if dup:
-                            logger.warning(
-                                f"⚠️ Operation {operation_id} already used by payment {dup[0]}, skipping payment {pending_id}"
-                            )
-                            continue
+                        continue
                 except Exception as e:
                     logger.warning(f"⚠️ Could not check operation_id uniqueness: {e}")
 
@@ -546,17 +570,10 @@ async def check_yoomoney_payments() -> None:
             logger.info(f"   Operation ID: {operation_id}, Amount: {operation_amount}")
             
             # Проверяем, не обработан ли уже этот платёж
-            with sqlite3.connect(str(DB_PATH)) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT status FROM payments WHERE id = ?",
-                    (pending_id,)
-                )
-                result = cursor.fetchone()
-                
-                if result and result[0] == "confirmed":
-                    logger.info(f"🔮 Payment {pending_id} already processed")
-                    continue
+            current_payment = await db.get_payment(pending_id)
+            if current_payment and current_payment["status"] == "confirmed":
+                logger.info(f"🔮 Payment {pending_id} already processed")
+                continue
             
             # Подтверждаем платёж и начисляем запросы строго из записи payments
             pending_requests = int(pending.get("requests", 0) or 0)
@@ -577,16 +594,7 @@ async def check_yoomoney_payments() -> None:
 
             if success:
                 # Пишем в платеж operation_id/amount_received, если в таблице есть колонки
-                try:
-                    with sqlite3.connect(str(DB_PATH)) as conn:
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "UPDATE payments SET yoomoney_operation_id = ?, amount_received = ? WHERE id = ?",
-                            (operation_id, operation_amount, pending_id)
-                        )
-                        conn.commit()
-                except Exception as e:
-                    logger.warning(f"⚠️ Could not store operation info for payment {pending_id}: {e}")
+                await db.set_payment_operation(pending_id, operation_id, operation_amount)
 
                 # Извлекаем package_key из label для логов
                 package_key = yoomoney_payment._extract_package_key_from_label(pending_label) or "unknown"
@@ -630,8 +638,19 @@ async def main() -> None:
     try:
         # Инициализируем базу данных
         db.init_db()
+        db.activity_log.start()
+        await db.load_rates()
+        await db.load_leaderboard()
         logger.info("🔮 Database initialized")
         
+        await ohmygpt_api.start()
+        
+        storage_settings = await db.get_storage_settings()
+        logger.info(
+            "🗄️ SQLite settings: "
+            + ", ".join(f"{name}={value}" for name, value in storage_settings.items())
+        )
+        
         # Создаем бота
         bot = Bot(
             token=BOT_TOKEN,
@@ -669,6 +688,17 @@ async def main() -> None:
             replace_existing=True
         )
         
+        # Повторная проверка чатов, недоступных для рассылок
+        scheduler.add_job(
+            reprobe_undeliverable_task,
+            trigger='cron',
+            hour=5,
+            minute=0,
+            kwargs={'bot': bot},
+            id='reprobe_undeliverable',
+            replace_existing=True
+        )
+        
         # Задача на проверку платежей YooMoney каждые 45 секунд
         scheduler.add_job(
             check_yoomoney_payments,
@@ -688,6 +718,43 @@ async def main() -> None:
             replace_existing=True
         )
         
+        # Задача на checkpoint WAL и PRAGMA optimize
+        scheduler.add_job(
+            db_maintenance_task,
+            trigger='interval',
+            minutes=DB_CHECKPOINT_INTERVAL_MINUTES,
+            id='db_maintenance',
+            replace_existing=True
+        )
+        
+        # Архивирование старых записей (раз в день, после очистки платежей)
+        scheduler.add_job(
+            archive_old_rows_task,
+            trigger='cron',
+            hour=4,
+            minute=0,
+            id='archive_old_rows',
+            replace_existing=True
+        )
+        
+        # Возврат зависших холдов запросов
+        scheduler.add_job(
+            release_stale_holds_task,
+            trigger='interval',
+            minutes=5,
+            id='release_stale_holds',
+            replace_existing=True
+        )
+        
+        # Плановый бэкап базы данных
+        scheduler.add_job(
+            db_backup_task,
+            trigger='interval',
+            minutes=BACKUP_INTERVAL_MINUTES,
+            id='db_backup',
+            replace_existing=True
+        )
+        
         # Запускаем планировщик
         scheduler.start()
         logger.info("⏰ Scheduler started with YooMoney payment checking")
@@ -718,6 +785,9 @@ async def main() -> None:
                 await webhook_runner.cleanup()
             except Exception:
                 pass
+        await ohmygpt_api.close()
+        await db.activity_log.stop()
+        db.close()
         logger.info("✨ Bot stopped")
 
 if __name__ == "__main__":
@@ -0,0 +1,681 @@
+"""
+migrations.py
+Версионированные миграции схемы базы данных на основе PRAGMA user_version.
+"""
+
+import logging
+import sqlite3
+import time
+from typing import Callable, List, Optional
+
+from compression import compress_text
+from storage import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки строк для миграций, переносящих данные
+MIGRATION_BATCH_SIZE: int = 5000
+
+
+class Migration:
+    """
+    Шаг миграции схемы.
+
+    apply выполняется одним вызовом pool.write_sync: изменения данных в нём
+    фиксируются вместе, но DDL (CREATE / ALTER / DROP) модуль sqlite3
+    выполняет вне транзакции, и каждая такая команда фиксируется сразу.
+    Поэтому apply должен быть идемпотентным (IF NOT EXISTS, _column_exists):
+    после сбоя посреди apply он выполняется повторно.
+
+    Если задан batch, он вызывается повторно с курсором (последним
+    обработанным id) и должен вернуть новый курсор или None, когда данных
+    больше нет. Каждая пачка — отдельная транзакция, курсор сохраняется
+    в schema_migration_state, поэтому прерванная миграция продолжается
+    с места остановки.
+
+    Пачками можно переносить только данные: CREATE INDEX по большой таблице
+    строится одной командой и держит блокировку записи всё время построения.
+    Миграции выполняются при запуске (Database.init_db) до начала обработки
+    апдейтов, поэтому такое построение приходится на перезапуск бота —
+    его стоит выкатывать в тихое время.
+
+    vacuum: после миграции выполнить VACUUM (если она освобождает много места).
+    VACUUM выполняется отдельно, вне транзакции.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        description: str,
+        apply: Optional[Callable[[sqlite3.Connection], None]] = None,
+        batch: Optional[Callable[[sqlite3.Connection, int], Optional[int]]] = None,
+        vacuum: bool = False
+    ) -> None:
+        self.version = version
+        self.description = description
+        self.apply = apply
+        self.batch = batch
+        self.vacuum = vacuum
+
+
+def _column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def _table_empty(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+
+# ==================== МИГРАЦИИ ====================
+
+def _v1_base_schema(conn: sqlite3.Connection) -> None:
+    """
+    Базовая схема. Идемпотентна: на существующей базе ничего не меняет.
+    """
+    cursor = conn.cursor()
+
+    # Таблица пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            requests_left INTEGER DEFAULT 3,
+            premium_requests INTEGER DEFAULT 1,
+            referral_id INTEGER,
+            referrals_count INTEGER DEFAULT 0,
+            last_free_request_time TEXT,
+            is_banned BOOLEAN DEFAULT FALSE,
+            ban_expires TEXT,
+            forbidden_attempts INTEGER DEFAULT 0,
+            agreed_rules BOOLEAN DEFAULT FALSE,
+            last_activity TEXT DEFAULT CURRENT_TIMESTAMP,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Таблица истории
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            question TEXT,
+            cards TEXT,
+            response TEXT,
+            reading_type TEXT DEFAULT 'classic',
+            is_premium BOOLEAN DEFAULT FALSE,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица платежей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            requests INTEGER,
+            status TEXT DEFAULT 'pending',
+            screenshot_id TEXT,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица отзывов
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS feedback (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            feedback TEXT,
+            rating INTEGER DEFAULT 5,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица реферальных начислений
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS referral_rewards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            reward_type TEXT,
+            amount INTEGER,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users(user_id),
+            FOREIGN KEY (referred_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица достижений пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_achievements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            achievement_name TEXT,
+            achievement_emoji TEXT,
+            description TEXT,
+            unlocked_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            UNIQUE(user_id, achievement_name)
+        )
+    """)
+
+    # Таблица уровней пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_levels (
+            user_id INTEGER PRIMARY KEY,
+            level INTEGER DEFAULT 1,
+            experience INTEGER DEFAULT 0,
+            total_readings INTEGER DEFAULT 0,
+            premium_readings INTEGER DEFAULT 0,
+            referrals_count INTEGER DEFAULT 0,
+            last_level_up TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица активности пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            activity_type TEXT,
+            details TEXT,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица статистики пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            total_readings INTEGER DEFAULT 0,
+            total_cards INTEGER DEFAULT 0,
+            total_words INTEGER DEFAULT 0,
+            favorite_reading_type TEXT,
+            most_used_cards TEXT,
+            reading_days_active INTEGER DEFAULT 0,
+            last_7_days_active INTEGER DEFAULT 0,
+            streak_days INTEGER DEFAULT 0,
+            last_streak_date TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Таблица тарифов
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rates (
+            package_key TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL,
+            price INTEGER NOT NULL,
+            label TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Индексы для оптимизации запросов
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_reading_type ON history(reading_type)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referral_id ON users(referral_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_user_id ON feedback(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_user_id ON user_activity(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_achievements_user_id ON user_achievements(user_id)")
+
+
+def _v2_payments_yoomoney(conn: sqlite3.Connection) -> None:
+    """
+    Колонки ЮMoney в payments и индексы по label / operation_id.
+    """
+    for column, column_type in (
+        ("yoomoney_label", "TEXT"),
+        ("admin_id", "INTEGER"),
+        ("yoomoney_operation_id", "TEXT"),
+        ("amount_received", "REAL"),
+    ):
+        if not _column_exists(conn, "payments", column):
+            conn.execute(f"ALTER TABLE payments ADD COLUMN {column} {column_type}")
+
+    # Уникальный индекс для yoomoney_label (только для не-NULL значений);
+    # если в старых данных есть дубликаты — обычный индекс
+    try:
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_yoomoney_label
+            ON payments(yoomoney_label)
+            WHERE yoomoney_label IS NOT NULL
+        """)
+    except (sqlite3.IntegrityError, sqlite3.OperationalError):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_yoomoney_label ON payments(yoomoney_label)")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_yoomoney_operation_id ON payments(yoomoney_operation_id)")
+
+
+def _v3_seed_rates(conn: sqlite3.Connection) -> None:
+    """
+    Начальные тарифы из config.PAYMENT_OPTIONS.
+    Новые пакеты, добавленные в конфиг позже, требуют отдельной миграции.
+    """
+    from config import PAYMENT_OPTIONS
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO rates (package_key, requests, price, label) VALUES (?, ?, ?, ?)",
+        [
+            (
+                package_key,
+                package_data["requests"],
+                package_data["price"],
+                package_data.get("label", f"{package_data['requests']} запросов ({package_data['price']} руб.)")
+            )
+            for package_key, package_data in PAYMENT_OPTIONS.items()
+        ]
+    )
+
+
+def _v4_activity_counters(conn: sqlite3.Connection) -> None:
+    """
+    Таблицы инкрементальных счётчиков раскладов.
+    """
+    # Дневные счётчики раскладов (инкрементально обновляются в add_history)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_daily_activity (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            readings INTEGER DEFAULT 0,
+            premium_readings INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
+
+    # Счётчики раскладов по типам
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_reading_types (
+            user_id INTEGER NOT NULL,
+            reading_type TEXT NOT NULL,
+            readings INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, reading_type)
+        ) WITHOUT ROWID
+    """)
+
+
+def _v4_backfill_counters(conn: sqlite3.Connection, last_id: int) -> Optional[int]:
+    """
+    Заполняет счётчики из history пачками по id.
+    """
+    # Счётчики уже заполнены ранее (база создана до появления миграций)
+    if last_id == 0 and not _table_empty(conn, "user_daily_activity"):
+        return None
+
+    upper_id = last_id + MIGRATION_BATCH_SIZE
+    max_id = conn.execute("SELECT MAX(id) FROM history").fetchone()[0]
+    if max_id is None or last_id >= max_id:
+        return None
+
+    conn.execute(
+        """
+        INSERT INTO user_daily_activity (user_id, day, readings, premium_readings)
+        SELECT user_id, DATE(timestamp), COUNT(*), SUM(CASE WHEN is_premium THEN 1 ELSE 0 END)
+        FROM history
+        WHERE id > ? AND id <= ? AND user_id IS NOT NULL AND timestamp IS NOT NULL
+        GROUP BY user_id, DATE(timestamp)
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            readings = readings + excluded.readings,
+            premium_readings = premium_readings + excluded.premium_readings
+        """,
+        (last_id, upper_id)
+    )
+    conn.execute(
+        """
+        INSERT INTO user_reading_types (user_id, reading_type, readings)
+        SELECT user_id, reading_type, COUNT(*)
+        FROM history
+        WHERE id > ? AND id <= ? AND user_id IS NOT NULL AND reading_type IS NOT NULL
+        GROUP BY user_id, reading_type
+        ON CONFLICT(user_id, reading_type) DO UPDATE SET readings = readings + excluded.readings
+        """,
+        (last_id, upper_id)
+    )
+    return upper_id
+
+
+def _v5_history_keyset_index(conn: sqlite3.Connection) -> None:
+    """
+    Составной индекс для keyset-пагинации истории.
+    Одиночный индекс по user_id им перекрывается и удаляется.
+
+    Построение индекса пачками не разбить: CREATE INDEX читает всю history
+    одной командой (см. Migration). На больших базах выкатывать в тихое время.
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id_id ON history(user_id, id DESC)")
+    conn.execute("DROP INDEX IF EXISTS idx_history_user_id")
+
+
+def _v6_history_responses(conn: sqlite3.Connection) -> None:
+    """
+    Отдельная таблица для сжатых текстов раскладов.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_responses (
+            history_id INTEGER PRIMARY KEY,
+            dictionary INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )
+    """)
+
+
+def _v6_compress_responses(conn: sqlite3.Connection, last_id: int) -> Optional[int]:
+    """
+    Переносит history.response в history_responses в сжатом виде.
+    """
+    rows = conn.execute(
+        """
+        SELECT id, response FROM history
+        WHERE id > ? AND response IS NOT NULL
+        ORDER BY id
+        LIMIT ?
+        """,
+        (last_id, MIGRATION_BATCH_SIZE)
+    ).fetchall()
+    if not rows:
+        return None
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO history_responses (history_id, dictionary, body) VALUES (?, ?, ?)",
+        [(row[0], *compress_text(row[1])) for row in rows]
+    )
+    conn.executemany(
+        "UPDATE history SET response = NULL WHERE id = ?",
+        [(row[0],) for row in rows]
+    )
+    return rows[-1][0]
+
+
+def _v7_archive_index(conn: sqlite3.Connection) -> None:
+    """
+    Учёт помесячных архивов history / user_activity (см. archive.py).
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive_months (
+            month TEXT PRIMARY KEY,
+            min_history_id INTEGER,
+            max_history_id INTEGER,
+            history_rows INTEGER DEFAULT 0,
+            activity_rows INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_archive_index (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            readings INTEGER DEFAULT 0,
+            min_id INTEGER,
+            max_id INTEGER,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    """)
+
+
+def _v8_credit_ledger(conn: sqlite3.Connection) -> None:
+    """
+    Журнал списаний запросов: холд при старте расклада, затем списание или возврат.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS credit_ledger (
+            reading_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('free', 'premium')),
+            state TEXT NOT NULL DEFAULT 'held' CHECK (state IN ('held', 'captured', 'refunded')),
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_credit_ledger_state ON credit_ledger(state, created_at)")
+
+
+def _v9_referral_stats(conn: sqlite3.Connection) -> None:
+    """
+    Материализованная статистика реферальной программы по пригласившему.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_stats (
+            referrer_id INTEGER PRIMARY KEY,
+            referrals_count INTEGER DEFAULT 0,
+            active_referrals INTEGER DEFAULT 0,
+            premium_referrals INTEGER DEFAULT 0,
+            total_referral_readings INTEGER DEFAULT 0,
+            total_bonuses INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_referral_rewards_referrer_id ON referral_rewards(referrer_id)")
+
+
+def _v9_backfill_referral_stats(conn: sqlite3.Connection, last_id: int) -> Optional[int]:
+    """
+    Заполняет referral_stats из счётчиков приглашённых пачками по referrer_id.
+    """
+    referrers = conn.execute(
+        """
+        SELECT DISTINCT referral_id FROM users
+        WHERE referral_id > ?
+        ORDER BY referral_id
+        LIMIT ?
+        """,
+        (last_id, MIGRATION_BATCH_SIZE)
+    ).fetchall()
+    if not referrers:
+        return None
+
+    upper_id = referrers[-1][0]
+    # Счётчики user_stats / user_levels учитывают и заархивированные расклады
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO referral_stats
+            (referrer_id, referrals_count, active_referrals, premium_referrals,
+             total_referral_readings, total_bonuses)
+        SELECT
+            u.referral_id,
+            COUNT(*),
+            SUM(CASE WHEN COALESCE(us.total_readings, 0) > 0 THEN 1 ELSE 0 END),
+            SUM(CASE WHEN COALESCE(ul.premium_readings, 0) > 0 THEN 1 ELSE 0 END),
+            COALESCE(SUM(us.total_readings), 0),
+            0
+        FROM users u
+        LEFT JOIN user_stats us ON us.user_id = u.user_id
+        LEFT JOIN user_levels ul ON ul.user_id = u.user_id
+        WHERE u.referral_id > ? AND u.referral_id <= ?
+        GROUP BY u.referral_id
+        """,
+        (last_id, upper_id)
+    )
+    conn.execute(
+        """
+        UPDATE referral_stats SET total_bonuses = (
+            SELECT COALESCE(SUM(amount), 0) FROM referral_rewards WHERE referrer_id = referral_stats.referrer_id
+        )
+        WHERE referrer_id > ? AND referrer_id <= ?
+        """,
+        (last_id, upper_id)
+    )
+    return upper_id
+
+
+def _v10_job_checkpoints(conn: sqlite3.Connection) -> None:
+    """
+    Контрольные точки фоновых задач: прерванный запуск продолжается с last_id.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_checkpoints (
+            job TEXT NOT NULL,
+            run_key TEXT NOT NULL,
+            last_id INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            started_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT,
+            PRIMARY KEY (job, run_key)
+        )
+    """)
+
+
+def _v11_delivery_status(conn: sqlite3.Connection) -> None:
+    """
+    Статус доставки сообщений пользователю: NULL — доставляется,
+    'blocked' / 'not_found' — рассылки его пропускают до повторной проверки.
+    """
+    for column in ("delivery_status", "delivery_failed_at"):
+        if not _column_exists(conn, "users", column):
+            conn.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT")
+
+    # Аудитория рассылок: частичный индекс только по доступным пользователям
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_deliverable
+        ON users(user_id)
+        WHERE is_banned = FALSE AND delivery_status IS NULL
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_undeliverable
+        ON users(delivery_failed_at)
+        WHERE delivery_status IS NOT NULL
+    """)
+
+
+def _v12_audience_indexes(conn: sqlite3.Connection) -> None:
+    """
+    Индексы сегментов аудитории: активность среди доступных чатов
+    и подтверждённые платежи пользователя.
+    """
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_last_activity
+        ON users(last_activity)
+        WHERE is_banned = FALSE AND delivery_status IS NULL
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments(user_id, status)")
+
+
+def _v13_activity_timestamp_index(conn: sqlite3.Connection) -> None:
+    """
+    Индекс по времени журнала активности: архивирование выбирает старые
+    строки по диапазону timestamp, а не полным сканированием с сортировкой.
+    Строится одной командой (см. Migration).
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_timestamp ON user_activity(timestamp)")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base schema", apply=_v1_base_schema),
+    Migration(2, "yoomoney payment columns", apply=_v2_payments_yoomoney),
+    Migration(3, "seed rates", apply=_v3_seed_rates),
+    Migration(4, "reading activity counters", apply=_v4_activity_counters, batch=_v4_backfill_counters),
+    Migration(5, "history keyset index", apply=_v5_history_keyset_index),
+    Migration(
+        6, "compressed history responses",
+        apply=_v6_history_responses, batch=_v6_compress_responses, vacuum=True
+    ),
+    Migration(7, "history archive index", apply=_v7_archive_index),
+    Migration(8, "credit ledger", apply=_v8_credit_ledger),
+    Migration(9, "referral stats", apply=_v9_referral_stats, batch=_v9_backfill_referral_stats),
+    Migration(10, "job checkpoints", apply=_v10_job_checkpoints),
+    Migration(11, "delivery status", apply=_v11_delivery_status),
+    Migration(12, "audience indexes", apply=_v12_audience_indexes),
+    Migration(13, "activity timestamp index", apply=_v13_activity_timestamp_index),
+]
+
+LATEST_VERSION: int = MIGRATIONS[-1].version
+
+# ==================== ЗАПУСК ====================
+
+def _get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _run_batches(pool: SQLitePool, migration: Migration) -> int:
+    """
+    Выполняет пакетную часть миграции, сохраняя курсор после каждой пачки.
+
+    Returns:
+        Количество обработанных пачек
+    """
+    def load_cursor(conn: sqlite3.Connection) -> int:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migration_state (
+                version INTEGER PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            )
+        """)
+        row = conn.execute(
+            "SELECT last_id FROM schema_migration_state WHERE version = ?",
+            (migration.version,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def run_batch(conn: sqlite3.Connection, last_id: int) -> Optional[int]:
+        next_id = migration.batch(conn, last_id)
+        if next_id is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO schema_migration_state (version, last_id) VALUES (?, ?)",
+                (migration.version, next_id)
+            )
+        return next_id
+
+    last_id = pool.write_sync(load_cursor)
+    batches = 0
+    while True:
+        # Каждая пачка — отдельная транзакция: блокировка записи отпускается между пачками
+        next_id = pool.write_sync(lambda conn: run_batch(conn, last_id))
+        if next_id is None:
+            break
+        last_id = next_id
+        batches += 1
+
+    if batches:
+        logger.info(f"🗄️ Migration {migration.version}: processed {batches} batches")
+    return batches
+
+
+def run_migrations(pool: SQLitePool) -> int:
+    """
+    Применяет недостающие миграции по порядку.
+
+    Если схема актуальна, выполняется только чтение PRAGMA user_version.
+
+    Returns:
+        Версия схемы после применения миграций
+    """
+    current = pool.write_sync(_get_version)
+    if current >= LATEST_VERSION:
+        return current
+
+    logger.info(f"🗄️ Database schema version {current}, migrating to {LATEST_VERSION}")
+
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+
+        started_at = time.monotonic()
+        if migration.apply:
+            pool.write_sync(migration.apply)
+        batches = _run_batches(pool, migration) if migration.batch else 0
+
+        def finish(conn: sqlite3.Connection) -> None:
+            if migration.batch:
+                conn.execute("DELETE FROM schema_migration_state WHERE version = ?", (migration.version,))
+            conn.execute(f"PRAGMA user_version = {migration.version}")
+
+        pool.write_sync(finish)
+        current = migration.version
+        logger.info(
+            f"🗄️ Applied migration {migration.version}: {migration.description} "
+            f"in {time.monotonic() - started_at:.1f}s"
+        )
+
+        if migration.vacuum and batches:
+            # VACUUM нельзя выполнить внутри транзакции; pool.write_sync её не открывает
+            pool.write_sync(lambda conn: conn.execute("VACUUM"))
+            logger.info(f"🗄️ Database vacuumed after migration {migration.version}")
+
+    return current
@@ -0,0 +1,306 @@
+"""
+model_router.py
+Выбор модели ИИ по задержке и ошибкам с автоматическим выключателем (circuit breaker).
+"""
+
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from config import (
+    OHMYGPT_MODEL, OHMYGPT_FALLBACK_MODELS,
+    ROUTER_WINDOW, ROUTER_MIN_SAMPLES, ROUTER_ERROR_THRESHOLD, ROUTER_CONSECUTIVE_FAILURES,
+    ROUTER_OPEN_SECONDS, ROUTER_MAX_OPEN_SECONDS, ROUTER_PROBE_SHARE,
+    HEDGE_BUDGET, HEDGE_BUDGET_WINDOW_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# Состояния выключателя
+CLOSED: str = "closed"
+OPEN: str = "open"
+HALF_OPEN: str = "half_open"
+
+# Пробный запрос без результата дольше этого (секунды) считается потерянным
+PROBE_STALE_SECONDS: float = 180.0
+
+
+class ModelHealth:
+    """
+    Скользящее окно последних window результатов модели и её выключатель.
+
+    Выключатель размыкается (модель не получает трафик), когда в окне
+    не меньше min_samples результатов и доля ошибок и таймаутов
+    достигает error_threshold, или подряд consecutive_failures неудач.
+    Через open_seconds модель становится half_open: ей уходит один
+    пробный запрос. Успех замыкает выключатель, неудача размыкает его
+    снова на вдвое больший срок (не больше max_open_seconds). Результаты
+    остальных запросов (начатых до размыкания) попадают в окно, но
+    состояние разомкнутого выключателя не меняют.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        window: int = ROUTER_WINDOW,
+        min_samples: int = ROUTER_MIN_SAMPLES,
+        error_threshold: float = ROUTER_ERROR_THRESHOLD,
+        consecutive_failures: int = ROUTER_CONSECUTIVE_FAILURES,
+        open_seconds: float = ROUTER_OPEN_SECONDS,
+        max_open_seconds: float = ROUTER_MAX_OPEN_SECONDS
+    ) -> None:
+        self.model: str = model
+        self.min_samples: int = min_samples
+        self.error_threshold: float = error_threshold
+        self.consecutive_failures: int = consecutive_failures
+        self.base_open_seconds: float = open_seconds
+        self.max_open_seconds: float = max_open_seconds
+        # (успех, таймаут, задержка в секундах)
+        self.results: Deque[Tuple[bool, bool, float]] = deque(maxlen=window)
+        self.failures_in_row: int = 0
+        self.state: str = CLOSED
+        self.open_seconds: float = open_seconds
+        self.opened_until: float = 0.0
+        self.probe_started: Optional[float] = None
+        self.requests: int = 0
+
+    def current_state(self, now: Optional[float] = None) -> str:
+        if self.state == OPEN and (now or time.monotonic()) >= self.opened_until:
+            self.state = HALF_OPEN
+        return self.state
+
+    def start(self) -> bool:
+        """
+        Отмечает начало запроса. Возвращает True, если это пробный запрос
+        half_open-модели (он один за раз).
+        """
+        now = time.monotonic()
+        if self.current_state(now) == HALF_OPEN and not self.probing(now):
+            self.probe_started = now
+            return True
+        return False
+
+    def record(self, ok: bool, latency: float, timeout: bool = False, probe: bool = False) -> None:
+        self.requests += 1
+        self.results.append((ok, timeout, latency))
+        if probe:
+            self.probe_started = None
+        state = self.current_state()
+        if ok:
+            self.failures_in_row = 0
+            # Запросы, начатые до размыкания, выключатель не замыкают — только проба
+            if probe and state == HALF_OPEN:
+                logger.info(f"✅ Model {self.model} recovered, circuit closed")
+                # Ошибки до размыкания не должны сразу разомкнуть его снова
+                self.results.clear()
+                self.results.append((ok, timeout, latency))
+                self.state = CLOSED
+                self.open_seconds = self.base_open_seconds
+            return
+
+        self.failures_in_row += 1
+        if probe and state == HALF_OPEN:
+            # Пробный запрос не прошёл: размыкаем на больший срок
+            self._open(min(self.open_seconds * 2, self.max_open_seconds))
+        elif state == CLOSED and self._tripped():
+            self._open(self.open_seconds)
+
+    def _tripped(self) -> bool:
+        if self.failures_in_row >= self.consecutive_failures:
+            return True
+        return len(self.results) >= self.min_samples and self.error_rate >= self.error_threshold
+
+    def _open(self, seconds: float) -> None:
+        self.state = OPEN
+        self.open_seconds = seconds
+        self.opened_until = time.monotonic() + seconds
+        logger.warning(
+            f"⚠️ Model {self.model} circuit opened for {seconds:.0f}s "
+            f"(error rate {self.error_rate:.0%}, {self.failures_in_row} failures in a row)"
+        )
+
+    def abandon(self, probe: bool) -> None:
+        """
+        Запрос отменён без результата: снимает отметку пробы, не считая неудачей.
+        """
+        if probe:
+            self.probe_started = None
+
+    def probing(self, now: float) -> bool:
+        return self.probe_started is not None and now - self.probe_started < PROBE_STALE_SECONDS
+
+    @property
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(1 for ok, _, _ in self.results if not ok) / len(self.results)
+
+    @property
+    def timeout_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(1 for _, timeout, _ in self.results if timeout) / len(self.results)
+
+    @property
+    def latency(self) -> Optional[float]:
+        """
+        Медиана задержки успешных запросов окна (None — данных нет).
+        """
+        return self.latency_percentile(0.5, min_samples=1)
+
+    def latency_percentile(self, q: float, min_samples: Optional[int] = None) -> Optional[float]:
+        """
+        Перцентиль q (0..1) задержки успешных запросов окна
+        (None, если успешных меньше min_samples).
+        """
+        latencies = sorted(latency for ok, _, latency in self.results if ok)
+        if not latencies or len(latencies) < (min_samples if min_samples is not None else self.min_samples):
+            return None
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def snapshot(self) -> Dict[str, Any]:
+        state = self.current_state()
+        return {
+            "model": self.model,
+            "state": state,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "timeout_rate": self.timeout_rate,
+            "samples": len(self.results),
+            "requests": self.requests,
+            "reopens_in": max(self.opened_until - time.monotonic(), 0.0) if state == OPEN else 0.0,
+        }
+
+
+class ModelRouter:
+    """
+    Порядок моделей для запроса: сначала самая быстрая из исправных
+    (по медиане задержки; модели без данных — в порядке конфигурации),
+    затем остальные исправные, затем half_open. Разомкнутые модели не
+    используются, пока не истечёт срок.
+
+    Восстановившейся (half_open) модели уходит пробный запрос с
+    вероятностью probe_share — по одному за раз; если исправных моделей
+    нет совсем, пробуются half_open без ожидания.
+    """
+
+    def __init__(self, models: Iterable[str], probe_share: float = ROUTER_PROBE_SHARE) -> None:
+        self.models: Dict[str, ModelHealth] = {model: ModelHealth(model) for model in models}
+        self._order: List[str] = list(self.models)
+        self.probe_share: float = probe_share
+
+    def candidates(self, exclude: Iterable[str] = ()) -> List[str]:
+        """
+        Модели в порядке попыток для одного запроса (без exclude).
+        """
+        now = time.monotonic()
+        excluded = set(exclude)
+        healthy: List[ModelHealth] = []
+        recovering: List[ModelHealth] = []
+        for model in self._order:
+            if model in excluded:
+                continue
+            health = self.models[model]
+            state = health.current_state(now)
+            if state == CLOSED:
+                healthy.append(health)
+            elif state == HALF_OPEN and not health.probing(now):
+                recovering.append(health)
+
+        # Быстрые с данными раньше, без данных — в порядке конфигурации после них
+        healthy.sort(key=lambda health: (health.latency is None, health.latency or 0.0))
+        ordered = [health.model for health in healthy]
+
+        probe = recovering[0] if recovering and (not healthy or random.random() < self.probe_share) else None
+        if probe is not None:
+            ordered.insert(0, probe.model)
+            recovering = recovering[1:]
+        return ordered + [health.model for health in recovering]
+
+    def start(self, model: str) -> bool:
+        """
+        Отмечает начало запроса к модели.
+
+        Returns:
+            True, если это пробный запрос half_open-модели; флаг передаётся
+            в record / abandon этого запроса
+        """
+        return self.models[model].start()
+
+    def record(self, model: str, ok: bool, latency: float, timeout: bool = False, probe: bool = False) -> None:
+        """
+        Результат запроса к модели. Для потоковых ответов latency — время до первого фрагмента.
+        """
+        self.models[model].record(ok, latency, timeout, probe)
+
+    def abandon(self, model: str, probe: bool) -> None:
+        """
+        Запрос отменён (проиграл хеджу, поток закрыт раньше времени) — результата нет.
+        """
+        self.models[model].abandon(probe)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        Состояние моделей для админ-панели.
+        """
+        return [self.models[model].snapshot() for model in self._order]
+
+
+class HedgeBudget:
+    """
+    Доля дублирующих (хедж) запросов: за последние window_seconds секунд
+    хеджей не больше ratio от числа запросов.
+    """
+
+    def __init__(self, ratio: float = HEDGE_BUDGET, window_seconds: float = HEDGE_BUDGET_WINDOW_SECONDS) -> None:
+        self.ratio: float = ratio
+        self.window_seconds: float = window_seconds
+        self._requests: Deque[float] = deque()
+        self._hedges: Deque[float] = deque()
+        self.hedges_total: int = 0
+        self.hedge_wins: int = 0
+        self.denied: int = 0
+
+    def _trim(self, now: float) -> None:
+        for events in (self._requests, self._hedges):
+            while events and now - events[0] > self.window_seconds:
+                events.popleft()
+
+    def request(self) -> None:
+        """
+        Учитывает запрос к ИИ (один раз на расклад, без повторов).
+        """
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def try_hedge(self) -> bool:
+        """
+        Забирает хедж из бюджета, если он ещё есть.
+        """
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._hedges) + 1 > self.ratio * len(self._requests):
+            self.denied += 1
+            return False
+        self._hedges.append(now)
+        self.hedges_total += 1
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._trim(time.monotonic())
+        return {
+            "requests": len(self._requests),
+            "hedges": len(self._hedges),
+            "share": len(self._hedges) / len(self._requests) if self._requests else 0.0,
+            "hedges_total": self.hedges_total,
+            "hedge_wins": self.hedge_wins,
+            "denied": self.denied,
+        }
+
+
+# Глобальные экземпляры
+model_router = ModelRouter(dict.fromkeys([OHMYGPT_MODEL, *OHMYGPT_FALLBACK_MODELS]))
+hedge_budget = HedgeBudget()
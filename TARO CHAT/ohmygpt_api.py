@@ -1,20 +1,169 @@
 import httpx
 import asyncio
+import importlib.util
 import json
 import logging
-from typing import Any, Dict, List, Optional
-
-from config import OHMYGPT_API_KEY, OHMYGPT_API_URL, OHMYGPT_MODEL, OHMYGPT_FALLBACK_MODELS
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from config import (
+    OHMYGPT_API_KEY, OHMYGPT_API_URL, OHMYGPT_MODEL, OHMYGPT_FALLBACK_MODELS,
+    OHMYGPT_HTTP2, OHMYGPT_MAX_CONNECTIONS, OHMYGPT_MAX_KEEPALIVE, OHMYGPT_KEEPALIVE_EXPIRY,
+    OHMYGPT_CONNECT_TIMEOUT, OHMYGPT_READ_TIMEOUT, OHMYGPT_POOL_TIMEOUT,
+    OHMYGPT_MAX_RETRIES, HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_DELAY
+)
 from utils import get_cards_description
+from model_router import model_router, hedge_budget
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+class OhMyGPTError(Exception):
+    """
+    Неуспешный ответ OhMyGPT (статус не 200).
+    """
+
 class OhMyGPTAPI:
+    """
+    Клиент OhMyGPT с одним долгоживущим httpx.AsyncClient на весь процесс:
+    соединения (DNS, TCP, TLS) переиспользуются между раскладами и повторами,
+    по HTTP/2 запросы мультиплексируются в одном соединении.
+
+    Клиент открывается start() при запуске бота и закрывается close()
+    при остановке; если start() не вызывали, он создаётся при первом запросе.
+    """
+
     def __init__(self):
         self.api_key = OHMYGPT_API_KEY
         self.base_url = OHMYGPT_API_URL
         self.default_model = OHMYGPT_MODEL
         self.fallback_models = OHMYGPT_FALLBACK_MODELS
+        self._client: Optional[httpx.AsyncClient] = None
+        # Метрики пула: запросы в полёте, пик, всего запросов и ошибок соединения
+        self.in_flight: int = 0
+        self.peak_in_flight: int = 0
+        self.requests_total: int = 0
+        self.transport_errors: int = 0
+        self.http_versions: Dict[str, int] = {}
+    
+    async def start(self) -> None:
+        """
+        Открывает общий HTTP-клиент.
+        """
+        if self._client is not None and not self._client.is_closed:
+            return
+        
+        # HTTP/2 требует пакет h2 (httpx[http2]); без него работаем по HTTP/1.1 с keep-alive
+        http2 = OHMYGPT_HTTP2 and importlib.util.find_spec("h2") is not None
+        if OHMYGPT_HTTP2 and not http2:
+            logger.warning("⚠️ Пакет h2 не установлен, клиент OhMyGPT работает по HTTP/1.1")
+        
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(
+                OHMYGPT_READ_TIMEOUT,
+                connect=OHMYGPT_CONNECT_TIMEOUT,
+                pool=OHMYGPT_POOL_TIMEOUT
+            ),
+            limits=httpx.Limits(
+                max_connections=OHMYGPT_MAX_CONNECTIONS,
+                max_keepalive_connections=OHMYGPT_MAX_KEEPALIVE,
+                keepalive_expiry=OHMYGPT_KEEPALIVE_EXPIRY
+            ),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.api_key}"
+            }
+        )
+        logger.info(
+            f"🌐 Клиент OhMyGPT запущен (http2={http2}, max_connections={OHMYGPT_MAX_CONNECTIONS})"
+        )
+    
+    async def close(self) -> None:
+        """
+        Закрывает общий HTTP-клиент и его соединения.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            await self.start()
+        return self._client
+    
+    async def _post(self, data: Dict[str, Any]) -> httpx.Response:
+        """
+        POST в OhMyGPT через общий клиент с учётом метрик пула.
+        """
+        client = await self._get_client()
+        self._request_started()
+        try:
+            response = await client.post(self.base_url, json=data)
+        except httpx.TransportError:
+            self.transport_errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self._count_version(response)
+        return response
+    
+    async def _stream(self, data: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        POST с "stream": true: разбирает SSE-строки «data: {...}» и отдаёт
+        фрагменты текста из choices[].delta.content до «data: [DONE]».
+        """
+        client = await self._get_client()
+        self._request_started()
+        try:
+            async with client.stream("POST", self.base_url, json=data) as response:
+                self._count_version(response)
+                if response.status_code != 200:
+                    body = (await response.aread())[:200].decode("utf-8", "replace")
+                    raise OhMyGPTError(f"Статус: {response.status_code}, Тело: {body}")
+                
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        return
+                    try:
+                        chunk = json.loads(payload)
+                    except ValueError:
+                        continue
+                    for choice in chunk.get("choices") or []:
+                        delta = (choice.get("delta") or {}).get("content")
+                        if delta:
+                            yield delta
+        except httpx.TransportError:
+            self.transport_errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+    
+    def _request_started(self) -> None:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.requests_total += 1
+    
+    def _count_version(self, response: httpx.Response) -> None:
+        self.http_versions[response.http_version] = self.http_versions.get(response.http_version, 0) + 1
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """
+        Метрики пула соединений: in_flight, peak_in_flight, utilization (доля
+        от max_connections), requests_total, transport_errors, http_versions.
+        """
+        return {
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "utilization": self.in_flight / OHMYGPT_MAX_CONNECTIONS if OHMYGPT_MAX_CONNECTIONS else 0.0,
+            "requests_total": self.requests_total,
+            "transport_errors": self.transport_errors,
+            "http_versions": dict(self.http_versions),
+        }
         
     async def get_tarot_response(
         self,
@@ -28,16 +177,287 @@ class OhMyGPTAPI:
     ) -> Optional[Dict[str, Any]]:
         """
         Получает ответ от OhMyGPT API для Таро-расклада.
+        Медленный запрос дублируется в следующую модель (см. _hedged).
         """
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        data = self._build_request(question, cards, is_premium, full_history, reading_type, stream=False)
+        
+        max_retries = OHMYGPT_MAX_RETRIES
+        retry_delay = 2
+        
+        # База бюджета хеджей — расклады, а не попытки
+        hedge_budget.request()
+        tried: List[str] = []
+        for attempt in range(max_retries):
+            model = self._next_model(tried)
+            try:
+                model, response_json = await self._hedged(lambda candidate: self._complete(data, candidate), model, tried)
+                logger.info(f"🔮 Ответ получен для пользователя {user_id} от {model}: {question[:50]}...")
+                return response_json
+                
+            except OhMyGPTError as e:
+                logger.error(f"⚠️ Ошибка API для пользователя {user_id} попытка {attempt + 1}: {e}")
+                
+            except httpx.TimeoutException:
+                logger.error(f"⚠️ Таймаут для пользователя {user_id} попытка {attempt + 1}")
+                    
+            except Exception as e:
+                logger.error(f"⚠️ Общая ошибка для пользователя {user_id} попытка {attempt + 1}: {str(e)}")
+            
+            await self._retry_pause(attempt, max_retries, tried, retry_delay)
+        
+        return None
+    
+    async def stream_tarot_response(
+        self,
+        question: str,
+        cards: List[str],
+        is_premium: bool,
+        full_history: str,
+        user_id: int,
+        username: str,
+        reading_type: str = None
+    ) -> AsyncIterator[str]:
+        """
+        Потоковый ответ для Таро-расклада: отдаёт фрагменты текста по мере генерации.
+        
+        Пока не получено ни одного фрагмента, ошибки повторяются с переключением
+        на резервные модели (как в get_tarot_response); если ответа так и нет,
+        поток завершается пустым. Обрыв посреди ответа поднимает исключение —
+        начало ответа пользователь уже видит. Если первый фрагмент задерживается,
+        поток открывается и у следующей модели (см. _hedged).
+        """
+        data = self._build_request(question, cards, is_premium, full_history, reading_type, stream=True)
+        
+        max_retries = OHMYGPT_MAX_RETRIES
+        retry_delay = 2
+        
+        # База бюджета хеджей — расклады, а не попытки
+        hedge_budget.request()
+        tried: List[str] = []
+        for attempt in range(max_retries):
+            model = self._next_model(tried)
+            started_at = time.monotonic()
+            try:
+                model, (stream, first_chunk, first_chunk_after, probe) = await self._hedged(
+                    lambda candidate: self._open_stream(data, candidate), model, tried, discard=self._close_stream
+                )
+            except OhMyGPTError as e:
+                logger.error(f"⚠️ Ошибка API для пользователя {user_id} попытка {attempt + 1}: {e}")
+                await self._retry_pause(attempt, max_retries, tried, retry_delay)
+                continue
+            except Exception as e:
+                logger.error(f"⚠️ Общая ошибка потока для пользователя {user_id} попытка {attempt + 1}: {str(e)}")
+                await self._retry_pause(attempt, max_retries, tried, retry_delay)
+                continue
+            
+            # Первый фрагмент получен: дальше без повторов, обрыв поднимает исключение
+            finished = False
+            try:
+                yield first_chunk
+                async for delta in stream:
+                    yield delta
+                # Для выбора модели важна задержка до первого фрагмента
+                finished = True
+                model_router.record(model, True, first_chunk_after, probe=probe)
+            except Exception as e:
+                finished = True
+                timeout = isinstance(e, httpx.TimeoutException)
+                model_router.record(model, False, time.monotonic() - started_at, timeout=timeout, probe=probe)
+                raise
+            finally:
+                if not finished:
+                    # Поток закрыли раньше конца ответа — результата нет
+                    model_router.abandon(model, probe)
+                await stream.aclose()
+            
+            logger.info(f"🔮 Потоковый ответ получен для пользователя {user_id} от {model}: {question[:50]}...")
+            return
+    
+    async def _complete(self, data: Dict[str, Any], model: str) -> Dict[str, Any]:
+        """
+        Один запрос без потока к модели model; результат учитывается в model_router.
+        
+        Raises:
+            OhMyGPTError: статус не 200 или в ответе нет choices
+        """
+        probe = model_router.start(model)
+        started_at = time.monotonic()
+        try:
+            response = await self._post(dict(data, model=model))
+            
+            if response.status_code == 200:
+                response_json = response.json()
+                if 'choices' in response_json and response_json['choices']:
+                    model_router.record(model, True, time.monotonic() - started_at, probe=probe)
+                    return response_json
+                raise OhMyGPTError(f"{model}: нет choices в ответе")
+            
+            error_msg = f"{model}: статус {response.status_code}"
+            try:
+                error_data = response.json()
+                error_msg += f", ошибка: {error_data.get('error', {}).get('message', 'Неизвестно')}"
+            except:
+                error_msg += f", тело: {response.text[:100]}"
+            raise OhMyGPTError(error_msg)
+            
+        except Exception as e:
+            timeout = isinstance(e, httpx.TimeoutException)
+            model_router.record(model, False, time.monotonic() - started_at, timeout=timeout, probe=probe)
+            raise
+        except BaseException:
+            # Проиграл хеджу (отмена) — результата нет, но проба освобождается
+            model_router.abandon(model, probe)
+            raise
+    
+    async def _open_stream(self, data: Dict[str, Any], model: str) -> Tuple[AsyncIterator[str], str, float, bool]:
+        """
+        Открывает поток к модели model и ждёт первого фрагмента.
+        Ошибка до первого фрагмента учитывается в model_router.
+        
+        Returns:
+            (поток с оставшимися фрагментами, первый фрагмент, секунд до него,
+            пробный ли это запрос — для model_router.record / abandon)
+        """
+        probe = model_router.start(model)
+        started_at = time.monotonic()
+        stream = self._stream(dict(data, model=model))
+        try:
+            first_chunk = await stream.__anext__()
+        except StopAsyncIteration:
+            model_router.record(model, False, time.monotonic() - started_at, probe=probe)
+            raise OhMyGPTError(f"{model}: пустой ответ")
+        except Exception as e:
+            timeout = isinstance(e, httpx.TimeoutException)
+            model_router.record(model, False, time.monotonic() - started_at, timeout=timeout, probe=probe)
+            raise
+        except BaseException:
+            # Проиграл хеджу: закрываем соединение, проба освобождается
+            model_router.abandon(model, probe)
+            await stream.aclose()
+            raise
+        return stream, first_chunk, time.monotonic() - started_at, probe
+    
+    @staticmethod
+    async def _close_stream(model: str, opened: Tuple[AsyncIterator[str], str, float, bool]) -> None:
+        model_router.abandon(model, opened[3])
+        await opened[0].aclose()
+    
+    async def _hedged(
+        self,
+        request: Callable[[str], Awaitable[T]],
+        model: str,
+        tried: List[str],
+        discard: Optional[Callable[[str, T], Awaitable[None]]] = None
+    ) -> Tuple[str, T]:
+        """
+        Выполняет request(model) с хеджированием: если за HEDGE_PERCENTILE
+        недавних задержек модели ответа нет, тот же запрос уходит в следующую
+        модель (если позволяет бюджет hedge_budget), берётся первый успешный
+        ответ, второй запрос отменяется (лишний успешный — закрывается
+        discard(модель, результат)).
         
+        Returns:
+            (модель, ответившая первой, её результат)
+        """
+        primary = asyncio.create_task(request(model))
+        delay = self._hedge_delay(model)
+        if delay is None:
+            return model, await primary
+        
+        tasks: Dict[asyncio.Task, str] = {primary: model}
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            hedge_model = None
+            if not done:
+                hedge_model = next(iter(model_router.candidates(exclude=tried)), None)
+            if hedge_model is None or not hedge_budget.try_hedge():
+                return model, await primary
+            
+            tried.append(hedge_model)
+            logger.info(f"🪁 {model} не ответила за {delay:.1f} с, дублирую запрос в {hedge_model}")
+            tasks[asyncio.create_task(request(hedge_model))] = hedge_model
+            
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    error = next(iter(done)).exception()
+                    continue
+                
+                winner = winners[0]
+                for extra in winners[1:]:
+                    if discard is not None:
+                        await discard(tasks[extra], extra.result())
+                if tasks[winner] == hedge_model:
+                    hedge_budget.hedge_wins += 1
+                return tasks[winner], winner.result()
+            raise error
+        finally:
+            # Проигравший запрос отменяем; если он успел ответить — закрываем
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    if discard is not None:
+                        task.add_done_callback(
+                            lambda finished, loser=tasks[task]: self._discard_late(finished, loser, discard)
+                        )
+    
+    @staticmethod
+    def _discard_late(task: asyncio.Task, model: str, discard: Callable[[str, Any], Awaitable[None]]) -> None:
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(discard(model, task.result()))
+    
+    @staticmethod
+    def _hedge_delay(model: str) -> Optional[float]:
+        """
+        Через сколько секунд без ответа дублировать запрос к model
+        (None — хеджирование выключено или задержек модели ещё мало).
+        """
+        if not HEDGE_ENABLED:
+            return None
+        percentile = model_router.models[model].latency_percentile(HEDGE_PERCENTILE) if model in model_router.models else None
+        if percentile is None:
+            return None
+        return max(percentile, HEDGE_MIN_DELAY)
+    
+    def _next_model(self, tried: List[str]) -> str:
+        """
+        Модель для следующей попытки: лучшая из ещё не опробованных
+        (см. ModelRouter), а если все исправные уже пробовали — лучшая вообще.
+        """
+        candidates = model_router.candidates(exclude=tried) or model_router.candidates() or [self.default_model]
+        model = candidates[0]
+        if tried:
+            logger.info(f"🔄 Переключаюсь на модель: {model}")
+        tried.append(model)
+        return model
+    
+    async def _retry_pause(self, attempt: int, max_retries: int, tried: List[str], retry_delay: float) -> None:
+        """
+        Пауза перед повтором нужна, только если повторять придётся на уже
+        опробованной модели; на другую модель переключаемся сразу.
+        """
+        if attempt < max_retries - 1 and not model_router.candidates(exclude=tried):
+            await asyncio.sleep(retry_delay)
+    
+    def _build_request(
+        self,
+        question: str,
+        cards: List[str],
+        is_premium: bool,
+        full_history: str,
+        reading_type: Optional[str],
+        stream: bool
+    ) -> Dict[str, Any]:
+        """
+        Тело запроса chat/completions для расклада.
+        """
         system_prompt = self._get_system_prompt(is_premium, reading_type)
         user_prompt = self._get_user_prompt(question, cards, full_history, reading_type)
         
-        data = {
+        return {
             "model": self.default_model,
             "messages": [
                 {"role": "system", "content": system_prompt},
@@ -48,61 +468,8 @@ class OhMyGPTAPI:
             "top_p": 0.95,  # Больше разнообразия
             "frequency_penalty": 0.05,  # Меньше штрафа за повторения
             "presence_penalty": 0.05,  # Меньше штрафа за присутствие слов
-            "stream": False
+            "stream": stream
         }
-        
-        max_retries = 3
-        retry_delay = 2
-        
-        for attempt in range(max_retries):
-            try:
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    response = await client.post(
-                        self.base_url,
-                        headers=headers,
-                        json=data
-                    )
-                    
-                    if response.status_code == 200:
-                        response_json = response.json()
-                        if 'choices' in response_json and response_json['choices']:
-                            logger.info(f"🔮 Ответ получен для пользователя {user_id}: {question[:50]}...")
-                            return response_json
-                        else:
-                            logger.warning(f"⚠️ Нет choices в ответе для пользователя {user_id}")
-                    
-                    # Логируем ошибку
-                    error_msg = f"Статус: {response.status_code}"
-                    if response.status_code != 200:
-                        try:
-                            error_data = response.json()
-                            error_msg += f", Ошибка: {error_data.get('error', {}).get('message', 'Неизвестно')}"
-                        except:
-                            error_msg += f", Тело: {response.text[:100]}"
-                    
-                    logger.error(f"⚠️ Ошибка API для пользователя {user_id} попытка {attempt + 1}: {error_msg}")
-                    
-                    if attempt < len(self.fallback_models):
-                        data["model"] = self.fallback_models[attempt]
-                        logger.info(f"🔄 Переключаюсь на модель: {data['model']}")
-                    
-                    await asyncio.sleep(retry_delay)
-                    
-            except httpx.TimeoutException:
-                logger.error(f"⚠️ Таймаут для пользователя {user_id} попытка {attempt + 1}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(retry_delay * 2)
-                else:
-                    return None
-                    
-            except Exception as e:
-                logger.error(f"⚠️ Общая ошибка для пользователя {user_id} попытка {attempt + 1}: {str(e)}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(retry_delay)
-                else:
-                    return None
-        
-        return None
     
     def _get_system_prompt(self, is_premium: bool, reading_type: str = None) -> str:
         """
@@ -286,4 +653,8 @@ ohmygpt_api = OhMyGPTAPI()
 
 async def get_tarot_response(*args, **kwargs):
     """Обёртка для обратной совместимости."""
-    return await ohmygpt_api.get_tarot_response(*args, **kwargs)
\ No newline at end of file
+    return await ohmygpt_api.get_tarot_response(*args, **kwargs)
+
+def stream_tarot_response(*args, **kwargs) -> AsyncIterator[str]:
+    """Потоковый ответ (см. OhMyGPTAPI.stream_tarot_response)."""
+    return ohmygpt_api.stream_tarot_response(*args, **kwargs)
\ No newline at end of file
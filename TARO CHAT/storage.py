@@ -0,0 +1,195 @@
+"""
+storage.py
+Пул долгоживущих SQLite-соединений для неблокирующего доступа к базе данных.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Размер пула читателей и кэша подготовленных выражений на соединение
+DEFAULT_READERS: int = 4
+DEFAULT_CACHED_STATEMENTS: int = 256
+
+# Допустимые режимы wal_checkpoint
+CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+
+
+class SQLitePool:
+    """
+    Пул соединений SQLite: один поток-писатель и несколько потоков-читателей.
+
+    Каждый поток держит своё соединение на всё время жизни процесса, поэтому
+    кэш подготовленных выражений sqlite3 переиспользуется между вызовами,
+    а сами запросы выполняются вне event loop.
+
+    pragmas применяются к каждому новому соединению в порядке словаря,
+    например {"journal_mode": "WAL", "synchronous": "NORMAL"}.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        readers: int = DEFAULT_READERS,
+        cached_statements: int = DEFAULT_CACHED_STATEMENTS,
+        pragmas: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.db_path: Path = db_path
+        self.readers: int = readers
+        self.cached_statements: int = cached_statements
+        self.pragmas: Dict[str, Any] = dict(pragmas or {})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Открывает новое соединение для текущего потока.
+        """
+        conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        with self._lock:
+            self._connections.append(conn)
+        logger.debug(f"🔌 Opened SQLite connection in {threading.current_thread().name}")
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Возвращает соединение, закреплённое за текущим потоком пула.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _executors(self) -> tuple:
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+                self._reader_pool = ThreadPoolExecutor(
+                    max_workers=self.readers,
+                    thread_name_prefix="sqlite-reader"
+                )
+            return self._writer, self._reader_pool
+
+    def _run_write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        conn = self._connection()
+        try:
+            result = fn(conn)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _run_read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        conn = self._connection()
+        try:
+            return fn(conn)
+        finally:
+            # Читатели не должны держать открытую транзакцию между вызовами
+            if conn.in_transaction:
+                conn.rollback()
+
+    async def read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Выполняет fn(conn) в потоке-читателе.
+        """
+        _, readers = self._executors()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(readers, self._run_read, fn)
+
+    async def write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Выполняет fn(conn) в потоке-писателе одной транзакцией.
+        При исключении транзакция откатывается.
+        """
+        writer, _ = self._executors()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(writer, self._run_write, fn)
+
+    def write_sync(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Синхронный вариант write() для кода вне event loop (инициализация, скрипты).
+        """
+        writer, _ = self._executors()
+        return writer.submit(self._run_write, fn).result()
+
+    def _read_settings(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        settings = {}
+        for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size"):
+            row = conn.execute(f"PRAGMA {name}").fetchone()
+            settings[name] = row[0] if row else None
+        return settings
+
+    async def settings(self) -> Dict[str, Any]:
+        """
+        Возвращает фактические значения PRAGMA на соединении писателя.
+        """
+        return await self.write(self._read_settings)
+
+    async def checkpoint(self, mode: str = "PASSIVE") -> Dict[str, int]:
+        """
+        Переносит содержимое WAL в основной файл базы данных.
+
+        Returns:
+            {"busy": ..., "log_frames": ..., "checkpointed_frames": ...}
+        """
+        mode = mode.upper()
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError(f"Unknown checkpoint mode: {mode}")
+
+        def run(conn: sqlite3.Connection) -> Dict[str, int]:
+            row = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            return {"busy": row[0], "log_frames": row[1], "checkpointed_frames": row[2]}
+
+        return await self.write(run)
+
+    async def optimize(self) -> None:
+        """
+        Выполняет PRAGMA optimize (обновление статистики планировщика запросов).
+        """
+        await self.write(lambda conn: conn.execute("PRAGMA optimize"))
+
+    def close(self) -> None:
+        """
+        Останавливает потоки пула и закрывает все соединения.
+        Пул можно использовать снова: соединения откроются заново при первом запросе.
+        """
+        with self._lock:
+            writer, readers = self._writer, self._reader_pool
+            self._writer = None
+            self._reader_pool = None
+
+        for executor in (writer, readers):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Error closing SQLite connection: {e}")
+
+        # Потоки завершены, их thread-local соединения больше не используются
+        self._local = threading.local()
+        logger.info(f"🔌 SQLite pool closed ({len(connections)} connections)")
@@ -7,7 +7,6 @@ import re
 import logging
 import random
 import asyncio
-import sqlite3
 from aiogram import Bot
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
@@ -20,12 +19,14 @@ import html
 
 from config import (
     ADMIN_ID, MAX_CARDS, TIMEZONE, FREE_REQUEST_INTERVAL,
-    BOT_USERNAME, TAROT_READER_NAME, DB_PATH
+    BOT_USERNAME, TAROT_READER_NAME, FREE_REQUESTS_BATCH_SIZE,
+    DELIVERY_REPROBE_DAYS, DELIVERY_REPROBE_BATCH
 )
-from database import Database
+from database import db, FREE_REQUESTS_JOB
+from audience import Segment
+from broadcast import new_broadcast
 
 logger = logging.getLogger(__name__)
-db = Database()
 
 @lru_cache(maxsize=1)
 def get_tarot_cards() -> Dict[str, Dict[str, str]]:
@@ -247,6 +248,13 @@ async def send_admin_notification(bot: Bot, message: str) -> None:
     except Exception as e:
         logger.error(f"⚠️ Failed to send admin notification: {e}")
 
+def strip_html_tags(text: str) -> str:
+    """
+    Удаляет HTML-теги из ответа ИИ (модель иногда размечает текст, хотя её просят
+    писать без HTML). Общая очистка для обычного и потокового ответа.
+    """
+    return re.sub(r'<[^>]*>', '', text)
+
 def format_tarot_response(
     answer: str,
     question: str,
@@ -258,36 +266,11 @@ def format_tarot_response(
     Форматирует ответ от ИИ. Возвращает список сообщений для отправки.
     Каждое сообщение гарантированно меньше 4096 символов.
     """
-    import re
-    import random
-    
     # 1. Удаляем все HTML-теги из ответа ИИ
-    answer = re.sub(r'<[^>]*>', '', answer)
+    answer = strip_html_tags(answer)
     
     # 2. Создаём первое сообщение с вопросом и картами
-    messages = []
-    
-    message1 = f"🔮 <b>Твой расклад готов, дорогой друг!</b>\n\n"
-    
-    # Добавляем вопрос (обрезаем если слишком длинный)
-    short_question = question[:200] + ("..." if len(question) > 200 else "")
-    message1 += f"✨ <b>Твой вопрос:</b>\n<i>{short_question}</i>\n\n"
-    
-    # Добавляем карты
-    message1 += f"🃏 <b>Выпавшие карты:</b>\n"
-    for card in cards:
-        message1 += f"• {card}\n"
-    message1 += "\n" + "━" * 25 + "\n\n"
-    
-    # Проверяем длину первого сообщения
-    if len(message1) > 4000:
-        # Если слишком длинное, упрощаем
-        message1 = f"🔮 <b>Твой расклад готов!</b>\n\n"
-        message1 += f"✨ <b>Вопрос:</b> {question[:100]}...\n\n"
-        message1 += f"🃏 <b>Карты:</b> {', '.join(cards[:3])}{'...' if len(cards) > 3 else ''}\n\n"
-        message1 += "━" * 25 + "\n\n"
-    
-    messages.append(message1)
+    messages = [format_reading_header(question, cards)]
     
     # 3. Разбиваем основной ответ на части
     MAX_PART_LENGTH = 3800  # Оставляем запас
@@ -326,6 +309,42 @@ def format_tarot_response(
                 messages.append(current_part.strip() + "\n\n")
     
     # 4. Создаём финальное сообщение
+    messages.append(format_reading_footer(answer, is_premium, reader_name))
+    
+    return messages
+
+def format_reading_header(question: str, cards: List[str]) -> str:
+    """
+    Первое сообщение расклада: вопрос и выпавшие карты.
+    """
+    message1 = f"🔮 <b>Твой расклад готов, дорогой друг!</b>\n\n"
+    
+    # Добавляем вопрос (обрезаем если слишком длинный)
+    short_question = question[:200] + ("..." if len(question) > 200 else "")
+    message1 += f"✨ <b>Твой вопрос:</b>\n<i>{short_question}</i>\n\n"
+    
+    # Добавляем карты
+    message1 += f"🃏 <b>Выпавшие карты:</b>\n"
+    for card in cards:
+        message1 += f"• {card}\n"
+    message1 += "\n" + "━" * 25 + "\n\n"
+    
+    # Проверяем длину первого сообщения
+    if len(message1) > 4000:
+        # Если слишком длинное, упрощаем
+        message1 = f"🔮 <b>Твой расклад готов!</b>\n\n"
+        message1 += f"✨ <b>Вопрос:</b> {question[:100]}...\n\n"
+        message1 += f"🃏 <b>Карты:</b> {', '.join(cards[:3])}{'...' if len(cards) > 3 else ''}\n\n"
+        message1 += "━" * 25 + "\n\n"
+    
+    return message1
+
+def format_reading_footer(answer: str, is_premium: bool, reader_name: str = TAROT_READER_NAME) -> str:
+    """
+    Финальное сообщение расклада: режим, объём, подпись и совет дня.
+    """
+    import random
+    
     final_message = "━" * 25 + "\n\n"
     
     if is_premium:
@@ -352,9 +371,7 @@ def format_tarot_response(
     advice = get_random_advice()
     final_message += f"💡 <i>Совет дня: {advice}</i>"
     
-    messages.append(final_message)
-    
-    return messages
+    return final_message
 
 def format_datetime(timestamp_str: Optional[str]) -> str:
     """
@@ -444,41 +461,91 @@ async def check_free_request_interval(user_id: int) -> bool:
 async def add_free_requests_task(bot: Bot) -> None:
     """
     Задача для добавления бесплатных запросов всем пользователям с уведомлением.
-    """
-    logger.info("🔮 Starting free requests distribution task with notifications")
+
+    Пользователи обрабатываются пачками по user_id: начисление пачки и сдвиг
+    контрольной точки — одна транзакция, уведомления пачки отправляются,
+    пока начисляется следующая. Прерванный запуск за тот же день (UTC)
+    продолжается с контрольной точки, завершённый повторно не выполняется.
+    """
+    run_key = datetime.utcnow().strftime("%Y-%m-%d")
+    checkpoint = await db.get_job_checkpoint(FREE_REQUESTS_JOB, run_key)
+    if checkpoint and checkpoint["finished_at"]:
+        logger.info(f"🔮 Free requests for {run_key} already distributed")
+        return
+    
+    last_id = checkpoint["last_id"] if checkpoint else 0
+    logger.info(f"🔮 Starting free requests distribution for {run_key} from user {last_id}")
+    
+    builder = InlineKeyboardBuilder()
+    builder.button(text="💎 Купить премиум", callback_data="buy_premium")
+    markup = builder.as_markup()
+    
+    async def notify(row: Tuple[int, int, int, Optional[str]]) -> None:
+        user_id, requests_left, premium_requests, _ = row
+        text = (
+            f"✨ Луна подарила тебе 1 бесплатный запрос! 🆓\n"
+            f"Теперь у тебя: 🆓 {requests_left} / 💎 {premium_requests}\n\n"
+            f"Бесплатные — для простых вопросов, начисляются раз в сутки.\n"
+            f"Хочешь самые глубокие, точные и страстные ответы? Бери премиум 💎 — они раскрывают всё 🔥\n\n"
+            f"💋 А за самыми горячими раскладами 18+ заходи в @EroticMoonBot 🔥"
+        )
+        await bot.send_message(user_id, text, reply_markup=markup)
     
+    granted = 0
+    notified = 0
+    sending: Optional[asyncio.Task] = None
     try:
-        users_affected, requests_added = await db.add_free_requests_to_all()
-        
-        if users_affected > 0:
-            logger.info(f"🔮 Added free requests to {users_affected} users")
+        while True:
+            rows = await db.grant_free_requests_batch(run_key, last_id, FREE_REQUESTS_BATCH_SIZE)
+            if sending is not None:
+                notified += (await sending)["sent"]
+                sending = None
+            if rows is None:
+                # Ошибка базы: запуск не завершён и продолжится с контрольной точки
+                logger.warning(f"⚠️ Free requests distribution paused after user {last_id}")
+                return
+            if not rows:
+                break
             
-            # Рассылаем уведомления
-            users = await db.get_all_users()
-            for user in users:
-                user_id = user['user_id']
-                try:
-                    # Получаем актуальные данные пользователя
-                    user_data = await db.get_user(user_id)
-                    if not user_data: continue
-                    
-                    text = (
-                        f"✨ Луна подарила тебе 1 бесплатный запрос! 🆓\n"
-                        f"Теперь у тебя: 🆓 {user_data['requests_left']} / 💎 {user_data['premium_requests']}\n\n"
-                        f"Бесплатные — для простых вопросов, начисляются раз в сутки.\n"
-                        f"Хочешь самые глубокие, точные и страстные ответы? Бери премиум 💎 — они раскрывают всё 🔥\n\n"
-                        f"💋 А за самыми горячими раскладами 18+ заходи в @EroticMoonBot 🔥"
-                    )
-                    builder = InlineKeyboardBuilder()
-                    builder.button(text="💎 Купить премиум", callback_data="buy_premium")
-                    
-                    await bot.send_message(user_id, text, reply_markup=builder.as_markup())
-                    await asyncio.sleep(0.05)  # Защита от флуда
-                except Exception as e:
-                    logger.debug(f"Failed to notify user {user_id}: {e}")
-                    
+            granted += len(rows)
+            last_id = max(row[0] for row in rows)
+            # Запрос начисляется всем, уведомление — только доступным чатам
+            recipients = [row for row in rows if row[3] is None]
+            sending = asyncio.create_task(new_broadcast().run(recipients, notify, chat_id=lambda row: row[0]))
+        
+        await db.finish_job(FREE_REQUESTS_JOB, run_key)
+        logger.info(f"🔮 Added free requests to {granted} users, notified {notified}")
+    except Exception as e:
+        if sending is not None:
+            sending.cancel()
+        logger.error(f"⚠️ Error in free requests task (stopped after user {last_id}): {e}")
+
+async def reprobe_undeliverable_task(bot: Bot) -> None:
+    """
+    Повторная проверка чатов, отмеченных недоступными больше
+    DELIVERY_REPROBE_DAYS дней назад: пользователю без уведомления
+    отправляется действие «печатает». Доступные чаты возвращаются
+    в рассылки, недоступные отмечаются заново (с новой датой).
+    """
+    try:
+        user_ids = await db.get_undeliverable_users(DELIVERY_REPROBE_DAYS, DELIVERY_REPROBE_BATCH)
+        if not user_ids:
+            return
+        
+        reachable: List[int] = []
+        
+        async def probe(user_id: int) -> None:
+            await bot.send_chat_action(user_id, "typing")
+            reachable.append(user_id)
+        
+        report = await new_broadcast().run(user_ids, probe)
+        await db.mark_deliverable(reachable)
+        logger.info(
+            f"📭 Re-probed {len(user_ids)} undeliverable chats: {len(reachable)} reachable again, "
+            f"{report['blocked'] + report['not_found']} still unreachable"
+        )
     except Exception as e:
-        logger.error(f"⚠️ Error in free requests task: {e}")
+        logger.error(f"⚠️ Error re-probing undeliverable chats: {e}")
 
 async def send_promotional_message(bot: Bot) -> None:
     """
@@ -487,13 +554,14 @@ async def send_promotional_message(bot: Bot) -> None:
     logger.info("🔮 Starting 12h promotional task")
     
     try:
-        active_users = await db.get_active_users(days=7)
+        segment = Segment.active(7)
+        total = await db.count_audience(segment)
         
-        if not active_users:
+        if not total:
             logger.info("🔮 No active users found for promotion")
             return
             
-        logger.info(f"🔮 Sending promotion to {len(active_users)} active users")
+        logger.info(f"🔮 Sending promotion to {total} active users")
         
         text = (
             "🌙 Хочешь откровенные и горячие расклады 18+? Переходи в @EroticMoonBot 🔥\n"
@@ -503,15 +571,14 @@ async def send_promotional_message(bot: Bot) -> None:
         builder = InlineKeyboardBuilder()
         builder.button(text="💋 Перейти в Эротику", url="https://t.me/EroticMoonBot")
         
-        for user in active_users:
-            user_id = user['user_id']
-            try:
-                await bot.send_message(user_id, text, reply_markup=builder.as_markup())
-                await asyncio.sleep(0.05)  # Защита от флуда
-            except Exception as e:
-                logger.debug(f"Failed to send promotion to user {user_id}: {e}")
-                
-        logger.info("🔮 Promotional campaign completed")
+        markup = builder.as_markup()
+        
+        report = await new_broadcast().run(
+            db.iter_audience(segment),
+            lambda user_id: bot.send_message(user_id, text, reply_markup=markup),
+            total=total
+        )
+        logger.info(f"🔮 Promotional campaign completed: {report['sent']} sent, {report['blocked']} blocked")
     except Exception as e:
         logger.error(f"⚠️ Error in promotional task: {e}")
 
@@ -549,18 +616,12 @@ async def get_user_level(user_id: int) -> int:
         Уровень от 1 до 10
     """
     try:
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            cursor = conn.cursor()
-            
-            # Получаем количество раскладов пользователя
-            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,))
-            history_count = cursor.fetchone()[0] or 0
-            
-            # Уровень: 1 уровень за каждые 5 раскладов, максимум 10
-            level = min(history_count // 5 + 1, 10)
-            
-            logger.info(f"🔮 User {user_id} level: {level} (based on {history_count} readings)")
-            return level
+        # Счётчик раскладов из user_stats (кэшируется вместе с пользователем)
+        user_data = await db.get_user_with_stats(user_id)
+        readings_count = (user_data or {}).get("total_readings") or 0
+        
+        # Уровень: 1 уровень за каждые 5 раскладов, максимум 10
+        return min(readings_count // 5 + 1, 10)
             
     except Exception as e:
         logger.error(f"⚠️ Error getting user level for {user_id}: {e}")
@@ -574,95 +635,16 @@ async def get_user_achievements(user_id: int) -> List[str]:
         user_id: ID пользователя
         
     Returns:
-        Список названий достижений
+        Список названий достижений с эмодзи ("🌱 Новичок")
     """
-    try:
-        achievements = []
-        
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            cursor = conn.cursor()
-            
-            # 1. Проверяем количество раскладов
-            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,))
-            history_count = cursor.fetchone()[0] or 0
-            
-            if history_count >= 1:
-                achievements.append("🌱 Новичок")
-            if history_count >= 5:
-                achievements.append("🔮 Искатель")
-            if history_count >= 10:
-                achievements.append("🌟 Мудрец")
-            if history_count >= 20:
-                achievements.append("💫 Маг")
-            if history_count >= 50:
-                achievements.append("✨ Мастер")
-            if history_count >= 100:
-                achievements.append("👑 Великий Маг")
-            
-            # 2. Проверяем премиум-расклады
-            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ? AND is_premium = TRUE", (user_id,))
-            premium_count = cursor.fetchone()[0] or 0
-            
-            if premium_count >= 1:
-                achievements.append("💎 Коллекционер")
-            if premium_count >= 5:
-                achievements.append("💎 Элитный")
-            if premium_count >= 10:
-                achievements.append("💎 Королевский Коллекционер")
-            
-            # 3. Проверяем рефералов
-            cursor.execute("SELECT COUNT(*) FROM users WHERE referral_id = ?", (user_id,))
-            referrals_count = cursor.fetchone()[0] or 0
-            
-            if referrals_count >= 1:
-                achievements.append("🤝 Наставник")
-            if referrals_count >= 3:
-                achievements.append("🌙 Проводник")
-            if referrals_count >= 5:
-                achievements.append("🤝 Мастер Наставничества")
-            
-            # 4. Проверяем разнообразие раскладов
-            cursor.execute("""
-                SELECT COUNT(DISTINCT reading_type) 
-                FROM history 
-                WHERE user_id = ? AND reading_type IS NOT NULL
-            """, (user_id,))
-            reading_types_count = cursor.fetchone()[0] or 0
-            
-            if reading_types_count >= 3:
-                achievements.append("📚 Энциклопедист")
-            
-            # 5. Проверяем активность по дням
-            cursor.execute("""
-                SELECT COUNT(DISTINCT DATE(timestamp)) 
-                FROM history 
-                WHERE user_id = ? AND timestamp >= datetime('now', '-7 days')
-            """, (user_id,))
-            active_days = cursor.fetchone()[0] or 0
-            
-            if active_days >= 7:
-                achievements.append("🔥 Ежедневный практик")
-            
-            logger.info(f"🔮 User {user_id} achievements: {len(achievements)} achievements")
-            
-        return achievements
-        
-    except Exception as e:
-        logger.error(f"⚠️ Error getting user achievements for {user_id}: {e}")
-        return []
+    achievements = await db.get_user_achievements(user_id)
+    return [f"{a['achievement_emoji']} {a['achievement_name']}" for a in achievements]
 
 async def get_premium_history_count(user_id: int) -> int:
     """
     Получает количество премиум-раскладов пользователя.
     """
-    try:
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ? AND is_premium = TRUE", (user_id,))
-            return cursor.fetchone()[0] or 0
-    except Exception as e:
-        logger.error(f"⚠️ Error getting premium history count for {user_id}: {e}")
-        return 0
+    return await db.get_premium_history_count(user_id)
 
 async def get_user_statistics(user_id: int) -> Dict[str, Any]:
     """
@@ -672,53 +654,17 @@ async def get_user_statistics(user_id: int) -> Dict[str, Any]:
         Словарь с различными статистиками
     """
     try:
-        with sqlite3.connect(str(DB_PATH)) as conn:
-            cursor = conn.cursor()
-            
-            stats = {}
-            
-            # Общее количество раскладов
-            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,))
-            stats["total_readings"] = cursor.fetchone()[0] or 0
-            
-            # Количество премиум-раскладов
-            cursor.execute("SELECT COUNT(*) FROM history WHERE user_id = ? AND is_premium = TRUE", (user_id,))
-            stats["premium_readings"] = cursor.fetchone()[0] or 0
-            
-            # Среднее количество карт в раскладе
-            cursor.execute("SELECT AVG(LENGTH(cards) - LENGTH(REPLACE(cards, ',', '')) + 1) FROM history WHERE user_id = ?", (user_id,))
-            stats["avg_cards"] = round(cursor.fetchone()[0] or 0, 1)
-            
-            # Самый частый тип расклада
-            cursor.execute("""
-                SELECT reading_type, COUNT(*) as count 
-                FROM history 
-                WHERE user_id = ? AND reading_type IS NOT NULL
-                GROUP BY reading_type 
-                ORDER BY count DESC 
-                LIMIT 1
-            """, (user_id,))
-            result = cursor.fetchone()
-            stats["favorite_type"] = result[0] if result else "Не определен"
-            
-            # Дни активности
-            cursor.execute("SELECT COUNT(DISTINCT DATE(timestamp)) FROM history WHERE user_id = ?", (user_id,))
-            stats["active_days"] = cursor.fetchone()[0] or 0
-            
-            # Первый и последний расклад
-            cursor.execute("SELECT MIN(timestamp), MAX(timestamp) FROM history WHERE user_id = ?", (user_id,))
-            dates = cursor.fetchone()
-            stats["first_reading"] = dates[0] if dates[0] else None
-            stats["last_reading"] = dates[1] if dates[1] else None
-            
-            # Уровень
-            stats["level"] = await get_user_level(user_id)
-            
-            # Достижения
-            stats["achievements"] = await get_user_achievements(user_id)
-            stats["achievements_count"] = len(stats["achievements"])
-            
-            return stats
+        # Счётчики из БД учитывают и заархивированные расклады
+        stats = await db.get_reading_summary(user_id)
+        
+        # Уровень
+        stats["level"] = await get_user_level(user_id)
+        
+        # Достижения
+        stats["achievements"] = await get_user_achievements(user_id)
+        stats["achievements_count"] = len(stats["achievements"])
+        
+        return stats
             
     except Exception as e:
         logger.error(f"⚠️ Error getting user statistics for {user_id}: {e}")